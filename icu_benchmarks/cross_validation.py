@@ -1,13 +1,16 @@
 import json
+import random
 from datetime import datetime
 import logging
 import gin
+import numpy as np
+import torch
 from pathlib import Path
 from pytorch_lightning import seed_everything
 
 from icu_benchmarks.wandb_utils import wandb_log
 from icu_benchmarks.run_utils import aggregate_results
-from icu_benchmarks.data.split_process_data import preprocess_data
+from icu_benchmarks.data.split_process_data import preprocess_data, drop_generated_features
 from icu_benchmarks.models.train import train_common
 from icu_benchmarks.models.utils import JsonResultLoggingEncoder
 from icu_benchmarks.run_utils import log_full_line
@@ -37,7 +40,9 @@ def execute_repeated_cv(
     cpu: bool = False,
     verbose: bool = False,
     wandb: bool = False,
-    complete_train: bool = False
+    complete_train: bool = False,
+    fold_pruner: object = None,
+    model_runs: dict = None,
 ) -> float:
     """Preprocesses data and trains a model for each fold.
 
@@ -65,14 +70,39 @@ def execute_repeated_cv(
         pretrained_imputation_model: Use a pretrained imputation model.
         cpu: Whether to run on CPU.
         verbose: Enable detailed logging.
+        fold_pruner: Optional FoldPruner that can stop training the remaining folds (used for hyperparameter tuning).
+        model_runs: Train several models on each preprocessed fold instead, see execute_repeated_cv_for_models. The folds are
+            logged in the run directory of each model and log_dir is ignored.
     Returns:
-        The average loss of all folds.
+        The average loss of all trained folds, per model if model_runs is set.
     """
     if not cv_repetitions_to_train:
         cv_repetitions_to_train = cv_repetitions
     if not cv_folds_to_train:
         cv_folds_to_train = cv_folds
+    if model_runs is not None:
+        return execute_repeated_cv_for_models(
+            model_runs,
+            data_dir,
+            seed,
+            train_size=train_size,
+            cv_repetitions=cv_repetitions,
+            cv_repetitions_to_train=cv_repetitions_to_train,
+            cv_folds=cv_folds,
+            cv_folds_to_train=1 if complete_train else cv_folds_to_train,
+            reproducible=reproducible,
+            debug=debug,
+            generate_cache=generate_cache,
+            load_cache=load_cache,
+            test_on=test_on,
+            mode=mode,
+            pretrained_imputation_model=pretrained_imputation_model,
+            cpu=cpu,
+            verbose=verbose,
+            complete_train=complete_train,
+        )
     agg_loss = 0
+    trained_folds = 0
     seed_everything(seed, reproducible)
     if complete_train:
         logging.info("Will train full model without cross validation.")
@@ -101,12 +131,13 @@ def execute_repeated_cv(
                 fold_index=fold_index,
                 pretrained_imputation_model=pretrained_imputation_model,
                 runmode=mode,
-                complete_train=complete_train
+                complete_train=complete_train,
+                recipe_dirs=[repetition_fold_dir],
             )
 
             preprocess_time = datetime.now() - start_time
             start_time = datetime.now()
-            agg_loss += train_common(
+            fold_loss = train_common(
                 data,
                 log_dir=repetition_fold_dir,
                 eval_only=eval_only,
@@ -121,6 +152,8 @@ def execute_repeated_cv(
                 train_only=complete_train
             )
             train_time = datetime.now() - start_time
+            agg_loss += fold_loss
+            trained_folds += 1
 
             log_full_line(
                 f"FINISHED FOLD {fold_index}| PREPROCESSING DURATION {preprocess_time}| PROCEDURE DURATION {train_time}",
@@ -134,6 +167,160 @@ def execute_repeated_cv(
                 wandb_log({"Iteration": repetition * cv_folds_to_train + fold_index})
             if repetition * cv_folds_to_train + fold_index > 1:
                 aggregate_results(log_dir)
+            if fold_pruner is not None and fold_pruner.should_prune(fold_loss, cv_repetitions_to_train * cv_folds_to_train):
+                break
         log_full_line(f"FINISHED CV REPETITION {repetition}", level=logging.INFO, char="=", num_newlines=3)
+        if fold_pruner is not None and fold_pruner.pruned:
+            break
 
-    return agg_loss / (cv_repetitions_to_train * cv_folds_to_train)
+    return agg_loss / trained_folds
+
+
+def execute_repeated_cv_for_models(
+    model_runs: dict,
+    data_dir: Path,
+    seed: int,
+    train_size: int = None,
+    cv_repetitions: int = 5,
+    cv_repetitions_to_train: int = 5,
+    cv_folds: int = 5,
+    cv_folds_to_train: int = 5,
+    reproducible: bool = True,
+    debug: bool = False,
+    generate_cache: bool = False,
+    load_cache: bool = False,
+    test_on: str = "test",
+    mode: str = RunMode.classification,
+    pretrained_imputation_model: object = None,
+    cpu: bool = False,
+    verbose: bool = False,
+    complete_train: bool = False,
+) -> dict[str, float]:
+    """Preprocesses each fold once and trains several models on it in sequence.
+
+    The data is preprocessed with the generated features if any model uses them. Models without generated features are
+    trained on the same data with these features removed. Datasets are built once per feature set and shared by the models.
+    Before each model is trained, its own gin config is bound and its own random state is restored. Each model starts from
+    the seed and continues with the random state it left after its previous fold, like when it is trained on its own with
+    execute_repeated_cv. As preprocessing does not draw from the global random state, the results of a model match a run of
+    that model on its own and do not depend on the other models.
+
+    Args:
+        model_runs: Dict that maps each model name to a dict with its gin "config" string, its "run_dir" and whether it uses
+            the "generate_features" of the preprocessor.
+        data_dir: Path to the data directory.
+        seed: Random seed.
+        train_size: Fixed size of train split (including validation data).
+        cv_repetitions: Amount of cross validation repetitions.
+        cv_repetitions_to_train: Amount of training repetitions.
+        cv_folds: Number of folds for cross validation.
+        cv_folds_to_train: Number of folds to use during training.
+        reproducible: Whether to make torch reproducible.
+        debug: Whether to load less data and enable more logging.
+        generate_cache: Whether to generate and save cache.
+        load_cache: Whether to load previously cached data.
+        test_on: Dataset to test on. Can be "test" or "val".
+        mode: Run mode. Can be one of the values of RunMode
+        pretrained_imputation_model: Use a pretrained imputation model.
+        cpu: Whether to run on CPU.
+        verbose: Enable detailed logging.
+        complete_train: Use the full data for training instead of held out test splits.
+
+    Returns:
+        The average loss of all trained folds per model.
+    """
+    feature_runs = [run for run in model_runs.values() if run["generate_features"]]
+    preprocessing_config = (feature_runs or list(model_runs.values()))[0]["config"]
+    agg_losses = {model: 0 for model in model_runs}
+    random_states = {}
+    trained_folds = 0
+    logging.info(f"Training {', '.join(model_runs)} on {cv_repetitions_to_train} repetitions of {cv_folds_to_train} folds.")
+
+    for repetition in range(cv_repetitions_to_train):
+        for fold_index in range(cv_folds_to_train):
+            fold_dir = Path(f"repetition_{repetition}") / f"fold_{fold_index}"
+            model_fold_dirs = {model: run["run_dir"] / fold_dir for model, run in model_runs.items()}
+            for model_fold_dir in model_fold_dirs.values():
+                model_fold_dir.mkdir(parents=True, exist_ok=True)
+
+            start_time = datetime.now()
+            bind_gin_config(preprocessing_config)
+            data = preprocess_data(
+                data_dir,
+                seed=seed,
+                debug=debug,
+                load_cache=load_cache,
+                generate_cache=generate_cache,
+                cv_repetitions=cv_repetitions,
+                repetition_index=repetition,
+                train_size=train_size,
+                cv_folds=cv_folds,
+                fold_index=fold_index,
+                pretrained_imputation_model=pretrained_imputation_model,
+                runmode=mode,
+                complete_train=complete_train,
+                recipe_dirs=list(model_fold_dirs.values()),
+            )
+            fold_data = {True: data, False: drop_generated_features(data)} if feature_runs else {False: data}
+            preprocess_time = datetime.now() - start_time
+            # Datasets are shared by the models with the same features.
+            dataset_caches = {generate_features: {} for generate_features in fold_data}
+
+            for model, run in model_runs.items():
+                model_fold_dir = model_fold_dirs[model]
+                bind_gin_config(run["config"])
+                if model in random_states:
+                    set_random_states(random_states[model])
+                else:
+                    seed_everything(seed, reproducible)
+                start_time = datetime.now()
+                agg_losses[model] += train_common(
+                    fold_data[run["generate_features"]],
+                    log_dir=model_fold_dir,
+                    reproducible=reproducible,
+                    test_on=test_on,
+                    mode=mode,
+                    cpu=cpu,
+                    verbose=verbose,
+                    train_only=complete_train,
+                    dataset_cache=dataset_caches[run["generate_features"]],
+                )
+                train_time = datetime.now() - start_time
+                random_states[model] = get_random_states()
+
+                log_full_line(
+                    f"FINISHED {model} ON FOLD {fold_index}| PREPROCESSING DURATION {preprocess_time}| "
+                    f"PROCEDURE DURATION {train_time}",
+                    level=logging.INFO,
+                )
+                durations = {"preprocessing_duration": preprocess_time, "train_duration": train_time}
+                with open(model_fold_dir / "durations.json", "w") as f:
+                    json.dump(durations, f, cls=JsonResultLoggingEncoder)
+                if repetition * cv_folds_to_train + fold_index > 1:
+                    aggregate_results(run["run_dir"])
+            trained_folds += 1
+        log_full_line(f"FINISHED CV REPETITION {repetition}", level=logging.INFO, char="=", num_newlines=3)
+
+    return {model: agg_loss / trained_folds for model, agg_loss in agg_losses.items()}
+
+
+def bind_gin_config(config: str):
+    """Replaces the current gin bindings by the given config."""
+    gin.clear_config()
+    gin.parse_config(config)
+
+
+def get_random_states() -> tuple:
+    """Returns the global random states of Python, numpy and torch."""
+    cuda_states = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    return random.getstate(), np.random.get_state(), torch.get_rng_state(), cuda_states
+
+
+def set_random_states(states: tuple):
+    """Restores the global random states returned by get_random_states."""
+    python_state, numpy_state, torch_state, cuda_states = states
+    random.setstate(python_state)
+    np.random.set_state(numpy_state)
+    torch.set_rng_state(torch_state)
+    if cuda_states:
+        torch.cuda.set_rng_state_all(cuda_states)
@@ -1,8 +1,8 @@
 from typing import List
-from pandas import DataFrame
+from pandas import DataFrame, MultiIndex, concat, factorize
 import gin
 import numpy as np
-from torch import Tensor, cat, from_numpy, float32
+from torch import Size, Tensor, cat, from_numpy, float32
 from torch.utils.data import Dataset
 import logging
 from typing import Dict, Tuple
@@ -11,6 +11,9 @@ from icu_benchmarks.imputation.amputations import ampute_data
 from .constants import DataSegment as Segment
 from .constants import DataSplit as Split
 
+# Separator of the names of the attributes of an intersectional grouping of the stays, e.g. "sex&age".
+GROUP_SEPARATOR = "&"
+
 
 class CommonDataset(Dataset):
     """Common dataset: subclass of Torch Dataset that represents the data to learn on.
@@ -59,6 +62,17 @@ class CommonDataset(Dataset):
     def get_feature_names(self):
         return self.features_df.columns
 
+    def get_input_shape(self, batch_size: int) -> Size:
+        """Returns the shape of a batch of input data, without loading it.
+
+        Args:
+            batch_size: Number of samples in the batch.
+
+        Returns:
+            Shape of the batch, consisting of batch size, sequence length and number of features.
+        """
+        return Size([batch_size, self.maxlen, self.features_df.shape[1]])
+
     def to_tensor(self):
         values = []
         for entry in self:
@@ -75,13 +89,44 @@ class PredictionDataset(CommonDataset):
 
     Args:
         ram_cache (bool, optional): Whether the complete dataset should be stored in ram. Defaults to True.
+        group_attributes (list, optional): Sensitive attributes to group the stays by for subgroup metrics, e.g.
+            ["sex", ["sex", "age"]]. A list of attributes groups the stays by the intersection of their values. The group
+            ids of each stay are returned as a fourth element of the samples. Defaults to None.
     """
 
-    def __init__(self, *args, ram_cache: bool = True, **kwargs):
-        super().__init__(*args, grouping_segment=Segment.outcome, **kwargs)
+    def __init__(self, data: dict, *args, ram_cache: bool = True, group_attributes: list = None, **kwargs):
+        super().__init__(data, *args, grouping_segment=Segment.outcome, **kwargs)
         self.outcome_df = self.grouping_df
+        self.group_ids = None
+        self.groupings = {}
+        if group_attributes:
+            self.group_stays(data, group_attributes)
         self.ram_cache(ram_cache)
 
+    def group_stays(self, data: dict, group_attributes: list):
+        """Numbers the groups of the stays once for each sensitive attribute or intersection of attributes.
+
+        The groups are numbered over the stays of all splits, so a group has the same id in each split.
+
+        Args:
+            data: Dict of the different splits of the data.
+            group_attributes: Attributes, or lists of attributes, to group the stays by.
+        """
+        stay_ids = self.outcome_df.index.unique()
+        group_ids = []
+        for attributes in group_attributes:
+            attributes = [attributes] if isinstance(attributes, str) else list(attributes)
+            values = {
+                split: data[split][Segment.features].groupby(self.vars["GROUP"], sort=False)[attributes].first()
+                for split in data
+                if Segment.features in data[split]
+            }
+            groups = MultiIndex.from_frame(concat(values.values()).drop_duplicates()).sort_values()
+            group_ids.append(groups.get_indexer(MultiIndex.from_frame(values[self.split].reindex(stay_ids))))
+            self.groupings[GROUP_SEPARATOR.join(attributes)] = len(groups)
+        self.group_ids = np.stack(group_ids, axis=1)
+        logging.info(f"Grouped the {self.split} stays by {self.groupings}.")
+
     def __getitem__(self, idx: int) -> Tuple[Tensor, Tensor, Tensor]:
         """Function to sample from the data split of choice. Used for deep learning implementations.
 
@@ -89,7 +134,8 @@ class PredictionDataset(CommonDataset):
             idx: A specific row index to sample.
 
         Returns:
-            A sample from the data, consisting of data, labels and padding mask.
+            A sample from the data, consisting of data, labels and padding mask, and the group ids of the stay if the stays
+            are grouped.
         """
         if self._cached_dataset is not None:
             return self._cached_dataset[idx]
@@ -124,6 +170,8 @@ class PredictionDataset(CommonDataset):
         labels = labels.astype(np.float32)
         data = window.astype(np.float32)
 
+        if self.group_ids is not None:
+            return from_numpy(data), from_numpy(labels), from_numpy(pad_mask), from_numpy(self.group_ids[idx])
         return from_numpy(data), from_numpy(labels), from_numpy(pad_mask)
 
     def get_balance(self) -> list:
@@ -135,6 +183,56 @@ class PredictionDataset(CommonDataset):
         counts = self.outcome_df[self.vars["LABEL"]].value_counts()
         return list((1 / counts) * np.sum(counts) / counts.shape[0])
 
+    def get_subsample_indices(self, fraction: float, seed: int = 42) -> List[int]:
+        """Return the indices of a fixed subsample of stays, stratified by whether a stay has a positive label.
+
+        Args:
+            fraction: Fraction of the stays to sample.
+            seed: Random seed, which keeps the subsample fixed across epochs and runs.
+
+        Returns:
+            Indices of the sampled stays.
+        """
+        stay_ids = self.outcome_df.index.unique()
+        labels = self.outcome_df[self.vars["LABEL"]].groupby(level=self.vars["GROUP"]).max().reindex(stay_ids)
+        positive = labels.to_numpy() > 0
+        rng = np.random.default_rng(seed)
+        indices = []
+        for stratum in [np.flatnonzero(positive), np.flatnonzero(~positive)]:
+            num_samples = int(np.ceil(fraction * len(stratum)))
+            indices.extend(rng.choice(stratum, num_samples, replace=False).tolist())
+        return sorted(indices)
+
+    def get_negative_subsample(self, rate: float, seed: int = 42) -> Tuple[np.array, np.array]:
+        """Returns a subsample of the labels with all positive labels and a fraction of the negative labels of each stay.
+
+        Of the n negative labels of a stay, ceil(rate * n) are sampled, so every stay keeps at least one. They are weighted
+        with the inverse of the sampled fraction of their stay, so that the weighted negative labels sum up to those of the
+        full data.
+
+        Args:
+            rate: Fraction of the negative labels of each stay to sample.
+            seed: Random seed, which keeps the subsample fixed across runs.
+
+        Returns:
+            The indices of the sampled labels in the order of get_data_and_labels, and their importance weights.
+        """
+        labels = self.outcome_df[self.vars["LABEL"]].to_numpy()
+        stays = self.get_stay_indices()
+        negatives = np.flatnonzero(labels == 0)
+        rng = np.random.default_rng(seed)
+        # Negative labels in a random order within each stay, of which the first ceil(rate * n) of each stay are kept.
+        order = negatives[np.lexsort((rng.random(len(negatives)), stays[negatives]))]
+        counts = np.bincount(stays[order], minlength=stays.max() + 1)
+        starts = np.cumsum(counts) - counts
+        kept = np.ceil(rate * counts)
+        positions = np.arange(len(order)) - starts[stays[order]]
+        sampled = order[positions < kept[stays[order]]]
+        weights = np.ones(len(labels))
+        weights[sampled] = (counts / np.maximum(kept, 1))[stays[sampled]]
+        indices = np.sort(np.concatenate([np.flatnonzero(labels != 0), sampled]))
+        return indices, weights[indices]
+
     def get_data_and_labels(self) -> Tuple[np.array, np.array]:
         """Function to return all the data and labels aligned at once.
 
@@ -152,6 +250,25 @@ class PredictionDataset(CommonDataset):
 
         return rep, labels
 
+    def get_stay_indices(self) -> np.array:
+        """Returns the index of the stay of each label, in the order of get_data_and_labels."""
+        return factorize(self.outcome_df.index)[0]
+
+    def get_stay_ids(self) -> np.array:
+        """Returns the ids of the stays, in the order of the samples."""
+        return self.outcome_df.index.unique().to_numpy()
+
+    def get_time_steps(self) -> np.array:
+        """Returns the time step within its stay of each label, in the order of get_data_and_labels.
+
+        A single label of a stay belongs to the last time step of the stay, like in the samples of the DL models.
+        """
+        group = self.vars["GROUP"]
+        if len(self.outcome_df) == self.num_stays:
+            lengths = self.features_df.groupby(level=group, sort=False).size()
+            return lengths.reindex(self.outcome_df.index).to_numpy() - 1
+        return self.outcome_df.groupby(level=group, sort=False).cumcount().to_numpy()
+
     def to_tensor(self):
         data, labels = self.get_data_and_labels()
         if self.mps:
@@ -198,6 +315,10 @@ class ImputationDataset(CommonDataset):
         self.features_df.fillna(0, inplace=True)
         self.ram_cache(ram_cache)
 
+    def get_input_shape(self, batch_size: int) -> Size:
+        """Returns the shape of a batch of input data. Windows are not padded, so the shape of the first sample is used."""
+        return Size([batch_size, *self[0][0].shape])
+
     def __getitem__(self, idx: int) -> Tuple[Tensor, Tensor, Tensor]:
         """Function to sample from the data split of choice.
 
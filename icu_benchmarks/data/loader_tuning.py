@@ -0,0 +1,129 @@
+import json
+import logging
+import math
+import time
+from itertools import islice
+from pathlib import Path
+from typing import Callable
+
+import gin
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from icu_benchmarks.thread_budget import thread_budget
+
+# Chosen settings per dataset type, sample shape, batch size and model, reused for further folds and tuning iterations.
+_tuned_settings = {}
+
+
+@gin.configurable("dataloader_autotuning")
+def autotune_dataloader(
+    dataset: Dataset,
+    batch_size: int,
+    step_fn: Callable = None,
+    pin_memory: bool = False,
+    name: str = "",
+    log_dir: Path = None,
+    max_workers: int = None,
+    num_batches: int = 8,
+    tolerance: float = 0.1,
+    max_prefetch_factor: int = 8,
+) -> dict:
+    """Chooses the DataLoader settings by measuring the loading throughput against the time of a training step.
+
+    Loading on the main thread is kept if it costs at most a small fraction of a training step. Otherwise, the number of
+    workers is increased until the loader delivers batches faster than the model consumes them, or until more workers stop
+    improving the throughput.
+
+    Args:
+        dataset: Dataset to load.
+        batch_size: Batch size used for training.
+        step_fn: Function that performs a training step on a batch. If None, the loading throughput is maximized.
+        pin_memory: Whether memory is pinned, which only helps if the model is trained on a GPU.
+        name: Name of the model, settings are reused for the same model and data shape.
+        log_dir: If set, the chosen settings are written to this directory.
+        max_workers: Maximum number of workers to try, by default one less than the thread budget and at most 16.
+        num_batches: Number of batches to measure for each setting.
+        tolerance: Fraction of the step time that loading on the main thread may take.
+        max_prefetch_factor: Maximum number of batches each worker loads in advance.
+
+    Returns:
+        Keyword arguments for the DataLoader.
+    """
+    if max_workers is None:
+        max_workers = max(1, min(thread_budget() - 1, 16))
+    key = (type(dataset).__name__, tuple(dataset[0][0].shape), batch_size, pin_memory, name)
+    if key not in _tuned_settings:
+        _tuned_settings[key] = choose_dataloader_settings(
+            dataset, batch_size, step_fn, pin_memory, max_workers, num_batches, tolerance, max_prefetch_factor
+        )
+    settings = _tuned_settings[key]
+    logging.info(f"Data loading settings: {settings}.")
+    if log_dir is not None:
+        with open(Path(log_dir) / "dataloader_settings.json", "w") as f:
+            json.dump(settings, f, indent=4)
+    return dict(settings)
+
+
+def choose_dataloader_settings(
+    dataset, batch_size, step_fn, pin_memory, max_workers, num_batches, tolerance, max_prefetch_factor
+) -> dict:
+    """Measures the candidate settings, see autotune_dataloader."""
+    settings = {"num_workers": 0, "persistent_workers": False, "prefetch_factor": None, "pin_memory": pin_memory}
+    main_thread_time = measure_batch_time(dataset, batch_size, num_batches, **settings)
+    step_time = measure_step_time(dataset, batch_size, step_fn) if step_fn is not None else 0.0
+    logging.debug(f"Loading takes {main_thread_time:.4f}s per batch on the main thread, a training step {step_time:.4f}s.")
+    if main_thread_time <= tolerance * step_time:
+        return settings
+
+    # On the main thread, loading and training alternate. Workers load while the model trains, so the slower one dominates.
+    best_workers, best_time, best_cost = 0, main_thread_time, main_thread_time + step_time
+    num_workers = 1
+    while num_workers <= max_workers:
+        batch_time = measure_batch_time(dataset, batch_size, num_batches, num_workers=num_workers, pin_memory=pin_memory)
+        logging.debug(f"Loading takes {batch_time:.4f}s per batch with {num_workers} workers.")
+        cost = max(batch_time, step_time)
+        if cost >= (1 - tolerance) * best_cost:
+            # More workers do not help anymore, e.g. because of inter-process overhead.
+            break
+        best_workers, best_time, best_cost = num_workers, batch_time, cost
+        if batch_time <= step_time:
+            break
+        num_workers *= 2
+
+    if best_workers > 0:
+        # Each worker should have enough batches queued to cover the steps taken while it loads its next batch.
+        batches_per_load = best_time * best_workers / step_time if step_time > 0 else 2
+        settings.update(
+            num_workers=best_workers,
+            persistent_workers=True,
+            prefetch_factor=min(max(2, math.ceil(batches_per_load)), max_prefetch_factor),
+        )
+    return settings
+
+
+def measure_batch_time(dataset: Dataset, batch_size: int, num_batches: int, **loader_kwargs) -> float:
+    """Returns the average time it takes to load a batch, excluding the start-up of the workers."""
+    # A separate generator keeps the global random state, and with it the training, unaffected by the measurement.
+    loader = DataLoader(dataset, batch_size=batch_size, drop_last=True, generator=torch.Generator(), **loader_kwargs)
+    iterator = iter(loader)
+    next(iterator)
+    start = time.perf_counter()
+    loaded = sum(1 for _ in islice(iterator, num_batches))
+    elapsed = time.perf_counter() - start
+    del iterator
+    return elapsed / loaded if loaded else 0.0
+
+
+def measure_step_time(dataset: Dataset, batch_size: int, step_fn: Callable, repetitions: int = 3) -> float:
+    """Returns the average time of a training step, or 0 if the step cannot be performed outside the trainer."""
+    batch = next(iter(DataLoader(dataset, batch_size=batch_size, generator=torch.Generator())))
+    try:
+        step_fn(batch)  # Warm-up
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            step_fn(batch)
+        return (time.perf_counter() - start) / repetitions
+    except Exception as e:
+        logging.debug(f"Could not measure the training step time: {e}")
+        return 0.0
@@ -26,8 +26,14 @@ from icu_benchmarks.data.loader import ImputationPredictionDataset
 from .constants import DataSplit as Split, DataSegment as Segment
 import abc
 
+# Suffixes of the historical features that are generated from the dynamic data for ML models.
+GENERATED_FEATURE_SUFFIXES = ("min_hist", "max_hist", "count_hist", "mean_hist")
+
 
 class Preprocessor:
+    # Fitted recipes per data segment, e.g. to describe the preprocessing of exported models.
+    recipes = None
+
     @abc.abstractmethod
     def apply(self, data, vars, save_cache=False, load_cache=None):
         return data
@@ -41,6 +47,10 @@ class Preprocessor:
         if self.imputation_model is not None:
             update_wandb_config({"imputation_model": self.imputation_model.__class__.__name__})
 
+    def recipe_metadata(self) -> dict:
+        """Returns a JSON-serializable description of the fitted recipes, see describe_recipe."""
+        return {segment: describe_recipe(recipe) for segment, recipe in (self.recipes or {}).items()}
+
 
 @gin.configurable("base_classification_preprocessor")
 class DefaultClassificationPreprocessor(Preprocessor):
@@ -68,6 +78,7 @@ class DefaultClassificationPreprocessor(Preprocessor):
         self.imputation_model = None
         self.save_cache = save_cache
         self.load_cache = load_cache
+        self.recipes = {}
 
     def apply(self, data, vars) -> dict[dict[pd.DataFrame]]:
         """
@@ -121,6 +132,7 @@ class DefaultClassificationPreprocessor(Preprocessor):
         sta_rec.add_step(StepSklearn(LabelEncoder(), sel=has_type("object"), columnwise=True))
 
         data = apply_recipe_to_splits(sta_rec, data, Segment.static, self.save_cache, self.load_cache)
+        self.recipes[Segment.static] = sta_rec
 
         return data
 
@@ -151,6 +163,7 @@ class DefaultClassificationPreprocessor(Preprocessor):
         if self.generate_features:
             dyn_rec = self._dynamic_feature_generation(dyn_rec, all_of(vars[Segment.dynamic]))
         data = apply_recipe_to_splits(dyn_rec, data, Segment.dynamic, self.save_cache, self.load_cache)
+        self.recipes[Segment.dynamic] = dyn_rec
         return data
 
     def _dynamic_feature_generation(self, data, dynamic_vars):
@@ -344,3 +357,34 @@ def restore_recipe(cache_file: str) -> Recipe:
             return recipe
     else:
         raise FileNotFoundError(f"Cache file {cache_file} not found.")
+
+
+def describe_recipe(recipe: Recipe) -> dict:
+    """Describes the steps of a fitted recipe and the parameters they learned from the training data.
+
+    Args:
+        recipe: Prepped recipe.
+
+    Returns:
+        The roles of the input columns and, for each step, its description, selected columns and the fitted attributes of
+        its scikit-learn transformer (e.g. the means and scales of StepScale).
+    """
+    steps = []
+    for step in recipe.steps:
+        description = {"step": step.__class__.__name__, "description": step.desc, "columns": list(step.columns)}
+        if isinstance(step, StepSklearn):
+            if step.columnwise and hasattr(step, "_transformers"):
+                description["fitted"] = {col: fitted_attributes(t) for col, t in step._transformers.items()}
+            else:
+                description["fitted"] = fitted_attributes(step.sklearn_transformer)
+        steps.append(description)
+    return {"roles": {column: list(roles) for column, roles in recipe.roles.items()}, "steps": steps}
+
+
+def fitted_attributes(transformer) -> dict:
+    """Returns the attributes of a fitted scikit-learn transformer, which end with an underscore by convention."""
+    return {
+        name: value.tolist() if hasattr(value, "tolist") else value
+        for name, value in vars(transformer).items()
+        if name.endswith("_") and not name.startswith("_")
+    }
@@ -10,8 +10,9 @@ import pickle
 
 from sklearn.model_selection import StratifiedKFold, KFold, StratifiedShuffleSplit, ShuffleSplit
 
-from icu_benchmarks.data.preprocessor import Preprocessor, DefaultClassificationPreprocessor
+from icu_benchmarks.data.preprocessor import Preprocessor, DefaultClassificationPreprocessor, GENERATED_FEATURE_SUFFIXES
 from icu_benchmarks.contants import RunMode
+from icu_benchmarks.thread_budget import apply_thread_budget, thread_budget
 from .constants import DataSplit as Split, DataSegment as Segment, VarType as Var
 
 
@@ -34,6 +35,7 @@ def preprocess_data(
     pretrained_imputation_model: str = None,
     complete_train: bool = False,
     runmode: RunMode = RunMode.classification,
+    recipe_dirs: list[Path] = None,
 ) -> dict[dict[pd.DataFrame]]:
     """Perform loading, splitting, imputing and normalising of task data.
 
@@ -55,11 +57,15 @@ def preprocess_data(
         generate_cache: Generate cached preprocessed data if true.
         fold_index: Index of the fold to return.
         pretrained_imputation_model: pretrained imputation model to use. if None, standard imputation is used.
+        recipe_dirs: Directories to write a description of the fitted recipes to (recipes.json), e.g. to export the models
+            trained on this fold together with their preprocessing.
 
     Returns:
         Preprocessed data as DataFrame in a hierarchical dict with features type (STATIC) / DYNAMIC/ OUTCOME
             nested within split (train/val/test).
     """
+    # The recipes compute with pandas and scikit-learn, whose BLAS threads are limited to the budget of the job.
+    apply_thread_budget(thread_budget())
 
     cache_dir = data_dir / "cache"
 
@@ -81,11 +87,19 @@ def preprocess_data(
     cache_filename += f"_{hash_config.hexdigest()}"
     cache_file = cache_dir / cache_filename
 
+    recipes_file = cache_file.with_name(cache_file.name + "_recipes.json")
+
     if load_cache:
         if cache_file.exists():
             with open(cache_file, "rb") as f:
                 logging.info(f"Loading cached data from {cache_file}.")
-                return pickle.load(f)
+                data = pickle.load(f)
+            if recipes_file.exists():
+                with open(recipes_file) as f:
+                    write_recipes(recipe_dirs, json.load(f))
+            elif recipe_dirs:
+                logging.warning(f"No recipes cached with {cache_file}, the recipes.json of the run is not written.")
+            return data
         else:
             logging.info(f"No cached data found in {cache_file}, loading raw features.")
 
@@ -113,10 +127,12 @@ def preprocess_data(
 
     # Apply preprocessing
     data = preprocessor.apply(data, vars)
+    recipes = preprocessor.recipe_metadata()
+    write_recipes(recipe_dirs, recipes)
 
     # Generate cache
     if generate_cache:
-        caching(cache_dir, cache_file, data, load_cache)
+        caching(cache_dir, cache_file, data, load_cache, recipes=recipes, recipes_file=recipes_file)
     else:
         logging.info("Cache will not be saved.")
 
@@ -125,6 +141,33 @@ def preprocess_data(
     return data
 
 
+def write_recipes(recipe_dirs: list[Path], recipes: dict):
+    """Writes the description of the fitted recipes to the recipes.json of each directory, see describe_recipe."""
+    for recipe_dir in recipe_dirs or []:
+        with open(Path(recipe_dir) / "recipes.json", "w") as f:
+            json.dump(recipes, f, indent=4, default=str)
+
+
+def drop_generated_features(data: dict[dict[pd.DataFrame]]) -> dict[dict[pd.DataFrame]]:
+    """Removes the generated historical features, e.g. to train DL models on data that was preprocessed for ML models.
+
+    The generated features are appended to the other features, so the remaining data equals the data preprocessed without
+    feature generation.
+
+    Args:
+        data: Preprocessed data as returned by preprocess_data.
+
+    Returns:
+        Copy of the data without the generated features.
+    """
+    data = {split: dict(segments) for split, segments in data.items()}
+    for segments in data.values():
+        features = segments[Segment.features]
+        generated = [column for column in features.columns if str(column).endswith(GENERATED_FEATURE_SUFFIXES)]
+        segments[Segment.features] = features.drop(columns=generated)
+    return data
+
+
 def make_train_val(
     data: dict[pd.DataFrame],
     vars: dict[str],
@@ -267,11 +310,15 @@ def make_single_split(
     return data_split
 
 
-def caching(cache_dir, cache_file, data, use_cache, overwrite=True):
+def caching(cache_dir, cache_file, data, use_cache, overwrite=True, recipes=None, recipes_file=None):
     if use_cache and (not overwrite or not cache_file.exists()):
         if not cache_dir.exists():
             cache_dir.mkdir()
         cache_file.touch()
         with open(cache_file, "wb") as f:
             pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        if recipes_file is not None:
+            # Runs that load the cached data write the description of its recipes like runs that fit them.
+            with open(recipes_file, "w") as f:
+                json.dump(recipes, f, indent=4, default=str)
         logging.info(f"Cached data in {cache_file}.")
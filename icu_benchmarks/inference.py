@@ -0,0 +1,70 @@
+"""Lightweight inference with models exported by icu_benchmarks.models.export.
+
+Only needs numpy and torch (TorchScript exports) or onnxruntime (ONNX exports), not the training stack.
+"""
+import json
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+
+
+class InferenceRunner:
+    """Scores batches with an exported model.
+
+    Args:
+        export_dir: Directory of the exported model and its export_metadata.json.
+        num_threads: Number of threads for inference, by default chosen by the runtime.
+    """
+
+    def __init__(self, export_dir: Path, num_threads: int = None):
+        export_dir = Path(export_dir)
+        with open(export_dir / "export_metadata.json") as f:
+            self.metadata = json.load(f)
+        path = export_dir / self.metadata["file"]
+        if self.metadata["format"] == "onnx":
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+            self._predict = lambda batch: session.run(None, {"features": batch})[0]
+        else:
+            import torch
+
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            module = torch.jit.load(str(path), map_location="cpu").eval()
+
+            def predict(batch):
+                with torch.inference_mode():
+                    return module(torch.from_numpy(batch)).numpy()
+
+            self._predict = predict
+
+    @property
+    def trained_columns(self) -> list[str]:
+        """Names of the features, in the order of the last input dimension."""
+        return self.metadata["trained_columns"]
+
+    def predict(self, features: np.ndarray) -> np.ndarray:
+        """Scores a batch of preprocessed features.
+
+        Args:
+            features: Array of shape (batch, time steps, features), with the features ordered like trained_columns.
+
+        Returns:
+            The class probabilities of classifiers, or the predicted values of regression models, per time step.
+        """
+        features = np.asarray(features, dtype=np.float32)
+        if features.ndim == 2:
+            features = features[np.newaxis]
+        if features.shape[-1] != self.metadata["input_shape"][-1]:
+            raise ValueError(f"Expected {self.metadata['input_shape'][-1]} features, got {features.shape[-1]}.")
+        return self._predict(np.ascontiguousarray(features))
+
+    def predict_batches(self, batches: Iterable[np.ndarray]) -> Iterator[np.ndarray]:
+        """Scores a stream of batches, see predict."""
+        for batch in batches:
+            yield self.predict(batch)
@@ -0,0 +1,93 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import gin
+import numpy as np
+
+
+@gin.configurable("bootstrap")
+def bootstrap_intervals(
+    label: np.ndarray,
+    pred: np.ndarray,
+    groups: np.ndarray = None,
+    num_samples: int = 1000,
+    confidence: float = 0.95,
+    max_chunk_elements: int = 2**21,
+    num_threads: int = 1,
+    seed: int = 42,
+) -> dict:
+    """Computes bootstrap confidence intervals of the AUROC and AUPRC of binary test predictions.
+
+    Stays are resampled with replacement, together with all of their predictions. The predictions are sorted once, and each
+    resample is represented by the number of times each stay is drawn. The metrics of a chunk of resamples are computed at
+    once from weighted cumulative sums over the sorted predictions.
+
+    Args:
+        label: Binary labels.
+        pred: Predicted probabilities of the positive class.
+        groups: Stay of each prediction. By default, each prediction is resampled on its own.
+        num_samples: Number of bootstrap resamples.
+        confidence: Confidence level of the percentile intervals.
+        max_chunk_elements: Maximum number of resamples times predictions that are computed at once, which bounds memory.
+        num_threads: Number of threads that compute chunks in parallel.
+        seed: Random seed of the resampling, the intervals do not depend on the number of threads.
+
+    Returns:
+        The confidence level, the number of resamples and the lower and upper bounds of the AUC and PR.
+    """
+    label, pred = np.ravel(label), np.ravel(pred)
+    order = np.argsort(pred, kind="mergesort")[::-1]
+    pred, label = pred[order], label[order] == 1
+    groups = np.unique(groups, return_inverse=True)[1].ravel()[order] if groups is not None else order
+    num_groups = int(groups.max()) + 1
+    threshold_idxs = np.r_[np.where(np.diff(pred))[0], len(pred) - 1]
+
+    chunk_size = max(1, max_chunk_elements // max(len(pred), num_groups))
+    sizes = [min(chunk_size, num_samples - start) for start in range(0, num_samples, chunk_size)]
+    # Each chunk draws from its own stream, so the resamples are the same for any number of threads.
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    def resample_chunk(size, seed_sequence):
+        rng = np.random.default_rng(seed_sequence)
+        indices = rng.integers(0, num_groups, size=(size, num_groups)) + np.arange(size)[:, np.newaxis] * num_groups
+        group_weights = np.bincount(indices.ravel(), minlength=size * num_groups).reshape(size, num_groups)
+        return weighted_ranking_metrics(group_weights[:, groups], label, threshold_idxs)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        results = list(executor.map(resample_chunk, sizes, seeds))
+    alpha = (1 - confidence) / 2
+    intervals = {"confidence": confidence, "num_samples": num_samples}
+    for name, values in zip(["AUC", "PR"], zip(*results)):
+        values = np.concatenate(values)
+        if np.isnan(values).all():
+            logging.warning(f"No bootstrap resample contains both classes, cannot compute the interval of {name}.")
+            continue
+        intervals[name] = np.nanquantile(values, [alpha, 1 - alpha]).tolist()
+    return intervals
+
+
+def weighted_ranking_metrics(weights: np.ndarray, label: np.ndarray, threshold_idxs: np.ndarray):
+    """Computes the AUROC and average precision of each row of sample weights.
+
+    Args:
+        weights: Weights of the predictions with shape (resamples, predictions), in the order of decreasing predictions.
+        label: Whether each prediction belongs to the positive class, in the same order.
+        threshold_idxs: Index of the last prediction of each distinct predicted value.
+
+    Returns:
+        The AUROC and average precision of each resample, NaN for resamples without both classes.
+    """
+    tps = np.cumsum(weights * label, axis=1)[:, threshold_idxs]
+    fps = np.cumsum(weights * ~label, axis=1)[:, threshold_idxs]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        tpr = tps / tps[:, -1:]
+        fpr = fps / fps[:, -1:]
+        zeros = np.zeros((len(weights), 1))
+        auc = np.trapz(np.hstack([zeros, tpr]), np.hstack([zeros, fpr]), axis=1)
+        predicted_positives = tps + fps
+        precision = np.where(predicted_positives > 0, tps / predicted_positives, 0.0)
+        average_precision = np.sum(np.diff(tpr, axis=1, prepend=0) * precision, axis=1)
+    undefined = (tps[:, -1] == 0) | (fps[:, -1] == 0)
+    auc[undefined] = np.nan
+    average_precision[undefined] = np.nan
+    return auc, average_precision
@@ -0,0 +1,94 @@
+import logging
+import time
+from typing import Any, Dict
+
+import numpy as np
+import torch
+from pytorch_lightning import Callback, LightningModule, Trainer
+from torch.utils.data import DataLoader
+
+from icu_benchmarks.thread_budget import apply_thread_budget
+
+
+class FullValidation(Callback):
+    """Validates on the full validation set whenever the loss on the validation subsample improves.
+
+    Early stopping keeps monitoring the loss on the fixed validation subsample, which is available after every validation
+    run. The full validation loss is only computed for models that improved on the subsample and logged as val_full/loss.
+
+    Args:
+        val_loader: DataLoader of the full validation set.
+        monitor: Metric of the validation subsample to monitor.
+        min_delta: Minimum change of the monitored metric to count as an improvement.
+    """
+
+    def __init__(self, val_loader: DataLoader, monitor: str = "val/loss", min_delta: float = 0.0):
+        self.val_loader = val_loader
+        self.monitor = monitor
+        self.min_delta = min_delta
+        self.best = np.inf
+
+    def on_validation_end(self, trainer: Trainer, pl_module: LightningModule):
+        current = trainer.callback_metrics.get(self.monitor)
+        if trainer.sanity_checking or current is None or not current < self.best - self.min_delta:
+            return
+        self.best = float(current)
+        loss = self.validate(pl_module)
+        logging.info(f"Validation subsample improved to {self.best:.4f}, full validation loss: {loss:.4f}.")
+        trainer.callback_metrics["val_full/loss"] = torch.tensor(loss)
+        for logger in trainer.loggers:
+            logger.log_metrics({"val_full/loss": loss}, step=trainer.global_step)
+
+    def validate(self, pl_module: LightningModule) -> float:
+        """Returns the loss on the full validation set, weighted by the batch sizes like the logged validation loss."""
+        was_training = pl_module.training
+        pl_module.eval()
+        total_loss, total_samples = 0.0, 0
+        with torch.no_grad():
+            for batch in self.val_loader:
+                batch_size = len(batch[0])
+                total_loss += pl_module.compute_loss(batch)[0].item() * batch_size
+                total_samples += batch_size
+        pl_module.train(was_training)
+        return total_loss / max(total_samples, 1)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"best": self.best}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        self.best = state_dict["best"]
+
+
+class Throughput(Callback):
+    """Logs the number of training steps per second of each epoch as train/steps_per_sec, e.g. to benchmark compilation."""
+
+    def __init__(self):
+        self.start = self.end = None
+        self.steps = 0
+
+    def on_train_epoch_start(self, trainer: Trainer, pl_module: LightningModule):
+        self.start, self.steps = time.perf_counter(), 0
+
+    def on_train_batch_end(self, trainer: Trainer, pl_module: LightningModule, outputs, batch, batch_idx: int):
+        self.end = time.perf_counter()
+        self.steps += 1
+
+    def on_train_epoch_end(self, trainer: Trainer, pl_module: LightningModule):
+        # The validation of the epoch runs before this hook, so the time is taken after the last training step.
+        if self.steps and self.end > self.start:
+            pl_module.log("train/steps_per_sec", self.steps / (self.end - self.start), sync_dist=True)
+
+
+class ThreadBudget(Callback):
+    """Sets the number of threads of each training process, e.g. to share the cores among data-parallel processes.
+
+    Args:
+        num_threads: Number of threads of each process.
+    """
+
+    def __init__(self, num_threads: int):
+        self.num_threads = num_threads
+
+    def setup(self, trainer: Trainer, pl_module: LightningModule, stage: str):
+        apply_thread_budget(self.num_threads)
+        logging.debug(f"Process {trainer.global_rank} uses {self.num_threads} threads.")
@@ -0,0 +1,95 @@
+import functools
+import logging
+import os
+from pathlib import Path
+
+import gin
+import torch
+import torch._dynamo
+from pytorch_lightning import LightningModule
+from pytorch_lightning.utilities.compile import from_compiled, to_uncompiled
+
+# Lightning hooks through which the compiled model is run in training, validation, testing and prediction.
+STEP_METHODS = ("training_step", "validation_step", "test_step", "predict_step")
+
+# Reasons why compilation failed, per model class, input shape and mode. These are not compiled again, e.g. in later folds.
+_compile_failures = {}
+
+
+@gin.configurable("compile_model")
+def compile_model(
+    model: LightningModule,
+    input_shape: torch.Size,
+    mode: str = "default",
+    device: torch.device = torch.device("cpu"),
+    cache_dir: Path = None,
+) -> LightningModule:
+    """Compiles the forward pass of a model with torch.compile, or returns it unchanged if compilation fails.
+
+    The model is compiled and trained for one step on a dummy batch right away, so that unsupported models fall back to
+    eager execution before training starts. Errors that only occur later, e.g. for the larger test batches, make dynamo
+    run the affected code eagerly instead of failing. This only applies to the steps of the compiled model, other models
+    compiled in the same process still raise their errors. The compiled kernels are cached on disk by the inductor backend,
+    so models of later folds with the same architecture and input shape reuse them.
+
+    Args:
+        model: Model to compile.
+        input_shape: Shape of the input batches.
+        mode: Compilation mode of torch.compile, e.g. "default", "reduce-overhead" or "max-autotune".
+        device: Device the model is trained on.
+        cache_dir: Directory of the compiled kernels, by default the temporary directory of the inductor backend.
+
+    Returns:
+        The compiled model, or the original model if compilation failed.
+    """
+    key = (type(model).__name__, tuple(input_shape), mode)
+    if key in _compile_failures:
+        logging.info(f"Not compiling {type(model).__name__}, compilation failed before: {_compile_failures[key]}")
+        return model
+    if cache_dir is not None:
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = str(cache_dir)
+    # Compiled code of earlier models is guarded on their identity and would only count towards the recompilation limit.
+    torch._dynamo.reset()
+    try:
+        compiled = from_compiled(torch.compile(model, mode=mode))
+        warm_up(compiled, input_shape, device)
+    except Exception as e:
+        _compile_failures[key] = str(e).strip().split("\n")[0]
+        logging.warning(f"Compiling {type(model).__name__} failed, training without compilation: {_compile_failures[key]}")
+        return uncompiled(model)
+    for name in STEP_METHODS:
+        setattr(compiled, name, suppress_errors(getattr(compiled, name)))
+    logging.info(f"Compiled {type(model).__name__} with mode {mode}.")
+    return compiled
+
+
+def uncompiled(model: LightningModule) -> LightningModule:
+    """Returns a model without its compilation, or the model itself if it is not compiled.
+
+    The forward pass and the steps of a compiled model are restored in place, see to_uncompiled.
+    """
+    try:
+        return to_uncompiled(model)
+    except ValueError:
+        return model
+
+
+def warm_up(model: LightningModule, input_shape: torch.Size, device: torch.device):
+    """Performs a forward and backward pass on a dummy batch, without changing the model or the random state."""
+    model.to(device)
+    with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+        out = model(torch.zeros(input_shape, device=device))
+        out = out[0] if isinstance(out, tuple) else out
+        out.float().sum().backward()
+    model.zero_grad(set_to_none=True)
+
+
+def suppress_errors(step):
+    """Wraps a compiled step so that dynamo runs the code it fails to compile eagerly, only for the duration of the step."""
+
+    @functools.wraps(step)
+    def wrapped(*args, **kwargs):
+        with torch._dynamo.config.patch(suppress_errors=True):
+            return step(*args, **kwargs)
+
+    return wrapped
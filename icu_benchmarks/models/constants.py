@@ -1,4 +1,3 @@
-from ignite.contrib.metrics import AveragePrecision, ROC_AUC, RocCurve, PrecisionRecallCurve
 from ignite.metrics import Accuracy, RootMeanSquaredError
 from sklearn.calibration import calibration_curve
 from sklearn.metrics import (
@@ -21,6 +20,10 @@ from torchmetrics.classification import (
 )
 from enum import Enum
 from icu_benchmarks.models.custom_metrics import (
+    BinnedAveragePrecision,
+    BinnedPrecisionRecallCurve,
+    BinnedROC_AUC,
+    BinnedRocCurve,
     CalibrationCurve,
     BalancedAccuracy,
     MAE,
@@ -55,11 +58,11 @@ class MLMetrics:
 # TODO: add support for confusion matrix
 class DLMetrics:
     BINARY_CLASSIFICATION = {
-        "AUC": ROC_AUC,
+        "AUC": BinnedROC_AUC,
         "Calibration_Curve": CalibrationCurve,
-        "PR": AveragePrecision,
-        "PR_Curve": PrecisionRecallCurve,
-        "RO_Curve": RocCurve,
+        "PR": BinnedAveragePrecision,
+        "PR_Curve": BinnedPrecisionRecallCurve,
+        "RO_Curve": BinnedRocCurve,
     }
 
     BINARY_CLASSIFICATION_TORCHMETRICS = {
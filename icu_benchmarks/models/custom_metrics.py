@@ -1,9 +1,9 @@
 import torch
 from typing import Callable
 import numpy as np
-from ignite.metrics import EpochMetric
-from sklearn.metrics import balanced_accuracy_score, mean_absolute_error
-from sklearn.calibration import calibration_curve
+from ignite.exceptions import NotComputableError
+from ignite.metrics import EpochMetric, Metric
+from ignite.metrics.metric import reinit__is_reduced, sync_all_reduce
 from scipy.spatial.distance import jensenshannon
 from torchmetrics.classification import BinaryFairness
 
@@ -29,47 +29,200 @@ def accuracy(output, target, topk=(1,)):
         return res
 
 
-class BalancedAccuracy(EpochMetric):
-    def __init__(self, output_transform: Callable = lambda x: x, check_compute_fn: bool = False) -> None:
-        super(BalancedAccuracy, self).__init__(
-            self.balanced_accuracy_compute, output_transform=output_transform, check_compute_fn=check_compute_fn
-        )
+# Number of bins of the predicted probabilities in the binned ranking metrics, which resolve scores up to 1e-4.
+NUM_SCORE_BINS = 10_000
 
-        def balanced_accuracy_compute(y_preds: torch.Tensor, y_targets: torch.Tensor) -> float:
-            y_true = y_targets.numpy()
-            y_pred = np.argmax(y_preds.numpy(), axis=-1)
-            return balanced_accuracy_score(y_true, y_pred)
 
+class BinnedBinaryMetric(Metric):
+    """Base class of binary classification metrics that are computed from histograms of the predicted probabilities.
 
-class CalibrationCurve(EpochMetric):
-    def __init__(self, output_transform: Callable = lambda x: x, check_compute_fn: bool = False) -> None:
-        super(CalibrationCurve, self).__init__(
-            self.ece_curve_compute_fn, output_transform=output_transform, check_compute_fn=check_compute_fn
-        )
+    The positive and negative samples are counted in equally wide probability bins on the device of the predictions, so
+    memory does not grow with the number of predictions. Metrics that depend on the ranking of the predictions treat
+    predictions in the same bin as ties, which is exact up to the bin width. The counts are summed across processes.
 
-        def ece_curve_compute_fn(y_preds: torch.Tensor, y_targets: torch.Tensor, n_bins=10) -> float:
-            y_true = y_targets.numpy()
-            y_pred = y_preds.numpy()
-            return calibration_curve(y_true, y_pred, n_bins=n_bins)
+    Args:
+        output_transform: Transforms the output of the model into the probabilities of the positive class and the targets.
+        device: Device of the counts before the first update, which moves them to the device of the predictions.
+        num_bins: Number of probability bins.
+    """
 
+    def __init__(self, output_transform: Callable = lambda x: x, device="cpu", num_bins: int = NUM_SCORE_BINS) -> None:
+        self.num_bins = num_bins
+        super().__init__(output_transform=output_transform, device=device)
 
-class MAE(EpochMetric):
-    def __init__(
-        self,
-        output_transform: Callable = lambda x: x,
-        check_compute_fn: bool = False,
-        invert_transform: Callable = lambda x: x,
-    ) -> None:
-        super(MAE, self).__init__(
-            lambda x, y: mae_with_invert_compute_fn(x, y, invert_transform),
-            output_transform=output_transform,
-            check_compute_fn=check_compute_fn,
+    @reinit__is_reduced
+    def reset(self) -> None:
+        # Counts of the negative (column 0) and positive (column 1) samples per bin.
+        self._counts = torch.zeros(self.num_bins, 2, dtype=torch.long, device=self._device)
+
+    @reinit__is_reduced
+    def update(self, output) -> None:
+        y_pred, y = output[0].detach().reshape(-1), output[1].detach().reshape(-1)
+        self._counts = self._counts.to(y_pred.device)
+        bins = (y_pred.float() * self.num_bins).long().clamp_(0, self.num_bins - 1)
+        self._counts += torch.bincount(bins * 2 + (y == 1).long(), minlength=2 * self.num_bins).view(self.num_bins, 2)
+
+    @sync_all_reduce("_counts")
+    def cumulative_counts(self) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Returns the true and false positives above each threshold, from the highest to the lowest, and the thresholds.
+
+        Only thresholds at the lower edges of non-empty bins are kept, like the distinct scores of the exact curves.
+        """
+        counts = self._counts.flip(0).double()
+        if counts[:, 1].sum() == 0 or counts[:, 0].sum() == 0:
+            raise NotComputableError(f"{type(self).__name__} needs positive and negative samples.")
+        non_empty = counts.sum(dim=1) > 0
+        thresholds = torch.arange(self.num_bins - 1, -1, -1, device=counts.device, dtype=torch.float64) / self.num_bins
+        tps, fps = counts[:, 1].cumsum(0), counts[:, 0].cumsum(0)
+        return tps[non_empty], fps[non_empty], thresholds[non_empty]
+
+
+class BinnedROC_AUC(BinnedBinaryMetric):
+    """Area under the ROC curve, computed from binned probabilities (see BinnedBinaryMetric)."""
+
+    def compute(self) -> float:
+        fpr, tpr, _ = binned_roc_curve(*self.cumulative_counts())
+        return torch.trapezoid(tpr, fpr).item()
+
+
+class BinnedRocCurve(BinnedBinaryMetric):
+    """ROC curve at the bin edges, as false positive rates, true positive rates and thresholds (see BinnedBinaryMetric)."""
+
+    def compute(self) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        return binned_roc_curve(*self.cumulative_counts())
+
+
+class BinnedAveragePrecision(BinnedBinaryMetric):
+    """Average precision, computed from binned probabilities like average_precision_score (see BinnedBinaryMetric)."""
+
+    def compute(self) -> float:
+        precision, recall, _ = binned_precision_recall_curve(*self.cumulative_counts())
+        return -torch.sum(torch.diff(recall) * precision[:-1]).item()
+
+
+class BinnedPrecisionRecallCurve(BinnedBinaryMetric):
+    """Precision-recall curve at the bin edges, in the order of precision_recall_curve (see BinnedBinaryMetric)."""
+
+    def compute(self) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        return binned_precision_recall_curve(*self.cumulative_counts())
+
+
+def binned_roc_curve(tps: torch.Tensor, fps: torch.Tensor, thresholds: torch.Tensor):
+    """Returns the false positive rates, true positive rates and thresholds, starting at the point (0, 0)."""
+    zero = tps.new_zeros(1)
+    fpr = torch.cat([zero, fps / fps[-1]])
+    tpr = torch.cat([zero, tps / tps[-1]])
+    return fpr, tpr, torch.cat([thresholds.new_full((1,), float("inf")), thresholds])
+
+
+def binned_precision_recall_curve(tps: torch.Tensor, fps: torch.Tensor, thresholds: torch.Tensor):
+    """Returns the precisions, recalls and thresholds for increasing thresholds, ending at precision 1 and recall 0."""
+    precision = tps / (tps + fps)
+    recall = tps / tps[-1]
+    one, zero = tps.new_ones(1), tps.new_zeros(1)
+    return torch.cat([precision.flip(0), one]), torch.cat([recall.flip(0), zero]), thresholds.flip(0)
+
+
+class BalancedAccuracy(Metric):
+    """Balanced accuracy of multiclass predictions, computed from a confusion matrix that is updated with each batch."""
+
+    @reinit__is_reduced
+    def reset(self) -> None:
+        self._confusion_matrix = None
+
+    @reinit__is_reduced
+    def update(self, output) -> None:
+        y_pred, y = output[0].detach(), output[1].detach().reshape(-1).long()
+        num_classes = y_pred.shape[-1]
+        if self._confusion_matrix is None:
+            self._confusion_matrix = torch.zeros(num_classes, num_classes, dtype=torch.long, device=y_pred.device)
+        predicted = y_pred.reshape(-1, num_classes).argmax(dim=-1)
+        self._confusion_matrix += torch.bincount(y * num_classes + predicted, minlength=num_classes**2).view(
+            num_classes, num_classes
         )
 
-        def mae_with_invert_compute_fn(y_preds: torch.Tensor, y_targets: torch.Tensor, invert_fn=Callable) -> float:
-            y_true = invert_fn(y_targets.numpy().reshape(-1, 1))[:, 0]
-            y_pred = invert_fn(y_preds.numpy().reshape(-1, 1))[:, 0]
-            return mean_absolute_error(y_true, y_pred)
+    @sync_all_reduce("_confusion_matrix")
+    def compute(self) -> float:
+        if self._confusion_matrix is None:
+            raise NotComputableError("BalancedAccuracy must have at least one example before it can be computed.")
+        # Like balanced_accuracy_score, the recall is averaged over the classes that occur in the targets.
+        support = self._confusion_matrix.sum(dim=1)
+        recall = self._confusion_matrix.diagonal()[support > 0].double() / support[support > 0]
+        return recall.mean().item()
+
+
+class CalibrationCurve(Metric):
+    """Calibration curve with uniform bins like calibration_curve, updated with each batch.
+
+    Args:
+        output_transform: Transforms the output of the model into the probabilities of the positive class and the targets.
+        device: Device of the bin statistics before the first update, which moves them to the device of the predictions.
+        n_bins: Number of bins of the predicted probabilities.
+    """
+
+    def __init__(self, output_transform: Callable = lambda x: x, device="cpu", n_bins: int = 10) -> None:
+        self.n_bins = n_bins
+        super().__init__(output_transform=output_transform, device=device)
+
+    @reinit__is_reduced
+    def reset(self) -> None:
+        # Number of samples, positive samples and sum of the predicted probabilities per bin.
+        self._bins = torch.zeros(3, self.n_bins, dtype=torch.float64, device=self._device)
+
+    @reinit__is_reduced
+    def update(self, output) -> None:
+        y_pred, y = output[0].detach().reshape(-1).double(), output[1].detach().reshape(-1).double()
+        self._bins = self._bins.to(y_pred.device)
+        # Bins are closed on the right, except for the first one, like in calibration_curve.
+        edges = torch.linspace(0, 1, self.n_bins + 1, dtype=torch.float64, device=y_pred.device)[1:-1]
+        bin_ids = torch.bucketize(y_pred, edges)
+        for row, values in enumerate([torch.ones_like(y_pred), y, y_pred]):
+            self._bins[row].index_add_(0, bin_ids, values)
+
+    @sync_all_reduce("_bins")
+    def compute(self) -> tuple[np.ndarray, np.ndarray]:
+        counts, positives, probabilities = self._bins
+        if counts.sum() == 0:
+            raise NotComputableError("CalibrationCurve must have at least one example before it can be computed.")
+        non_empty = counts > 0
+        prob_true = (positives[non_empty] / counts[non_empty]).cpu().numpy()
+        prob_pred = (probabilities[non_empty] / counts[non_empty]).cpu().numpy()
+        return prob_true, prob_pred
+
+
+class MAE(Metric):
+    """Mean absolute error, computed from a running sum of the absolute errors.
+
+    Args:
+        output_transform: Transforms the output of the model into the predictions and targets.
+        device: Device of the running sums before the first update, which moves them to the device of the predictions.
+        invert_transform: Function applied to the predictions and targets (as numpy arrays of shape (n, 1)) before the error
+            is computed, e.g. to undo the scaling of the outcome.
+    """
+
+    def __init__(self, output_transform: Callable = lambda x: x, device="cpu", invert_transform: Callable = None) -> None:
+        self.invert_transform = invert_transform
+        super().__init__(output_transform=output_transform, device=device)
+
+    @reinit__is_reduced
+    def reset(self) -> None:
+        # Sum of the absolute errors and number of examples.
+        self._sums = torch.zeros(2, dtype=torch.float64, device=self._device)
+
+    @reinit__is_reduced
+    def update(self, output) -> None:
+        y_pred, y = output[0].detach().reshape(-1), output[1].detach().reshape(-1)
+        if self.invert_transform is not None:
+            y_pred = torch.as_tensor(self.invert_transform(y_pred.cpu().numpy().reshape(-1, 1))[:, 0], device=y.device)
+            y = torch.as_tensor(self.invert_transform(y.cpu().numpy().reshape(-1, 1))[:, 0], device=y.device)
+        errors = torch.abs(y_pred.double() - y.double())
+        self._sums = self._sums.to(errors.device) + torch.stack([errors.sum(), errors.new_tensor(errors.numel())])
+
+    @sync_all_reduce("_sums")
+    def compute(self) -> float:
+        if self._sums[1] == 0:
+            raise NotComputableError("MAE must have at least one example before it can be computed.")
+        return (self._sums[0] / self._sums[1]).item()
 
 
 class JSD(EpochMetric):
@@ -105,28 +258,23 @@ class TorchMetricsWrapper:
 
 
 class BinaryFairnessWrapper(BinaryFairness):
-    """
-    This class is a wrapper for the BinaryFairness metric from TorchMetrics.
-    """
+    """Wrapper of the BinaryFairness metric from TorchMetrics that computes the fairness for the groups of one grouping.
 
-    group_name = None
+    The groups of the predictions are passed to update as an array with one column per grouping of the stays, see
+    PredictionDataset.group_attributes. The column of the grouping is chosen once, so updates do not look up any names.
 
-    def __init__(self, group_name="sex", *args, **kwargs) -> None:
+    Args:
+        num_groups: Number of groups of the grouping.
+        group_index: Column of the grouping in the group ids.
+        group_name: Name of the grouping, e.g. "sex" or "sex&age".
+    """
+
+    def __init__(self, num_groups: int, group_index: int = 0, group_name: str = None, *args, **kwargs) -> None:
+        super().__init__(num_groups, *args, **kwargs)
+        self.group_index = group_index
         self.group_name = group_name
-        super().__init__(*args, **kwargs)
-
-    def update(self, preds, target, data, feature_names) -> None:
-        """ " Standard metric update function"""
-        groups = data[:, :, feature_names.index(self.group_name)]
-        group_per_id = groups[:, 0]
-        return super().update(preds=preds.cpu(), target=target.cpu(), groups=group_per_id.long().cpu())
-
-    def feature_helper(self, trainer, step_prefix):
-        """Helper function to get the feature names from the trainer"""
-        if step_prefix == "train":
-            feature_names = trainer.train_dataloader.dataset.features
-        elif step_prefix == "val":
-            feature_names = trainer.train_dataloader.dataset.features
-        else:
-            feature_names = trainer.test_dataloaders.dataset.features
-        return feature_names
+
+    def update(self, preds, target, groups) -> None:
+        """Updates the metric with the predictions, targets and group ids of the predictions of a batch."""
+        groups = groups[:, self.group_index] if groups.ndim == 2 else groups
+        return super().update(preds=preds.cpu(), target=target.long().cpu(), groups=groups.long().cpu())
@@ -3,7 +3,7 @@ from numbers import Integral
 import numpy as np
 import torch.nn as nn
 from icu_benchmarks.contants import RunMode
-from icu_benchmarks.models.layers import TransformerBlock, LocalBlock, TemporalBlock, PositionalEncoding
+from icu_benchmarks.models.layers import TransformerBlock, LocalBlock, TemporalBlock, PositionalEncoding, stacked_rnn_forward
 from icu_benchmarks.models.wrappers import DLPredictionWrapper
 
 
@@ -12,6 +12,8 @@ class RNNet(DLPredictionWrapper):
     """Torch standard RNN model"""
 
     _supported_run_modes = [RunMode.classification, RunMode.regression]
+    # Several instances are trained together as one wide recurrent network, see DLEnsembleWrapper.
+    stacked_forward = staticmethod(stacked_rnn_forward)
 
     def __init__(self, input_size, hidden_dim, layer_dim, num_classes, *args, **kwargs):
         super().__init__(
@@ -38,6 +40,8 @@ class LSTMNet(DLPredictionWrapper):
     """Torch standard LSTM model."""
 
     _supported_run_modes = [RunMode.classification, RunMode.regression]
+    # Several instances are trained together as one wide recurrent network, see DLEnsembleWrapper.
+    stacked_forward = staticmethod(stacked_rnn_forward)
 
     def __init__(self, input_size, hidden_dim, layer_dim, num_classes, *args, **kwargs):
         super().__init__(
@@ -65,6 +69,8 @@ class GRUNet(DLPredictionWrapper):
     """Torch standard GRU model."""
 
     _supported_run_modes = [RunMode.classification, RunMode.regression]
+    # Several instances are trained together as one wide recurrent network, see DLEnsembleWrapper.
+    stacked_forward = staticmethod(stacked_rnn_forward)
 
     def __init__(self, input_size, hidden_dim, layer_dim, num_classes, *args, **kwargs):
         super().__init__(
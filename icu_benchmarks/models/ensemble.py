@@ -0,0 +1,319 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+from ignite.exceptions import NotComputableError
+from torch.func import functional_call, vmap
+
+from icu_benchmarks.models.wrappers import BaseModule, DLPredictionWrapper
+
+
+def create_ensemble(model_class: type, size: int, optimizer_params: list[dict] = None, **kwargs) -> "DLEnsembleWrapper":
+    """Creates an ensemble of instances of a deep learning model, initialized with consecutive seeds.
+
+    The first member is initialized from the current random state, like a single model. The other members are initialized
+    in a forked random state, so that the data is shuffled as for a single model.
+
+    Args:
+        model_class: Class of the members.
+        size: Number of members.
+        optimizer_params: Optimizer hyperparameters of each member, e.g. the learning rate.
+        kwargs: Keyword arguments of the members and of the ensemble.
+    """
+    ensemble_kwargs = {key: kwargs.pop(key) for key in ["patience", "min_delta", "log_dir"] if key in kwargs}
+    seed = torch.initial_seed()
+    members = [model_class(**kwargs)]
+    for offset in range(1, size):
+        with torch.random.fork_rng():
+            torch.manual_seed(seed + offset)
+            members.append(model_class(**kwargs))
+    return DLEnsembleWrapper(members, optimizer_params=optimizer_params, **ensemble_kwargs)
+
+
+def fused_forward(members, x):
+    """Computes the members as one wide model, for model classes that implement it."""
+    return type(members[0]).stacked_forward(members, x)
+
+
+def vmap_forward(members, x):
+    """Computes the members with one vectorized call of the first member on their stacked parameters."""
+    params = {
+        name: torch.stack([dict(m.named_parameters())[name] for m in members]) for name, _ in members[0].named_parameters()
+    }
+    buffers = {name: torch.stack([dict(m.named_buffers())[name] for m in members]) for name, _ in members[0].named_buffers()}
+
+    def call(member_params, member_buffers, data):
+        return functional_call(members[0], (member_params, member_buffers), (data,))
+
+    # functional_call does not restore every tensor of modules that are registered under several names (e.g. also inside a
+    # Sequential) or that store computed weights as attributes (e.g. weight_norm), so the state is restored here.
+    state = [(vars(module), dict(vars(module))) for module in members[0].modules()]
+    state += [(tensors, dict(tensors)) for module in members[0].modules() for tensors in (module._parameters, module._buffers)]
+    try:
+        return vmap(call, in_dims=(0, 0, None), randomness="different")(params, buffers, x)
+    finally:
+        for tensors, original in state:
+            tensors.update(original)
+
+
+def loop_forward(members, x):
+    """Computes the members one after another."""
+    return torch.stack([member(x) for member in members])
+
+
+class DLEnsembleWrapper(BaseModule):
+    """Trains several instances of a deep learning model together on the same batches.
+
+    The members are computed together in each step, either as one wide model if the model class implements
+    `stacked_forward` (e.g. the recurrent networks), or vectorized with torch.func on their stacked parameters. If neither
+    works for a model, they are computed one after another, which still shares the data loading and the training loop.
+    Each member has its own optimizer, early stopping, checkpoint (member_<i>/model.ckpt) and metrics (<split>/member_<i>/),
+    so that the members behave like separately trained models. The logged loss and metrics without a member prefix are the
+    averages over the members.
+
+    Args:
+        members: Instances of the same model class with identical architectures, e.g. initialized with different seeds.
+        optimizer_params: Optimizer hyperparameters of each member, which override the configured ones.
+        patience: Number of validation runs without improvement after which a member stops training.
+        min_delta: Minimum change of the validation loss of a member to count as an improvement.
+        log_dir: Directory in which the checkpoints of the members are saved.
+    """
+
+    requires_backprop = True
+
+    def __init__(
+        self,
+        members: list[DLPredictionWrapper],
+        optimizer_params: list[dict] = None,
+        patience: int = 20,
+        min_delta: float = 1e-5,
+        log_dir: Path = None,
+    ):
+        super().__init__()
+        if optimizer_params is not None and len(optimizer_params) != len(members):
+            raise ValueError(f"Got optimizer parameters for {len(optimizer_params)} of {len(members)} ensemble members.")
+        self.members = nn.ModuleList(members)
+        self.optimizer_params = optimizer_params or [{} for _ in members]
+        self.patience = patience
+        self.min_delta = min_delta
+        self.log_dir = log_dir
+        self.run_mode = members[0].run_mode
+        self.automatic_optimization = False
+        self.best_losses = [np.inf] * len(members)
+        self.wait_counts = [0] * len(members)
+        self.stopped = [False] * len(members)
+        # Members whose metrics were updated in the current epoch, per step type.
+        self.evaluated = {"train": set(), "val": set(), "test": set()}
+        self.val_losses = {}
+        self.stacked_forward = self.choose_stacked_forward()
+
+    def choose_stacked_forward(self):
+        """Returns the fastest way of computing the members that works for their model class."""
+        candidates = [vmap_forward, loop_forward]
+        if hasattr(type(self.members[0]), "stacked_forward"):
+            candidates.insert(0, fused_forward)
+        input_size = self.members[0].input_size
+        sample = torch.zeros(2, *input_size[1:]) if input_size is not None else None
+        for forward in candidates[:-1]:
+            if sample is None:
+                break
+            try:
+                with torch.no_grad():
+                    forward(list(self.members), sample)
+                logging.info(f"Computing {len(self.members)} ensemble members with {forward.__name__}.")
+                return forward
+            except Exception as e:
+                logging.debug(f"Cannot compute the ensemble members with {forward.__name__}: {e}")
+        logging.info(f"Computing {len(self.members)} ensemble members one after another.")
+        return loop_forward
+
+    def forward(self, x, indices=None):
+        """Returns the outputs of the members (all by default), stacked along the first dimension."""
+        members = list(self.members) if indices is None else [self.members[i] for i in indices]
+        if len(members) == 1:
+            return members[0](x).unsqueeze(0)
+        return self.stacked_forward(members, x)
+
+    def set_weight(self, weight, dataset):
+        for member in self.members:
+            member.set_weight(weight, dataset)
+
+    def set_trained_columns(self, columns: list[str]):
+        super().set_trained_columns(columns)
+        for member in self.members:
+            member.set_trained_columns(columns)
+
+    def set_groupings(self, groupings: dict[str, int]):
+        super().set_groupings(groupings)
+        for member in self.members:
+            member.set_groupings(groupings)
+
+    def enable_bootstrap(self):
+        logging.warning("Bootstrap confidence intervals are not supported for ensembles, skipping them.")
+
+    def enable_prediction_writer(self, path, stay_ids):
+        logging.warning("Writing predictions is not supported for ensembles, skipping it.")
+
+    def on_fit_start(self):
+        for member in self.members:
+            member.on_fit_start()
+
+    def on_train_start(self):
+        for member in self.members:
+            member.on_train_start()
+
+    def on_test_epoch_start(self):
+        for member in self.members:
+            member.on_test_epoch_start()
+
+    def configure_optimizers(self):
+        """Configures an optimizer, and possibly a learning rate scheduler, for each member."""
+        optimizers, schedulers = [], []
+        for member, params in zip(self.members, self.optimizer_params):
+            configured = member.configure_optimizers()
+            optimizer = configured["optimizer"] if isinstance(configured, dict) else configured
+            for group in optimizer.param_groups:
+                group.update(params)
+            optimizers.append(optimizer)
+            if isinstance(configured, dict):
+                schedulers.append(configured["lr_scheduler"])
+        return optimizers, schedulers
+
+    def active_members(self, step_prefix):
+        """Returns the indices of the members to compute, i.e. all members except stopped ones during training."""
+        if step_prefix == "test":
+            return list(range(len(self.members)))
+        return [i for i, stopped in enumerate(self.stopped) if not stopped]
+
+    def compute_member_losses(self, element, step_prefix=""):
+        """Computes the losses of the active members on a batch and updates their metrics.
+
+        Returns:
+            The indices of the computed members and their losses.
+        """
+        indices = self.active_members(step_prefix)
+        data, labels, mask = self.members[0].prepare_batch(element)
+        outputs = self(data, indices)
+        losses = []
+        for i, out in zip(indices, outputs):
+            member = self.members[i]
+            loss, prediction, target = member.loss_from_output(out, labels, mask)
+            member.update_metrics(prediction, target, member.prediction_groups(element), step_prefix)
+            self.log(f"{step_prefix}/member_{i}/loss", loss, on_step=False, on_epoch=True, sync_dist=True)
+            losses.append(loss)
+        self.evaluated[step_prefix].update(indices)
+        return indices, losses
+
+    def compute_loss(self, element):
+        """Computes the average loss of the active members on a batch."""
+        indices = self.active_members("val")
+        data, labels, mask = self.members[0].prepare_batch(element)
+        losses = [self.members[i].loss_from_output(out, labels, mask)[0] for i, out in zip(indices, self(data, indices))]
+        return (torch.stack(losses).mean(),)
+
+    def step_fn(self, element, step_prefix=""):
+        indices, losses = self.compute_member_losses(element, step_prefix)
+        loss = torch.stack(losses).mean()
+        self.log(f"{step_prefix}/loss", loss, on_step=False, on_epoch=True, sync_dist=True)
+        if step_prefix == "val":
+            batch_size = len(element[0])
+            for i, member_loss in zip(indices, losses):
+                total, count = self.val_losses.get(i, (0.0, 0))
+                self.val_losses[i] = (total + member_loss.item() * batch_size, count + batch_size)
+        return loss
+
+    def training_step(self, batch, batch_idx):
+        optimizers = self.optimizers()
+        optimizers = optimizers if isinstance(optimizers, list) else [optimizers]
+        indices, losses = self.compute_member_losses(batch, "train")
+        loss = torch.stack(losses).mean()
+        self.log("train/loss", loss, on_step=False, on_epoch=True, sync_dist=True)
+        for i in indices:
+            optimizers[i].zero_grad()
+        # The members are independent, so the gradient of the sum of their losses is the gradient of each loss.
+        self.manual_backward(torch.stack(losses).sum())
+        for i in indices:
+            optimizers[i].step()
+        return loss
+
+    def finalize_step(self, step_prefix=""):
+        """Logs the metrics of each evaluated member and their averages."""
+        member_values = {}
+        for i in sorted(self.evaluated[step_prefix]):
+            try:
+                member_values[i] = self.members[i].compute_metrics(step_prefix)
+            except (NotComputableError, ValueError):
+                logging.warning(f"Metrics of ensemble member {i} for {step_prefix} not computable")
+        self.evaluated[step_prefix].clear()
+        values = {}
+        for i, member_metrics in member_values.items():
+            for name, value in member_metrics.items():
+                values[name.replace(f"{step_prefix}/", f"{step_prefix}/member_{i}/", 1)] = value
+        for name in next(iter(member_values.values()), {}):
+            # The names of some values, like the pair of groups of a fairness metric, depend on the member.
+            if any(name not in metrics for metrics in member_values.values()):
+                continue
+            member_metrics = [torch.as_tensor(metrics[name], dtype=torch.float32) for metrics in member_values.values()]
+            if all(value.numel() == 1 for value in member_metrics):
+                values[name] = torch.stack([value.reshape(()) for value in member_metrics]).mean()
+        if values:
+            self.log_dict(values, sync_dist=True)
+
+    def on_train_epoch_end(self):
+        schedulers = self.lr_schedulers()
+        schedulers = schedulers if isinstance(schedulers, list) else [schedulers] if schedulers is not None else []
+        for i in sorted(self.evaluated["train"]):
+            if i < len(schedulers):
+                schedulers[i].step()
+        super().on_train_epoch_end()
+
+    def on_validation_epoch_end(self):
+        super().on_validation_epoch_end()
+        val_losses, self.val_losses = self.val_losses, {}
+        if self.trainer.sanity_checking:
+            return
+        # With data-parallel training, all processes decide on the losses of the complete validation set.
+        indices = sorted(val_losses)
+        totals = torch.tensor([val_losses[i] for i in indices], dtype=torch.float64, device=self.device).reshape(-1, 2)
+        totals = self.trainer.strategy.reduce(totals, reduce_op="sum")
+        for i, (total, count) in zip(indices, totals.tolist()):
+            loss = total / max(count, 1)
+            if loss < self.best_losses[i] - self.min_delta:
+                self.best_losses[i], self.wait_counts[i] = loss, 0
+                continue
+            self.wait_counts[i] += 1
+            if self.wait_counts[i] >= self.patience:
+                logging.info(f"Ensemble member {i} stopped after {self.current_epoch + 1} epochs.")
+                self.stopped[i] = True
+                self.save_member(i)
+        if all(self.stopped):
+            self.trainer.should_stop = True
+
+    def on_fit_end(self):
+        for i, stopped in enumerate(self.stopped):
+            if not stopped:
+                self.save_member(i)
+
+    def save_member(self, index):
+        """Saves a member to member_<index>/model.ckpt in the log directory."""
+        if self.log_dir is None or not self.trainer.is_global_zero:
+            return
+        member_dir = Path(self.log_dir) / f"member_{index}"
+        member_dir.mkdir(parents=True, exist_ok=True)
+        self.members[index].save_model(member_dir, "model")
+
+    def on_save_checkpoint(self, checkpoint):
+        checkpoint["ensemble_state"] = {
+            "best_losses": self.best_losses,
+            "wait_counts": self.wait_counts,
+            "stopped": self.stopped,
+        }
+        return super().on_save_checkpoint(checkpoint)
+
+    def on_load_checkpoint(self, checkpoint):
+        state = checkpoint.get("ensemble_state", {})
+        self.best_losses = state.get("best_losses", self.best_losses)
+        self.wait_counts = state.get("wait_counts", self.wait_counts)
+        self.stopped = state.get("stopped", self.stopped)
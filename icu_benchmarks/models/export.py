@@ -0,0 +1,191 @@
+import json
+import logging
+import sys
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from pathlib import Path
+
+import gin
+import torch
+import torch.nn as nn
+from pytorch_lightning import LightningModule, Trainer
+
+from icu_benchmarks.contants import RunMode
+from icu_benchmarks.models.compilation import uncompiled
+from icu_benchmarks.models.ensemble import DLEnsembleWrapper
+from icu_benchmarks.models.train import CHECKPOINT_NAMES, find_checkpoint
+from icu_benchmarks.models.wrappers import BaseModule
+
+EXPORT_FORMATS = {"torchscript": "model.pt", "onnx": "model.onnx"}
+
+
+class InferenceModule(nn.Module):
+    """Wraps the forward pass of a trained model for inference.
+
+    Auxiliary losses are dropped and the logits of classifiers are turned into class probabilities. The members of an
+    ensemble are averaged.
+
+    Args:
+        model: Trained model.
+        probabilities: Whether to apply a softmax to the output.
+    """
+
+    def __init__(self, model: nn.Module, probabilities: bool):
+        super().__init__()
+        self.model = model
+        self.probabilities = probabilities
+        self.ensemble = isinstance(model, DLEnsembleWrapper)
+
+    def forward(self, x):
+        out = self.model(x)
+        out = out[0] if isinstance(out, tuple) else out
+        out = torch.softmax(out, dim=-1) if self.probabilities else out
+        return out.mean(dim=0) if self.ensemble else out
+
+
+def export_model(
+    model: BaseModule,
+    input_shape: torch.Size,
+    export_dir: Path,
+    export_format: str = "torchscript",
+    recipes: dict = None,
+) -> Path:
+    """Exports the forward pass of a trained DL model, so that it can be used without the training stack.
+
+    The model is traced with TorchScript (model.pt) or exported to ONNX (model.onnx), with a dynamic batch size. The
+    metadata needed to prepare its input is written to export_metadata.json. Inference only needs torch or onnxruntime, see
+    icu_benchmarks.inference.
+
+    Args:
+        model: Trained model.
+        input_shape: Shape of the input batches the model was trained on.
+        export_dir: Directory to write the exported model and its metadata to.
+        export_format: "torchscript" or "onnx".
+        recipes: Description of the fitted preprocessing recipes, see describe_recipe.
+
+    Returns:
+        Path to the exported model.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {export_format}, choose one of {', '.join(EXPORT_FORMATS)}.")
+    if not model.requires_backprop:
+        raise ValueError(f"Only DL models can be exported, got {type(model).__name__}.")
+    model = uncompiled(model)
+    probabilities = model.run_mode == RunMode.classification
+    module = InferenceModule(model.cpu().eval(), probabilities).eval()
+    # Tracing specializes on the sample shape, a batch size of one would not generalize to other batch sizes.
+    sample = torch.zeros(2, *input_shape[1:])
+    export_dir = Path(export_dir)
+    export_dir.mkdir(parents=True, exist_ok=True)
+    path = export_dir / EXPORT_FORMATS[export_format]
+    with torch.no_grad(), attached_trainer(model):
+        if export_format == "torchscript":
+            torch.jit.trace(module, sample).save(str(path))
+        else:
+            torch.onnx.export(
+                module,
+                sample,
+                str(path),
+                input_names=["features"],
+                output_names=["output"],
+                dynamic_axes={"features": {0: "batch"}, "output": {0: "batch"}},
+            )
+    metadata = {
+        "model": type(model).__name__,
+        "format": export_format,
+        "file": path.name,
+        "input_shape": [int(size) for size in input_shape[1:]],
+        "trained_columns": list(model.trained_columns) if model.trained_columns is not None else None,
+        "run_mode": str(model.run_mode.value if isinstance(model.run_mode, RunMode) else model.run_mode),
+        "output": "probabilities" if probabilities else "values",
+        "recipes": recipes,
+    }
+    with open(export_dir / "export_metadata.json", "w") as f:
+        json.dump(metadata, f, indent=4, default=str)
+    logging.info(f"Exported {type(model).__name__} to {path}.")
+    return path
+
+
+@contextmanager
+def attached_trainer(model: BaseModule):
+    """Temporarily attaches a bare trainer to the modules of a model that are not attached to one, e.g. after loading it.
+
+    TorchScript reads every attribute of the modules it traces, and the trainer property raises if there is no trainer.
+    """
+    detached = []
+    for module in model.modules():
+        try:
+            if isinstance(module, LightningModule):
+                module.trainer
+        except RuntimeError:
+            detached.append(module)
+    if detached:
+        trainer = Trainer(
+            accelerator="cpu", logger=False, enable_checkpointing=False, enable_progress_bar=False, enable_model_summary=False
+        )
+    for module in detached:
+        module.trainer = trainer
+    try:
+        yield
+    finally:
+        for module in detached:
+            module.trainer = None
+
+
+def export_checkpoint(checkpoint: Path, export_dir: Path = None, export_format: str = "torchscript") -> Path:
+    """Loads a model from a Lightning checkpoint and exports it, by default next to the checkpoint.
+
+    The architecture is bound from the train_config.gin of the fold, like when evaluating a trained model. The description
+    of the fitted recipes is taken from the recipes.json of the fold, if it was written during training.
+    """
+    checkpoint = Path(checkpoint)
+    # Checkpoints of ensemble members are saved in a subdirectory of the fold.
+    fold_dirs = [checkpoint.parent, checkpoint.parent.parent]
+    config_files = [fold_dir / "train_config.gin" for fold_dir in fold_dirs if (fold_dir / "train_config.gin").exists()]
+    if not config_files:
+        raise FileNotFoundError(f"No train_config.gin found for {checkpoint}.")
+    gin.clear_config()
+    gin.parse_config_file(config_files[0], skip_unknown=True)
+    state = torch.load(checkpoint, map_location="cpu")
+    model = state["class"].load_from_checkpoint(checkpoint, map_location="cpu")
+    model.set_trained_columns(state.get("trained_columns"))
+    recipes = None
+    for recipe_file in [fold_dir / "recipes.json" for fold_dir in fold_dirs]:
+        if recipe_file.exists():
+            with open(recipe_file) as f:
+                recipes = json.load(f)
+            break
+    else:
+        logging.warning(f"No recipes.json found for {checkpoint}, the export does not describe the preprocessing.")
+    export_dir = export_dir if export_dir is not None else checkpoint.parent / "export"
+    return export_model(model, model.hparams.input_size, export_dir, export_format, recipes)
+
+
+def main(my_args=tuple(sys.argv[1:])):
+    parser = ArgumentParser(description="Export trained YAIB models for inference without the training stack.")
+    parser.add_argument("path", type=Path, help="Checkpoint, or a run or fold directory to export all models of.")
+    parser.add_argument("-f", "--format", default="torchscript", choices=list(EXPORT_FORMATS), help="Export format.")
+    parser.add_argument("-o", "--output", type=Path, help="Export directory, by default next to each checkpoint.")
+    args = parser.parse_args(my_args)
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s : %(message)s", level=logging.INFO)
+
+    if args.path.is_file():
+        checkpoints = [args.path]
+    else:
+        fold_dirs = sorted({path.parent for name in CHECKPOINT_NAMES for path in args.path.rglob(name)})
+        checkpoints = [find_checkpoint(fold_dir) for fold_dir in fold_dirs]
+    if not checkpoints:
+        raise FileNotFoundError(f"No checkpoints found in {args.path}.")
+    for checkpoint in checkpoints:
+        export_dir = None
+        if args.output is not None:
+            relative = checkpoint.parent.relative_to(args.path) if args.path.is_dir() else Path()
+            export_dir = args.output / relative
+        try:
+            export_checkpoint(checkpoint, export_dir, args.format)
+        except Exception as e:
+            logging.error(f"Cannot export {checkpoint}: {e}")
+
+
+if __name__ == "__main__":
+    main()
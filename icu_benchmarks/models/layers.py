@@ -314,3 +314,54 @@ class TemporalBlock(nn.Module):
         out = self.net(x)
         res = x if self.downsample is None else self.downsample(x)
         return self.relu(out + res)
+
+
+def stacked_rnn_forward(members, x):
+    """Runs the recurrent networks of several models with identical architectures as one wide network.
+
+    The hidden states of all models are concatenated and the recurrent (and deeper input) weights are combined into
+    block-diagonal matrices, so that the models stay independent but are computed in a single call of a wide recurrent
+    module of the same class. This is much faster than separate calls for small hidden sizes, which underuse the available
+    cores.
+
+    Args:
+        members: Models with a unidirectional `rnn` and a `logit` linear layer, applied as in their forward method.
+        x: Input batch shared by all models.
+
+    Returns:
+        The predictions of all models, stacked along the first dimension.
+    """
+    rnns = [member.rnn for member in members]
+    rnn = rnns[0]
+    num_models, hidden, num_gates = len(rnns), rnn.hidden_size, rnn.weight_ih_l0.shape[0] // rnn.hidden_size
+
+    def combine(name, block_diagonal):
+        # Reorders the weights from (model, gate, unit) to (gate, model, unit), the gate layout of the wide network.
+        weights = torch.stack([getattr(module, name) for module in rnns])
+        weights = weights.reshape(num_models, num_gates, hidden, *weights.shape[2:]).transpose(0, 1)
+        if block_diagonal:
+            return torch.cat([torch.block_diag(*gate_weights) for gate_weights in weights])
+        return weights.reshape(num_gates * num_models * hidden, *weights.shape[3:])
+
+    weights = {}
+    for layer in range(rnn.num_layers):
+        weights[f"weight_ih_l{layer}"] = combine(f"weight_ih_l{layer}", block_diagonal=layer > 0)
+        weights[f"weight_hh_l{layer}"] = combine(f"weight_hh_l{layer}", block_diagonal=True)
+        if rnn.bias:
+            weights[f"bias_ih_l{layer}"] = combine(f"bias_ih_l{layer}", block_diagonal=False)
+            weights[f"bias_hh_l{layer}"] = combine(f"bias_hh_l{layer}", block_diagonal=False)
+
+    # The wide network is created without allocating its weights, which are replaced by the combined weights. These are
+    # assigned as plain tensors rather than parameters, so that the gradients flow back to the weights of the models.
+    kwargs = dict(num_layers=rnn.num_layers, bias=rnn.bias, batch_first=rnn.batch_first, dropout=rnn.dropout, device="meta")
+    if isinstance(rnn, nn.RNN):
+        kwargs["nonlinearity"] = rnn.nonlinearity
+    wide = type(rnn)(rnn.input_size, num_models * hidden, **kwargs).train(rnn.training)
+    for name, weight in weights.items():
+        delattr(wide, name)
+        setattr(wide, name, weight)
+    out = wide(x)[0]
+    out = out.reshape(*out.shape[:-1], num_models, hidden).movedim(-2, 0)
+    logit_weights = torch.stack([member.logit.weight for member in members])
+    logit_bias = torch.stack([member.logit.bias for member in members])
+    return torch.einsum("k...h,kch->k...c", out, logit_weights) + logit_bias.reshape(num_models, *([1] * (out.dim() - 2)), -1)
@@ -0,0 +1,103 @@
+from functools import cached_property
+from typing import Callable
+
+import numpy as np
+from sklearn.calibration import calibration_curve
+from sklearn.metrics import average_precision_score, precision_recall_curve, roc_auc_score, roc_curve
+
+# Metrics that return curves instead of scalars, these are skipped without being computed when only scalars are requested.
+CURVE_METRICS = {calibration_curve, precision_recall_curve, roc_curve}
+
+
+class SortedBinaryScores:
+    """Sorts the scores of a binary classifier once and derives the ranking metrics from the shared order.
+
+    The results are the same as those of the scikit-learn functions, which each sort the scores on their own.
+
+    Args:
+        y_true: Binary labels.
+        y_score: Scores of the positive class.
+    """
+
+    def __init__(self, y_true: np.ndarray, y_score: np.ndarray):
+        self.y_true = np.ravel(y_true) == 1
+        self.y_score = np.ravel(y_score)
+
+    @cached_property
+    def clf_curve(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """False and true positives at each distinct score from the highest to the lowest, and the scores."""
+        order = np.argsort(self.y_score, kind="mergesort")[::-1]
+        y_score, y_true = self.y_score[order], self.y_true[order]
+        threshold_idxs = np.r_[np.where(np.diff(y_score))[0], y_true.size - 1]
+        tps = np.cumsum(y_true, dtype=np.float64)[threshold_idxs]
+        fps = 1 + threshold_idxs - tps
+        return fps, tps, y_score[threshold_idxs]
+
+    def roc_curve(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """See sklearn.metrics.roc_curve, suboptimal thresholds are dropped."""
+        fps, tps, thresholds = self.clf_curve
+        if len(fps) > 2:
+            optimal_idxs = np.where(np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True])[0]
+            fps, tps, thresholds = fps[optimal_idxs], tps[optimal_idxs], thresholds[optimal_idxs]
+        fps, tps, thresholds = np.r_[0, fps], np.r_[0, tps], np.r_[np.inf, thresholds]
+        return fps / fps[-1], tps / tps[-1], thresholds
+
+    def precision_recall_curve(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """See sklearn.metrics.precision_recall_curve."""
+        fps, tps, thresholds = self.clf_curve
+        predicted_positives = tps + fps
+        precision = np.zeros_like(tps)
+        np.divide(tps, predicted_positives, out=precision, where=predicted_positives != 0)
+        recall = tps / tps[-1]
+        return np.hstack((precision[::-1], 1)), np.hstack((recall[::-1], 0)), thresholds[::-1]
+
+    def roc_auc_score(self) -> float:
+        """See sklearn.metrics.roc_auc_score."""
+        fpr, tpr, _ = self.roc_curve()
+        return np.trapz(tpr, fpr)
+
+    def average_precision_score(self) -> float:
+        """See sklearn.metrics.average_precision_score."""
+        precision, recall, _ = self.precision_recall_curve()
+        return max(0.0, -np.sum(np.diff(recall) * precision[:-1]))
+
+
+# Metric functions that are computed from the shared order of the scores, by the name of the SortedBinaryScores method.
+SORTED_BINARY_METRICS = {
+    roc_auc_score: "roc_auc_score",
+    average_precision_score: "average_precision_score",
+    precision_recall_curve: "precision_recall_curve",
+    roc_curve: "roc_curve",
+}
+
+
+def evaluate_metrics(metrics: dict[str, Callable], label: np.ndarray, pred: np.ndarray, curves: bool = False) -> dict:
+    """Computes each metric once on the transformed labels and predictions.
+
+    If the labels are binary and contain both classes, the ranking metrics share one sort of the predictions. Other metrics
+    are called with (label, pred) like the scikit-learn metrics.
+
+    Args:
+        metrics: Metric functions by name.
+        label: Transformed labels.
+        pred: Transformed predictions.
+        curves: Whether to also compute the curve metrics. Metrics that turn out to return a tuple are always skipped
+            otherwise.
+
+    Returns:
+        The values of the metrics by name.
+    """
+    sorted_scores = None
+    if set(np.unique(label)) == {0, 1} and np.ndim(pred) == 1:
+        sorted_scores = SortedBinaryScores(label, pred)
+    values = {}
+    for name, metric in metrics.items():
+        if metric in CURVE_METRICS and not curves:
+            continue
+        if sorted_scores is not None and metric in SORTED_BINARY_METRICS:
+            value = getattr(sorted_scores, SORTED_BINARY_METRICS[metric])()
+        else:
+            value = metric(label, pred)
+        if curves or not isinstance(value, tuple):
+            values[name] = value
+    return values
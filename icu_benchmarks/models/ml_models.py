@@ -1,3 +1,11 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
 import gin
 import lightgbm as lgbm
 import numpy as np
@@ -6,13 +14,99 @@ from sklearn import linear_model
 from sklearn import ensemble
 from sklearn import neural_network
 from sklearn import svm
+from sklearn.utils.class_weight import compute_sample_weight
 from icu_benchmarks.models.wrappers import MLWrapper
 from icu_benchmarks.contants import RunMode
 from wandb.lightgbm import wandb_callback
 
 
+# Parameters of LightGBM that change the binning of a Dataset, and their aliases in the scikit-learn interface. A cached
+# Dataset is reused when only other parameters of the booster change.
+DATASET_PARAMS = {
+    "bin_construct_sample_cnt",
+    "categorical_feature",
+    "data_random_seed",
+    "enable_bundle",
+    "feature_pre_filter",
+    "linear_tree",
+    "max_bin",
+    "max_bin_by_feature",
+    "min_child_samples",
+    "min_data_in_bin",
+    "min_data_in_leaf",
+    "random_state",
+    "seed",
+    "subsample_for_bin",
+    "use_missing",
+    "zero_as_missing",
+}
+
+
+# Directory in the run directory, in which the binned LightGBM Datasets are cached while the run tunes and trains its models.
+DATASET_CACHE_DIR = "lightgbm_datasets"
+
+
+@gin.configurable("lightgbm_dataset_cache")
+def lightgbm_dataset_cache(cache_dir: str = None) -> Path:
+    """Returns the directory that the binned LightGBM Datasets are cached in, or None if they are not cached.
+
+    Runs bind it to a directory in the run directory, which is removed when the run finishes.
+
+    Args:
+        cache_dir: Directory of the cached Datasets.
+    """
+    return Path(cache_dir) if cache_dir is not None else None
+
+
+def bind_dataset_cache(run_dir: Path):
+    """Caches the binned LightGBM Datasets of a run in its run directory."""
+    gin.bind_parameter("lightgbm_dataset_cache.cache_dir", str(run_dir / DATASET_CACHE_DIR))
+
+
+def remove_dataset_cache(run_dir: Path):
+    """Removes the LightGBM Datasets cached by a run, which are only reused until the run finishes."""
+    shutil.rmtree(run_dir / DATASET_CACHE_DIR, ignore_errors=True)
+
+
 class LGBMWrapper(MLWrapper):
-    def fit_model(self, train_data, train_labels, val_data, val_labels):
+    """Trains LightGBM models on Datasets that are cached as LightGBM binary files.
+
+    The binned training and validation Datasets of a fold are saved to the directory of lightgbm_dataset_cache, keyed by a
+    hash of the data and the binning parameters, and loaded instead of binning the features again when the same fold is
+    trained on again, e.g. while tuning the hyperparameters of the booster. After training, the model is the trained
+    lgbm.Booster.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dataset_cache_dir = lightgbm_dataset_cache()
+        self.predict_threads = None
+
+    def predict(self, features):
+        """Predicts with the trained booster, the probabilities of both classes for binary classifiers."""
+        if not isinstance(self.model, lgbm.Booster):
+            return super().predict(features)
+        num_threads = self.predict_threads if self.predict_threads is not None else self.model.params.get("n_jobs", 0)
+        pred = self.model.predict(features, num_threads=num_threads)
+        # The booster of a binary classifier only predicts the probability of the positive class.
+        if self.run_mode == RunMode.classification and pred.ndim == 1:
+            return np.stack([1 - pred, pred], axis=1)
+        return pred
+
+    @contextmanager
+    def model_threads(self, threads: int):
+        """Temporarily sets the number of threads the booster predicts with."""
+        if not isinstance(self.model, lgbm.Booster):
+            with super().model_threads(threads):
+                yield
+            return
+        self.predict_threads = threads
+        try:
+            yield
+        finally:
+            self.predict_threads = None
+
+    def fit_model(self, train_data, train_labels, val_data, val_labels, train_weights=None):
         """Fitting function for LGBM models."""
         self.model.set_params(random_state=np.random.get_state()[1][0])
         callbacks = [lgbm.early_stopping(self.hparams.patience, verbose=True), lgbm.log_evaluation(period=-1)]
@@ -20,16 +114,79 @@ class LGBMWrapper(MLWrapper):
         if wandb.run is not None:
             callbacks.append(wandb_callback())
 
-        self.model = self.model.fit(
-            train_data,
-            train_labels,
-            eval_set=(val_data, val_labels),
-            verbose=True,
+        params = self.booster_params(train_labels)
+        if getattr(self.model, "class_weight", None) is not None:
+            class_weights = compute_sample_weight(self.model.class_weight, train_labels)
+            train_weights = class_weights if train_weights is None else class_weights * train_weights
+        train_set, val_set = self.build_datasets(params, train_data, train_labels, val_data, val_labels, train_weights)
+        self.model = lgbm.train(
+            params,
+            train_set,
+            num_boost_round=self.model.n_estimators,
+            valid_sets=[val_set],
+            valid_names=["valid_0"],
             callbacks=callbacks,
         )
-        val_loss = list(self.model.best_score_["valid_0"].values())[0]
+        self.model.free_dataset()
+        val_loss = list(self.model.best_score["valid_0"].values())[0]
         return val_loss
 
+    def booster_params(self, train_labels):
+        """Returns the LightGBM parameters of the model, like the scikit-learn interface passes them to lgbm.train."""
+        params = self.model.get_params()
+        for name in ["silent", "importance_type", "n_estimators", "class_weight"]:
+            params.pop(name, None)
+        params.setdefault("verbose", -1)
+        if isinstance(self.model, lgbm.LGBMRegressor):
+            params["objective"] = params["objective"] or "regression"
+        elif len(np.unique(train_labels)) > 2:
+            params["objective"] = params["objective"] or "multiclass"
+            params["num_class"] = len(np.unique(train_labels))
+        else:
+            params["objective"] = params["objective"] or "binary"
+        return params
+
+    def build_datasets(self, params, train_data, train_labels, val_data, val_labels, train_weights=None):
+        """Returns the training Dataset and the validation Dataset that shares its bins, loaded from the cache if possible."""
+        if self.dataset_cache_dir is None:
+            train_set = lgbm.Dataset(train_data, label=train_labels, weight=train_weights, params=params)
+            return train_set, train_set.create_valid(val_data, label=val_labels, params=params)
+        key = dataset_key(params, train_data, train_labels, train_weights, val_data, val_labels)
+        train_path = self.dataset_cache_dir / f"{key}.train.bin"
+        val_path = self.dataset_cache_dir / f"{key}.val.bin"
+        if train_path.exists() and val_path.exists():
+            logging.info(f"Loading the binned LightGBM Datasets from {train_path.parent}.")
+            train_set = lgbm.Dataset(str(train_path), params=params)
+            return train_set, lgbm.Dataset(str(val_path), reference=train_set, params=params)
+        train_set = lgbm.Dataset(train_data, label=train_labels, weight=train_weights, params=params)
+        val_set = train_set.create_valid(val_data, label=val_labels, params=params)
+        val_set.construct()
+        try:
+            self.dataset_cache_dir.mkdir(parents=True, exist_ok=True)
+            for dataset, path in [(train_set, train_path), (val_set, val_path)]:
+                # Datasets are written under a temporary name, so that concurrent runs never load a partial file.
+                partial_path = path.with_name(f"{path.name}.{os.getpid()}")
+                dataset.save_binary(str(partial_path))
+                os.replace(partial_path, path)
+        except OSError as e:
+            logging.warning(f"Cannot cache the LightGBM Datasets in {self.dataset_cache_dir}: {e}")
+        return train_set, val_set
+
+
+def dataset_key(params: dict, *arrays) -> str:
+    """Returns a hash of the arrays of a fold and the parameters that change how they are binned."""
+    digest = hashlib.blake2b(digest_size=16)
+    binning = {name: value for name, value in params.items() if name in DATASET_PARAMS}
+    digest.update(json.dumps([lgbm.__version__, binning], sort_keys=True, default=str).encode())
+    for array in arrays:
+        if array is None:
+            digest.update(b"None")
+            continue
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype}{array.shape}".encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
 
 @gin.configurable
 class LGBMClassifier(LGBMWrapper):
@@ -39,10 +196,6 @@ class LGBMClassifier(LGBMWrapper):
         self.model = self.set_model_args(lgbm.LGBMClassifier, *args, **kwargs)
         super().__init__(*args, **kwargs)
 
-    def predict(self, features):
-        """Predicts labels for the given features."""
-        return self.model.predict_proba(features)
-
 
 @gin.configurable
 class LGBMRegressor(LGBMWrapper):
@@ -0,0 +1,207 @@
+import json
+import logging
+import sys
+from argparse import ArgumentParser, BooleanOptionalAction as BOA
+from pathlib import Path
+from statistics import mean, pstdev
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+from pytorch_lightning import Trainer
+from torch.utils.data import DataLoader
+
+from icu_benchmarks.contants import RunMode
+from icu_benchmarks.models.constants import MLMetrics
+from icu_benchmarks.models.ml_metrics import evaluate_metrics
+from icu_benchmarks.models.utils import JsonResultLoggingEncoder
+
+PREDICTIONS_FILE = "{split}_predictions.parquet"
+RECOMPUTED_METRICS_FILE = "{split}_recomputed_metrics.json"
+
+
+class PredictionWriter:
+    """Streams the predictions of the labeled time steps of a split to a Parquet file.
+
+    Each row holds the stay id, the time step within the stay, the label and the score. The score is the probability of the
+    positive class for binary classification, the predicted value for regression and one column score_<class> per class
+    otherwise. Rows are buffered and written in row groups, so the predictions never have to be held in memory at once.
+
+    Args:
+        path: Parquet file to write, an existing file is replaced.
+        stay_ids: Ids of the stays of the split, the predictions refer to the stays by their position.
+        run_mode: Run mode of the model, stored in the file metadata.
+        row_group_size: Number of rows that are buffered before they are written.
+    """
+
+    def __init__(self, path: Path, stay_ids: np.ndarray, run_mode: RunMode, row_group_size: int = 2**16):
+        self.path = Path(path)
+        self.stay_ids = np.asarray(stay_ids)
+        self.run_mode = run_mode.value if isinstance(run_mode, RunMode) else str(run_mode)
+        self.row_group_size = row_group_size
+        self.num_rows = 0
+        self._buffer = []
+        self._buffered_rows = 0
+        self._writer = None
+        self.path.unlink(missing_ok=True)
+
+    def write(self, stays, time_steps, labels, scores):
+        """Adds the predictions of a batch.
+
+        Args:
+            stays: Position of the stay of each prediction in stay_ids.
+            time_steps: Time step of each prediction within its stay.
+            labels: Labels of the predictions.
+            scores: Scores with shape (predictions,) or (predictions, classes).
+        """
+        stays, time_steps, labels, scores = (
+            np.asarray(value.detach().cpu() if isinstance(value, torch.Tensor) else value)
+            for value in (stays, time_steps, labels, scores)
+        )
+        scores = scores.reshape(len(scores), -1)
+        columns = {
+            "stay_id": self.stay_ids[stays.ravel()],
+            "time_step": time_steps.ravel().astype(np.int32),
+            "label": labels.ravel().astype(np.float32),
+        }
+        if scores.shape[1] == 1:
+            columns["score"] = scores[:, 0].astype(np.float32)
+        else:
+            columns.update({f"score_{i}": scores[:, i].astype(np.float32) for i in range(scores.shape[1])})
+        self._buffer.append(columns)
+        self._buffered_rows += len(scores)
+        if self._buffered_rows >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        table = pa.Table.from_pydict(
+            {name: np.concatenate([batch[name] for batch in self._buffer]) for name in self._buffer[0]}
+        )
+        if self._writer is None:
+            schema = table.schema.with_metadata({"run_mode": self.run_mode})
+            self._writer = pq.ParquetWriter(self.path, schema)
+        self._writer.write_table(table.cast(self._writer.schema))
+        self.num_rows += table.num_rows
+        self._buffer, self._buffered_rows = [], 0
+
+    def close(self):
+        """Writes the remaining predictions and closes the file."""
+        self._flush()
+        if self._writer is None:
+            logging.warning(f"No predictions were written to {self.path}.")
+            return
+        self._writer.close()
+        self._writer = None
+        logging.info(f"Wrote {self.num_rows} predictions to {self.path}.")
+
+
+def write_predictions(model, loader: DataLoader, path: Path, stay_ids: np.ndarray, device_settings: dict, verbose=False):
+    """Writes the predictions of a trained model on a loader, without logging any metrics.
+
+    Args:
+        model: Trained model.
+        loader: Loader of the split, like the loader of the test set.
+        path: Parquet file to write.
+        stay_ids: Ids of the stays of the split.
+        device_settings: Accelerator and devices of the trainer, the predictions are computed by a single process.
+        verbose: Whether to show the progress.
+    """
+    model.enable_prediction_writer(path, stay_ids)
+    # Iterating the loader draws a seed, the random state is forked to keep later folds as without the predictions.
+    with torch.random.fork_rng(devices=[]):
+        trainer = Trainer(**device_settings, logger=False, enable_checkpointing=False, enable_progress_bar=verbose)
+        trainer.test(model, dataloaders=loader, verbose=False)
+
+
+def read_predictions(fold_dir: Path, split: str = "test") -> pd.DataFrame:
+    """Reads the predictions of a split of a fold, including the parts written by the processes of a data-parallel test.
+
+    Returns:
+        The predictions, with the run mode of the model in the attrs of the DataFrame.
+    """
+    name = PREDICTIONS_FILE.format(split=split)
+    paths = sorted(Path(fold_dir).glob(f"{Path(name).stem}*.parquet"))
+    if not paths:
+        raise FileNotFoundError(f"No {split} predictions found in {fold_dir}.")
+    tables = [pq.read_table(path) for path in paths]
+    predictions = pa.concat_tables(tables).to_pandas()
+    predictions.attrs["run_mode"] = tables[0].schema.metadata[b"run_mode"].decode()
+    return predictions
+
+
+def prediction_metrics(predictions: pd.DataFrame, curves: bool = False) -> dict:
+    """Computes the metrics of the ML models on stored predictions, see evaluate_metrics.
+
+    Args:
+        predictions: Predictions as read by read_predictions.
+        curves: Whether to also compute the curve metrics.
+
+    Returns:
+        The values of the metrics by name.
+    """
+    labels = predictions["label"].to_numpy()
+    if predictions.attrs["run_mode"] == RunMode.regression.value:
+        return evaluate_metrics(MLMetrics.REGRESSION, labels, predictions["score"].to_numpy(), curves)
+    if "score" in predictions:
+        return evaluate_metrics(MLMetrics.BINARY_CLASSIFICATION, labels, predictions["score"].to_numpy(), curves)
+    scores = predictions.filter(regex=r"^score_\d+$").to_numpy()
+    return evaluate_metrics(MLMetrics.MULTICLASS_CLASSIFICATION, labels, np.argmax(scores, axis=-1), curves)
+
+
+def recompute_metrics(run_dir: Path, split: str = "test", curves: bool = False) -> dict:
+    """Recomputes the metrics of all folds of a run from their stored predictions, without loading any model.
+
+    The metrics of each fold are written to <split>_recomputed_metrics.json in the fold directory. Their mean and the
+    standard error over the folds are written to the same file in the run directory.
+
+    Args:
+        run_dir: Run directory, or any directory that contains fold directories with predictions.
+        split: Split of the predictions, "test" or "val".
+        curves: Whether to also compute the curve metrics.
+
+    Returns:
+        The metrics of each fold by its path relative to the run directory, and their mean and standard error.
+    """
+    run_dir = Path(run_dir)
+    pattern = f"{Path(PREDICTIONS_FILE.format(split=split)).stem}*.parquet"
+    fold_dirs = sorted({path.parent for path in run_dir.rglob(pattern)})
+    if not fold_dirs:
+        raise FileNotFoundError(f"No {split} predictions found in {run_dir}.")
+    folds = {}
+    for fold_dir in fold_dirs:
+        metrics = prediction_metrics(read_predictions(fold_dir, split), curves)
+        with open(fold_dir / RECOMPUTED_METRICS_FILE.format(split=split), "w") as f:
+            json.dump(metrics, f, cls=JsonResultLoggingEncoder, indent=4)
+        folds[str(fold_dir.relative_to(run_dir))] = metrics
+    scores = {}
+    for metrics in folds.values():
+        for name, value in metrics.items():
+            if np.ndim(value) == 0:
+                scores.setdefault(name, []).append(float(value))
+    results = {
+        "folds": folds,
+        "avg": {name: mean(values) for name, values in scores.items()},
+        "std": {name: pstdev(values) / np.sqrt(len(values)) for name, values in scores.items()},
+    }
+    with open(run_dir / RECOMPUTED_METRICS_FILE.format(split=split), "w") as f:
+        json.dump(results, f, cls=JsonResultLoggingEncoder, indent=4)
+    logging.info(f"Recomputed the {split} metrics of {len(folds)} folds: {results['avg']}")
+    return results
+
+
+def main(my_args=tuple(sys.argv[1:])):
+    parser = ArgumentParser(description="Recompute the metrics of a YAIB run from its stored predictions.")
+    parser.add_argument("run_dir", type=Path, help="Run directory, or any directory containing folds with predictions.")
+    parser.add_argument("-s", "--split", default="test", choices=["test", "val"], help="Split of the predictions.")
+    parser.add_argument("--curves", default=False, action=BOA, help="Also compute the curve metrics.")
+    args = parser.parse_args(my_args)
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s : %(message)s", level=logging.INFO)
+    recompute_metrics(args.run_dir, args.split, args.curves)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import logging
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+from pytorch_lightning import Trainer
+from torch.utils.data import DataLoader
+
+from icu_benchmarks.models.compilation import uncompiled
+from icu_benchmarks.models.ensemble import DLEnsembleWrapper, loop_forward
+from icu_benchmarks.models.wrappers import BaseModule
+
+# Layers whose weights are quantized to int8, their activations are quantized on the fly during inference.
+QUANTIZED_LAYERS = {nn.Linear, nn.LSTM, nn.GRU}
+# State of a test run, which is not copied to the quantized model. It may not be copyable, like an open prediction file.
+TEST_STATE = (
+    "bootstrap_outputs",
+    "bootstrap_stays",
+    "prediction_batches",
+    "prediction_path",
+    "prediction_stay_ids",
+    "prediction_writer",
+)
+
+
+def quantize_model(model: BaseModule) -> BaseModule:
+    """Returns a copy of a trained DL model with dynamically int8-quantized Linear, LSTM and GRU layers for CPU inference.
+
+    Args:
+        model: Trained model, which is moved to the CPU.
+
+    Returns:
+        The quantized copy of the model.
+    """
+    model = uncompiled(model)
+    # The trainer and the state of test runs are not copied with the model.
+    try:
+        trainer = model.trainer
+    except RuntimeError:
+        trainer = None
+    model.trainer = None
+    test_state = {name: model.__dict__.pop(name) for name in TEST_STATE if name in model.__dict__}
+    try:
+        quantized = torch.ao.quantization.quantize_dynamic(model.cpu(), QUANTIZED_LAYERS, dtype=torch.qint8)
+    finally:
+        model.trainer = trainer
+        model.__dict__.update(test_state)
+    if isinstance(quantized, DLEnsembleWrapper):
+        # The stacked computation of the members needs their float weights.
+        quantized.stacked_forward = loop_forward
+    return quantized
+
+
+def test_quantized(model: BaseModule, test_loader: DataLoader, loggers: list, log_dir: Path, verbose: bool = False) -> dict:
+    """Quantizes a trained DL model, saves it to model_quantized.ckpt and tests it on the CPU.
+
+    The test metrics are logged with the prefix test/quantized/, next to the metrics of the float model.
+
+    Args:
+        model: Trained model.
+        test_loader: Loader of the test set.
+        loggers: Loggers of the float model.
+        log_dir: Directory to save the quantized model to.
+        verbose: Whether to show the test progress and results.
+
+    Returns:
+        The test metrics of the quantized model.
+    """
+    # Quantized layers are initialized randomly before their weights are replaced and iterating the loader draws a seed, so
+    # the random state is forked to keep later folds as without the quantized test.
+    with torch.random.fork_rng(devices=[]):
+        quantized = quantize_model(model)
+        quantized.save_model(log_dir, "model_quantized")
+        trainer = Trainer(accelerator="cpu", devices=1, logger=False, enable_checkpointing=False, enable_progress_bar=verbose)
+        results = trainer.test(quantized, dataloaders=test_loader, verbose=verbose)[0]
+    results = {key.replace("test/", "test/quantized/", 1): value for key, value in results.items()}
+    for logger in loggers:
+        logger.log_metrics(results)
+    logging.info(f"Quantized model test loss: {results['test/quantized/loss']:.4f}.")
+    return results
@@ -1,21 +1,31 @@
-import os
+import math
 import gin
 import torch
 import logging
 import pandas as pd
 from joblib import load
 from torch.optim import Adam
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from pytorch_lightning.loggers import TensorBoardLogger, WandbLogger
 from pytorch_lightning import Trainer
+from pytorch_lightning.strategies import DDPStrategy
 from pytorch_lightning.callbacks import EarlyStopping, ModelCheckpoint, TQDMProgressBar, LearningRateMonitor
 from pathlib import Path
 from icu_benchmarks.data.loader import PredictionDataset, ImputationDataset
-from icu_benchmarks.models.utils import save_config_file, JSONMetricsLogger
+from icu_benchmarks.data.loader_tuning import autotune_dataloader
+from icu_benchmarks.models.callbacks import FullValidation, ThreadBudget, Throughput
+from icu_benchmarks.models.compilation import compile_model
+from icu_benchmarks.models.ensemble import DLEnsembleWrapper, create_ensemble
+from icu_benchmarks.models.predictions import PREDICTIONS_FILE, write_predictions
+from icu_benchmarks.models.quantization import test_quantized
+from icu_benchmarks.models.utils import save_config_file, JSONMetricsLogger, resolve_precision, set_matmul_precision
 from icu_benchmarks.contants import RunMode
 from icu_benchmarks.data.constants import DataSplit as Split
+from icu_benchmarks.thread_budget import apply_thread_budget, thread_budget
 
-cpu_core_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+# Checkpoints of a trained DL model in the order they are loaded, the best model is saved as model-v1.ckpt if model.ckpt
+# already exists.
+CHECKPOINT_NAMES = ("model.ckpt", "model-v1.ckpt", "last.ckpt")
 
 
 def assure_minimum_length(dataset):
@@ -24,6 +34,17 @@ def assure_minimum_length(dataset):
     return dataset
 
 
+def build_dataset(dataset_class, data, split, name, dataset_cache=None, **kwargs):
+    """Builds the dataset of a split, or reuses it if it was already built for another model trained on the same data."""
+    key = (dataset_class.__name__, split, name)
+    if dataset_cache is not None and key in dataset_cache:
+        return dataset_cache[key]
+    dataset = assure_minimum_length(dataset_class(data, split=split, name=name, **kwargs))
+    if dataset_cache is not None:
+        dataset_cache[key] = dataset
+    return dataset
+
+
 @gin.configurable("train_common")
 def train_common(
     data: dict[str, pd.DataFrame],
@@ -49,7 +70,19 @@ def train_common(
     ram_cache=False,
     pl_model=True,
     train_only=False,
-    num_workers: int = min(cpu_core_count, torch.cuda.device_count() * 8 * int(torch.cuda.is_available()), 32),
+    num_workers: int = None,
+    sanity_val_steps: int = 2,
+    val_interval: int = 1,
+    val_subsample: float = None,
+    dataset_cache: dict = None,
+    ensemble_size: int = 1,
+    ensemble_optimizer_params: list[dict] = None,
+    compile: bool = False,
+    compile_mode: str = "default",
+    cpu_processes: int = 1,
+    quantize: bool = False,
+    bootstrap: bool = False,
+    save_predictions: list[str] = (Split.test,),
 ):
     """Common wrapper to train all benchmarked models.
 
@@ -64,7 +97,9 @@ def train_common(
         model: Model to be trained.
         weight: Weight to be used for the loss function.
         optimizer: Optimizer to be used for training.
-        precision: Pytorch precision to be used for training. Can be 16 or 32.
+        precision: Pytorch precision to be used for training, e.g. 32, 16 or "bf16-mixed". 16-bit precision uses mixed
+            precision with float32 weights, with bfloat16 on the CPU. Devices without bfloat16 support train in float32.
+            Losses and metrics are computed in float32.
         batch_size: Batch size to be used for training.
         epochs: Number of epochs to train for.
         patience: Number of epochs to wait for improvement before early stopping.
@@ -75,18 +110,39 @@ def train_common(
         verbose: Enable detailed logging.
         ram_cache: Whether to cache the data in RAM.
         pl_model: Loading a pytorch lightning model.
-        num_workers: Number of workers to use for data loading.
+        num_workers: Number of workers to use for data loading. If None, the data loading settings are tuned automatically.
+        sanity_val_steps: Number of validation batches to run before training, -1 to run the full validation set.
+        val_interval: Validate every n epochs. The patience stays in epochs and is converted to validation runs.
+        val_subsample: If set, validate on a fixed, stratified fraction of the validation set after every interval and on the
+            full validation set only when the loss on the subsample improves. Early stopping monitors the subsample.
+        dataset_cache: Dict in which the built datasets are stored and reused, e.g. by several models trained on one fold.
+        ensemble_size: Number of instances of a DL model, initialized with consecutive seeds, that are trained together on
+            the same batches. Each instance has its own optimizer, early stopping, checkpoint and metrics.
+        ensemble_optimizer_params: Optimizer hyperparameters for each instance, e.g. [{"lr": 1e-3}, {"lr": 1e-4}], which
+            trains one instance per entry.
+        compile: If set to true, compile DL models with torch.compile, falling back to eager execution if it fails.
+        compile_mode: Compilation mode, e.g. "default", "reduce-overhead" or "max-autotune".
+        cpu_processes: Number of processes that train a DL model data-parallel on the CPU (DDP with the gloo backend), each
+            with an equal share of the cores. The batch size stays the total batch size of all processes.
+        quantize: If set to true, also test a copy of the DL model with dynamically int8-quantized layers on the CPU, which
+            is saved to model_quantized.ckpt. Its test metrics are logged with the prefix test/quantized/.
+        bootstrap: If set to true, write bootstrap confidence intervals of the test AUC and PR of binary classifiers to
+            test_metrics.json, resampling the test stays (see bootstrap_intervals).
+        save_predictions: Splits whose predictions are written to <split>_predictions.parquet, "test" and/or "val". The test
+            predictions are written while testing, the validation set is predicted by the final model after testing.
     """
 
     logging.info(f"Training model: {model.__name__}.")
     dataset_class = ImputationDataset if mode == RunMode.imputation else PredictionDataset
 
     logging.info(f"Logging to directory: {log_dir}.")
+    # Limits torch, BLAS and the ML models to the cores of this job, see thread_budget.
+    threads = thread_budget()
+    apply_thread_budget(threads)
     save_config_file(log_dir)  # We save the operative config before and also after training
 
-    train_dataset = dataset_class(data, split=Split.train, ram_cache=ram_cache, name=dataset_names["train"])
-    val_dataset = dataset_class(data, split=Split.val, ram_cache=ram_cache, name=dataset_names["val"])
-    train_dataset, val_dataset = assure_minimum_length(train_dataset), assure_minimum_length(val_dataset)
+    train_dataset = build_dataset(dataset_class, data, Split.train, dataset_names["train"], dataset_cache, ram_cache=ram_cache)
+    val_dataset = build_dataset(dataset_class, data, Split.val, dataset_names["val"], dataset_cache, ram_cache=ram_cache)
     batch_size = min(batch_size, len(train_dataset), len(val_dataset))
 
     if not eval_only:
@@ -94,58 +150,76 @@ def train_common(
             f"Training on {train_dataset.name} with {len(train_dataset)} samples and validating on {val_dataset.name} with"
             f" {len(val_dataset)} samples."
         )
-    logging.info(f"Using {num_workers} workers for data loading.")
-
-    train_loader = DataLoader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        num_workers=num_workers,
-        pin_memory=True,
-        drop_last=True,
-    )
-    val_loader = DataLoader(
-        val_dataset,
-        batch_size=batch_size,
-        shuffle=False,
-        num_workers=num_workers,
-        pin_memory=True,
-        drop_last=True,
-    )
 
-    data_shape = next(iter(train_loader))[0].shape
+    data_shape = train_dataset.get_input_shape(batch_size)
 
+    # Early stopping counts validation runs without improvement.
+    patience = math.ceil(patience / val_interval)
     if load_weights:
         model = load_model(model, source_dir, pl_model=pl_model)
     else:
-        model = model(optimizer=optimizer, input_size=data_shape, epochs=epochs, run_mode=mode)
+        model = create_model(
+            model,
+            ensemble_size,
+            ensemble_optimizer_params,
+            dict(patience=patience, min_delta=min_delta, log_dir=log_dir),
+            optimizer=optimizer,
+            input_size=data_shape,
+            epochs=epochs,
+            run_mode=mode,
+        )
+
+    use_cuda = torch.cuda.is_available() and not cpu
+    device = torch.device("cuda" if use_cuda else "cpu")
+    cpu_processes = cpu_processes if model.requires_backprop and not use_cuda else 1
+    # Each process loads its own share of every batch, so loading is parallel without workers by default.
+    batch_size = max(1, batch_size // cpu_processes)
+    num_workers = 0 if cpu_processes > 1 and num_workers is None else num_workers
+    if compile and model.requires_backprop and not eval_only:
+        model = compile_model(model, data_shape, mode=compile_mode, device=device)
+    loader_settings = choose_loader_settings(model, train_dataset, batch_size, num_workers, device, log_dir)
+    logging.info(f"Using {loader_settings['num_workers']} workers for data loading.")
+
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, drop_last=True, **loader_settings)
+    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, drop_last=True, **loader_settings)
 
     model.set_weight(weight, train_dataset)
     model.set_trained_columns(train_dataset.get_feature_names())
+    model.set_groupings(getattr(train_dataset, "groupings", {}))
     loggers = [TensorBoardLogger(log_dir), JSONMetricsLogger(log_dir)]
     if use_wandb:
         loggers.append(WandbLogger(save_dir=log_dir))
     callbacks = [
-        EarlyStopping(monitor="val/loss", min_delta=min_delta, patience=patience, strict=False, verbose=verbose),
         ModelCheckpoint(log_dir, filename="model", save_top_k=1, save_last=True),
         LearningRateMonitor(logging_interval="step"),
+        Throughput(),
     ]
+    if not isinstance(model, DLEnsembleWrapper):
+        # Ensemble members stop individually.
+        callbacks.insert(
+            0, EarlyStopping(monitor="val/loss", min_delta=min_delta, patience=patience, strict=False, verbose=verbose)
+        )
+    if val_subsample is not None and model.requires_backprop:
+        val_loader, full_validation = subsample_validation(val_dataset, val_loader, val_subsample, min_delta, loader_settings)
+        callbacks.extend(full_validation)
+    device_settings, device_callbacks = trainer_device_settings(model, cpu, cpu_processes, threads)
+    callbacks.extend(device_callbacks)
     if verbose:
         callbacks.append(TQDMProgressBar(refresh_rate=min(100, len(train_loader) // 2)))
-    if precision == 16 or "16-mixed":
-        torch.set_float32_matmul_precision("medium")
+    precision = resolve_precision(precision, use_cuda)
+    set_matmul_precision(precision)
 
     trainer = Trainer(
         max_epochs=epochs if model.requires_backprop else 1,
         callbacks=callbacks,
         precision=precision,
-        accelerator="auto" if not cpu else "cpu",
-        devices=max(torch.cuda.device_count(), 1),
+        **device_settings,
         deterministic="warn" if reproducible else False,
         benchmark=not reproducible,
         enable_progress_bar=verbose,
         logger=loggers,
-        num_sanity_val_steps=-1,
+        num_sanity_val_steps=sanity_val_steps,
+        check_val_every_n_epoch=val_interval,
         log_every_n_steps=5,
     )
     if not eval_only:
@@ -162,38 +236,141 @@ def train_common(
         logging.info("Finished training full model.")
         save_config_file(log_dir)
         return 0
-    test_dataset = dataset_class(data, split=test_on, name=dataset_names["test"])
-    test_dataset = assure_minimum_length(test_dataset)
+    if test_on == Split.val and dataset_names["test"] == dataset_names["val"]:
+        # Evaluating on the validation set, e.g. while tuning, reuses the already prepared dataset.
+        test_dataset = val_dataset
+    else:
+        test_dataset = build_dataset(dataset_class, data, test_on, dataset_names["test"], dataset_cache)
     logging.info(f"Testing on {test_dataset.name}  with {len(test_dataset)} samples.")
-    test_loader = (
-        DataLoader(
-            test_dataset,
-            batch_size=min(batch_size * 4, len(test_dataset)),
-            shuffle=False,
-            num_workers=num_workers,
-            pin_memory=True,
-            drop_last=True,
-        )
-        if model.requires_backprop
-        else DataLoader([test_dataset.to_tensor()], batch_size=1)
-    )
+    test_loader = build_test_loader(model, test_dataset, batch_size, cpu_processes, loader_settings)
 
     model.set_weight("balanced", train_dataset)
+    enable_test_outputs(model, test_dataset, log_dir, bootstrap, Split.test in save_predictions)
     test_loss = trainer.test(model, dataloaders=test_loader, verbose=verbose)[0]["test/loss"]
+    if quantize and model.requires_backprop:
+        test_quantized(model, test_loader, loggers, log_dir, verbose)
+    if Split.val in save_predictions and hasattr(val_dataset, "get_stay_ids"):
+        val_loader = build_test_loader(model, val_dataset, batch_size, 1, loader_settings)
+        val_path = log_dir / PREDICTIONS_FILE.format(split=Split.val)
+        write_predictions(
+            model, val_loader, val_path, val_dataset.get_stay_ids(), trainer_device_settings(model, cpu, threads=threads)[0]
+        )
     save_config_file(log_dir)
     return test_loss
 
 
+def create_model(model_class, ensemble_size=1, ensemble_optimizer_params=None, ensemble_kwargs=None, **kwargs):
+    """Creates a model, or an ensemble of instances of a DL model that are trained together."""
+    if (ensemble_size > 1 or ensemble_optimizer_params) and model_class.requires_backprop:
+        size = len(ensemble_optimizer_params) if ensemble_optimizer_params else ensemble_size
+        logging.info(f"Training an ensemble of {size} instances.")
+        return create_ensemble(model_class, size, ensemble_optimizer_params, **(ensemble_kwargs or {}), **kwargs)
+    return model_class(**kwargs)
+
+
+def choose_loader_settings(model, train_dataset, batch_size, num_workers, device, log_dir):
+    """Returns the DataLoader settings, which are tuned for DL models unless the number of workers is set."""
+    use_cuda = device.type == "cuda"
+    if num_workers is None and model.requires_backprop:
+        loader_settings = autotune_dataloader(
+            train_dataset,
+            batch_size,
+            step_fn=training_step_fn(model, device),
+            pin_memory=use_cuda,
+            name=type(model).__name__,
+            log_dir=log_dir,
+        )
+        model.cpu()
+        return loader_settings
+    num_workers = num_workers or 0
+    return {"num_workers": num_workers, "persistent_workers": num_workers > 0, "pin_memory": use_cuda}
+
+
+def build_test_loader(model, test_dataset, batch_size, cpu_processes, loader_settings):
+    """Builds the loader of the test set, ML models are tested on the whole set at once, which is its only batch."""
+    if not model.requires_backprop:
+        # Yields the dataset itself, so that ML models read its arrays without a round trip through torch.
+        return DataLoader([test_dataset], batch_size=None, collate_fn=lambda dataset: dataset)
+    return DataLoader(
+        test_dataset,
+        batch_size=min(batch_size * 4, max(1, len(test_dataset) // cpu_processes)),
+        shuffle=False,
+        # The last batch is kept, so that every stay is tested and its predictions are written.
+        drop_last=False,
+        # The test set is loaded only once, so workers are not kept alive.
+        **{**loader_settings, "persistent_workers": False},
+    )
+
+
+def enable_test_outputs(model, test_dataset, log_dir, bootstrap, save_predictions):
+    """Enables the bootstrap confidence intervals and the prediction file of the next test run, if they are requested."""
+    if bootstrap:
+        model.enable_bootstrap()
+    if save_predictions and hasattr(test_dataset, "get_stay_ids"):
+        model.enable_prediction_writer(log_dir / PREDICTIONS_FILE.format(split=Split.test), test_dataset.get_stay_ids())
+
+
+def trainer_device_settings(model, cpu, cpu_processes=1, threads=None):
+    """Returns the accelerator, devices and strategy of the trainer and the callbacks they need.
+
+    With several CPU processes, the model is trained data-parallel and the threads of the job are shared equally among the
+    processes.
+    """
+    if cpu_processes == 1:
+        devices = {"accelerator": "auto" if not cpu else "cpu", "devices": max(torch.cuda.device_count(), 1)}
+        return {**devices, "strategy": "auto"}, []
+    logging.info(f"Training data-parallel with {cpu_processes} CPU processes.")
+    # Forking avoids pickling the model and data. Stopped ensemble members do not contribute to the loss.
+    strategy = DDPStrategy(
+        process_group_backend="gloo", start_method="fork", find_unused_parameters=isinstance(model, DLEnsembleWrapper)
+    )
+    threads = max(1, (threads or thread_budget()) // cpu_processes)
+    return {"accelerator": "cpu", "devices": cpu_processes, "strategy": strategy}, [ThreadBudget(threads)]
+
+
+def subsample_validation(val_dataset, val_loader, fraction, min_delta, loader_settings):
+    """Creates a loader for a stratified subsample of the validation set and a callback that validates on the full set."""
+    if not hasattr(val_dataset, "get_subsample_indices"):
+        logging.warning("Validation subsampling is only supported for prediction datasets, validating on the full set.")
+        return val_loader, []
+    subsample = Subset(val_dataset, val_dataset.get_subsample_indices(fraction))
+    logging.info(f"Validating on a subsample of {len(subsample)} of {len(val_dataset)} samples.")
+    subsample_loader = DataLoader(
+        subsample, batch_size=min(val_loader.batch_size, len(subsample)), shuffle=False, drop_last=True, **loader_settings
+    )
+    return subsample_loader, [FullValidation(val_loader, min_delta=min_delta)]
+
+
+def training_step_fn(model, device):
+    """Returns a function that performs a forward and backward pass on a batch, without changing the model state."""
+    model.to(device)
+
+    def step(batch):
+        model.eval()
+        data = batch[0].float().to(device)
+        out = model(data)
+        out = out[0] if isinstance(out, tuple) else out
+        out.float().sum().backward()
+        model.zero_grad(set_to_none=True)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    return step
+
+
+def find_checkpoint(source_dir: Path) -> Path:
+    """Returns the checkpoint of the best model in a fold directory, or None if there is none."""
+    for name in CHECKPOINT_NAMES:
+        if (source_dir / name).exists():
+            return source_dir / name
+    return None
+
+
 def load_model(model, source_dir, pl_model=True):
     if source_dir.exists():
         if model.requires_backprop:
-            if (source_dir / "model.ckpt").exists():
-                model_path = source_dir / "model.ckpt"
-            elif (source_dir / "model-v1.ckpt").exists():
-                model_path = source_dir / "model-v1.ckpt"
-            elif (source_dir / "last.ckpt").exists():
-                model_path = source_dir / "last.ckpt"
-            else:
+            model_path = find_checkpoint(source_dir)
+            if model_path is None:
                 return Exception(f"No weights to load at path : {source_dir}")
             if pl_model:
                 model = model.load_from_checkpoint(model_path)
@@ -23,6 +23,55 @@ def save_config_file(log_dir):
         f.write(gin.operative_config_str())
 
 
+# Trainer precisions that compute in 16 bit and keep the weights in 32 bit.
+MIXED_PRECISIONS = ["16-mixed", "bf16-mixed"]
+
+
+def resolve_precision(precision: Union[int, str], use_cuda: bool) -> str:
+    """Returns the trainer precision for a configured precision and the device that is trained on.
+
+    Float16 autocast is not supported on the CPU, so 16-bit mixed precision uses bfloat16 there, which has the range of
+    float32 and needs no loss scaling. Mixed precision keeps float32 master weights. On devices without bfloat16 support,
+    bfloat16 precisions fall back to float32.
+
+    Args:
+        precision: Configured precision, e.g. 32, 16, "bf16" or a precision of the lightning trainer like "bf16-mixed".
+        use_cuda: Whether the model is trained on a GPU.
+
+    Returns:
+        Precision of the lightning trainer.
+    """
+    aliases = {"16": "16-mixed", "bf16": "bf16-mixed", "32": "32-true", "64": "64-true"}
+    precision = aliases.get(str(precision), str(precision))
+    if precision == "16-mixed" and not use_cuda:
+        logging.info("Float16 autocast is not supported on the CPU, using bfloat16 mixed precision.")
+        precision = "bf16-mixed"
+    bf16_supported = torch.cuda.is_bf16_supported() if use_cuda else cpu_supports_bf16()
+    if precision.startswith("bf16") and not bf16_supported:
+        logging.warning(f"The {'GPU' if use_cuda else 'CPU'} does not support bfloat16, using float32 precision.")
+        precision = "32-true"
+    return precision
+
+
+def cpu_supports_bf16() -> bool:
+    """Whether the CPU has bfloat16 instructions, without which bfloat16 autocast is emulated and slower than float32.
+
+    The instructions are read from /proc/cpuinfo, on other systems bfloat16 is assumed to be unsupported.
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpuinfo = f.read()
+    except OSError:
+        return False
+    # x86 CPUs with AVX-512 or AMX bfloat16 instructions, ARM CPUs list bf16 among their features.
+    return any(flag in cpuinfo.split() for flag in ("avx512_bf16", "amx_bf16", "bf16"))
+
+
+def set_matmul_precision(precision: str):
+    """Allows reduced precision (e.g. TF32) for float32 matrix multiplications only when training with mixed precision."""
+    torch.set_float32_matmul_precision("medium" if precision in MIXED_PRECISIONS else "highest")
+
+
 def create_optimizer(name: str, model: Module, lr: float, momentum: float = 0) -> Optimizer:
     """creates the specified optimizer with the given parameters
 
@@ -1,9 +1,15 @@
 import logging
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
 from typing import Dict, Any, List, Optional, Union
 
 import torchmetrics
 from sklearn.metrics import log_loss, mean_squared_error
+from sklearn.utils.validation import has_fit_parameter
+from threadpoolctl import threadpool_limits
 
 import torch
 from torch.nn import MSELoss, CrossEntropyLoss
@@ -16,12 +22,20 @@ import gin
 import numpy as np
 from ignite.exceptions import NotComputableError
 from icu_benchmarks.models.constants import ImputationInit
-from icu_benchmarks.models.utils import create_optimizer, create_scheduler
+from icu_benchmarks.models.utils import create_optimizer, create_scheduler, JSONMetricsLogger
 from joblib import dump
 from pytorch_lightning import LightningModule
 
 from icu_benchmarks.models.constants import MLMetrics, DLMetrics
+from icu_benchmarks.models.bootstrap import bootstrap_intervals
+from icu_benchmarks.models.custom_metrics import BinaryFairnessWrapper
+from icu_benchmarks.models.ml_metrics import evaluate_metrics
+from icu_benchmarks.models.predictions import PredictionWriter
 from icu_benchmarks.contants import RunMode
+from icu_benchmarks.thread_budget import model_thread_params, thread_budget
+
+# Target of the unlabeled time steps, which the classification losses ignore. This is the default of the torch losses.
+IGNORE_INDEX = -100
 
 gin.config.external_configurable(nn.functional.nll_loss, module="torch.nn.functional")
 gin.config.external_configurable(nn.functional.cross_entropy, module="torch.nn.functional")
@@ -40,8 +54,16 @@ class BaseModule(LightningModule):
     # Metrics to be logged
     metrics = {}
     trained_columns = None
+    # Number of groups of each grouping of the stays by sensitive attributes, for which subgroup metrics are computed
+    groupings = {}
     # Type of run mode
     run_mode = None
+    # Test labels, predictions and stays collected for bootstrap confidence intervals, None if these are not computed
+    bootstrap_outputs = None
+    # Parquet file that the predictions of the next test run are written to and the ids of the tested stays
+    prediction_path = None
+    prediction_stay_ids = None
+    prediction_writer = None
 
     def forward(self, *args, **kwargs):
         raise NotImplementedError()
@@ -58,6 +80,9 @@ class BaseModule(LightningModule):
     def set_trained_columns(self, columns: List[str]):
         self.trained_columns = columns
 
+    def set_groupings(self, groupings: Dict[str, int]):
+        self.groupings = groupings
+
     def set_weight(self, weight, *args, **kwargs):
         pass
 
@@ -76,8 +101,69 @@ class BaseModule(LightningModule):
     def on_validation_epoch_end(self) -> None:
         self.finalize_step("val")
 
+    def on_test_epoch_start(self) -> None:
+        if self.prediction_path is not None:
+            path = self.prediction_path
+            if self.trainer.world_size > 1:
+                # Each process writes the predictions of its share of the stays.
+                path = path.with_name(f"{path.stem}_rank{self.global_rank}{path.suffix}")
+            self.prediction_writer = PredictionWriter(path, self.prediction_stay_ids, self.run_mode)
+
     def on_test_epoch_end(self) -> None:
         self.finalize_step("test")
+        if self.bootstrap_outputs is not None:
+            self.log_bootstrap_intervals()
+        if self.prediction_writer is not None:
+            self.prediction_writer.close()
+            self.prediction_writer = self.prediction_path = self.prediction_stay_ids = None
+
+    def enable_prediction_writer(self, path: Path, stay_ids):
+        """Writes the predictions of the next test run to a Parquet file, see PredictionWriter.
+
+        Args:
+            path: Parquet file to write.
+            stay_ids: Ids of the stays of the tested dataset, in the order of the dataset.
+        """
+        self.prediction_path = Path(path)
+        self.prediction_stay_ids = stay_ids
+
+    def enable_bootstrap(self):
+        """Collects the test predictions to write bootstrap confidence intervals of the AUC and PR to test_metrics.json."""
+        self.bootstrap_outputs = []
+        self.bootstrap_stays = 0
+
+    def collect_bootstrap_outputs(self, label, pred, groups):
+        """Adds the labels, predicted probabilities of the positive class and stay indices of a test batch."""
+        self.bootstrap_outputs.append(
+            tuple(np.asarray(value.detach().cpu() if isinstance(value, Tensor) else value) for value in (label, pred, groups))
+        )
+
+    def log_bootstrap_intervals(self):
+        """Writes the bootstrap confidence intervals of the collected test predictions to the JSON metrics loggers."""
+        outputs = self.bootstrap_outputs
+        self.enable_bootstrap()
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            gathered = [None] * torch.distributed.get_world_size()
+            torch.distributed.all_gather_object(gathered, outputs)
+        else:
+            gathered = [outputs]
+        loggers = [logger for logger in self.loggers if isinstance(logger, JSONMetricsLogger)]
+        if not loggers or not self.trainer.is_global_zero:
+            return
+        labels, preds, groups = [], [], []
+        for process_outputs in gathered:
+            # Stay indices are only unique within a process.
+            offset = max(group.max() for group in groups) + 1 if groups else 0
+            for label, pred, group in process_outputs:
+                labels.append(label.ravel())
+                preds.append(pred)
+                groups.append(group.ravel() + offset)
+        if not preds or any(pred.ndim != 1 for pred in preds):
+            logging.warning("Bootstrap confidence intervals are only computed for binary classification.")
+            return
+        intervals = bootstrap_intervals(np.concatenate(labels), np.concatenate(preds), np.concatenate(groups))
+        for logger in loggers:
+            logger.log_metrics({"test/bootstrap_CI": intervals})
 
     def on_save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
         checkpoint["class"] = self.__class__
@@ -133,40 +219,43 @@ class DLWrapper(BaseModule, ABC):
         self.initialization_method = initialization_method
         self.scaler = None
 
-    def on_fit_start(self):
-        self.metrics = {
+    def build_metrics(self):
+        """Instantiates the metrics of each step type, metric classes and partially applied metrics are instantiated."""
+        return {
             step_name: {
-                metric_name: (metric() if isinstance(metric, type) else metric)
+                metric_name: (metric() if isinstance(metric, (type, partial)) else metric)
                 for metric_name, metric in self.set_metrics().items()
             }
             for step_name in ["train", "val", "test"]
         }
+
+    def on_fit_start(self):
+        self.metrics = self.build_metrics()
         return super().on_fit_start()
 
     def on_train_start(self):
-        self.metrics = {
-            step_name: {
-                metric_name: (metric() if isinstance(metric, type) else metric)
-                for metric_name, metric in self.set_metrics().items()
-            }
-            for step_name in ["train", "val", "test"]
-        }
+        self.metrics = self.build_metrics()
         return super().on_train_start()
 
+    def compute_metrics(self, step_prefix=""):
+        """Compute the metrics of a step type, except for curves, and reset them."""
+        values = {
+            f"{step_prefix}/{name}": metric.compute()
+            for name, metric in self.metrics[step_prefix].items()
+            if "_Curve" not in name
+        }
+        # Metrics that return several values, like the fairness of each pair of groups, are logged as one value each.
+        for name, value in list(values.items()):
+            if isinstance(value, dict):
+                values.update({f"{name}/{key}": group_value for key, group_value in values.pop(name).items()})
+        values = {name: np.float32(value) if isinstance(value, np.float64) else value for name, value in values.items()}
+        for metric in self.metrics[step_prefix].values():
+            metric.reset()
+        return values
+
     def finalize_step(self, step_prefix=""):
         try:
-            self.log_dict(
-                {
-                    f"{step_prefix}/{name}": (
-                        np.float32(metric.compute()) if isinstance(metric.compute(), np.float64) else metric.compute()
-                    )
-                    for name, metric in self.metrics[step_prefix].items()
-                    if "_Curve" not in name
-                },
-                sync_dist=True,
-            )
-            for metric in self.metrics[step_prefix].values():
-                metric.reset()
+            self.log_dict(self.compute_metrics(step_prefix), sync_dist=True)
         except (NotComputableError, ValueError):
             if step_prefix not in self._metrics_warning_printed:
                 self._metrics_warning_printed.add(step_prefix)
@@ -194,10 +283,7 @@ class DLWrapper(BaseModule, ABC):
         return optimizers
 
     def on_test_epoch_start(self) -> None:
-        self.metrics = {
-            step_name: {metric_name: metric() for metric_name, metric in self.set_metrics().items()}
-            for step_name in ["train", "val", "test"]
-        }
+        self.metrics = self.build_metrics()
         return super().on_test_epoch_start()
 
     def save_model(self, save_path, file_name, file_extension=".ckpt"):
@@ -214,6 +300,8 @@ class DLPredictionWrapper(DLWrapper):
     """Interface for Deep Learning models."""
 
     _supported_run_modes = [RunMode.classification, RunMode.regression]
+    # Dataset indices of the stays in the remaining test batches, while predictions are written
+    prediction_batches = None
 
     def __init__(
         self,
@@ -278,7 +366,7 @@ class DLPredictionWrapper(DLWrapper):
             # Binary classification
             if self.logit.out_features == 2:
                 self.output_transform = softmax_binary_output_transform
-                metrics = DLMetrics.BINARY_CLASSIFICATION
+                metrics = {**DLMetrics.BINARY_CLASSIFICATION, **self.fairness_metrics()}
             else:
                 # Multiclass classification
                 self.output_transform = softmax_multi_output_transform
@@ -295,14 +383,32 @@ class DLPredictionWrapper(DLWrapper):
                 value.to(self.device)
         return metrics
 
-    def step_fn(self, element, step_prefix=""):
-        """Perform a step in the DL prediction model training loop.
+    def fairness_metrics(self):
+        """Returns a fairness metric for each grouping of the stays, which computes the fairness between its groups."""
+        return {
+            f"Fairness_{name}": partial(BinaryFairnessWrapper, num_groups, group_index=index, group_name=name)
+            for index, (name, num_groups) in enumerate(self.groupings.items())
+        }
+
+    def compute_loss(self, element):
+        """Compute the loss of a batch.
 
         Args:
-            element (object):
-            step_prefix (str): Step type, by default: test, train, val.
+            element (object): Batch consisting of data, labels and optionally a mask.
+
+        Returns:
+            The loss, the predictions and targets of the labeled time steps, and the data.
         """
+        data, labels, mask = self.prepare_batch(element)
+        loss, prediction, target = self.loss_from_output(self(data), labels, mask)
+        return loss, prediction, target, data
+
+    def prepare_batch(self, element):
+        """Moves a batch consisting of data, labels and optionally a mask and group ids to the device.
 
+        Returns:
+            The data, labels and mask of the batch.
+        """
         if len(element) == 2:
             data, labels = element[0], element[1].to(self.device)
             if isinstance(data, list):
@@ -312,7 +418,7 @@ class DLPredictionWrapper(DLWrapper):
                 data = data.float().to(self.device)
             mask = torch.ones_like(labels).bool()
 
-        elif len(element) == 3:
+        elif len(element) in (3, 4):
             data, labels, mask = element[0], element[1].to(self.device), element[2].to(self.device)
             if isinstance(data, list):
                 for i in range(len(data)):
@@ -320,41 +426,108 @@ class DLPredictionWrapper(DLWrapper):
             else:
                 data = data.float().to(self.device)
         else:
-            raise Exception("Loader should return either (data, label) or (data, label, mask)")
-        out = self(data)
+            raise Exception("Loader should return either (data, label), (data, label, mask) or (data, label, mask, groups)")
+        return data, labels, mask
+
+    def loss_from_output(self, out, labels, mask):
+        """Compute the loss of the model output for the labeled time steps.
 
+        The loss is computed on the padded output, unlabeled time steps are ignored by the classification loss and weighted
+        with zero in the regression loss. Only the predictions and targets for the metrics are gathered, without gradients.
+
+        Returns:
+            The loss and the predictions and targets of the labeled time steps.
+        """
         # If aux_loss is present, it is returned as a tuple
         if len(out) == 2 and isinstance(out, tuple):
             out, aux_loss = out
         else:
             aux_loss = 0
-        # Get prediction and target
-        prediction = torch.masked_select(out, mask.unsqueeze(-1)).reshape(-1, out.shape[-1]).to(self.device)
-        target = torch.masked_select(labels, mask).to(self.device)
-
-        if prediction.shape[-1] > 1 and self.run_mode == RunMode.classification:
-            # Classification task
-            loss = self.loss(prediction, target.long(), weight=self.loss_weights.to(self.device)) + aux_loss
-            # Returns torch.long because negative log likelihood loss
+        # Losses and metrics are computed in full precision, also when the model is trained with mixed precision.
+        out = out.float().reshape(-1, out.shape[-1])
+        mask = mask.reshape(-1).to(out.device)
+        labels = labels.reshape(-1).to(out.device)
+
+        if out.shape[-1] > 1 and self.run_mode == RunMode.classification:
+            # Classification task, negative log likelihood losses expect the classes as torch.long
+            target = labels.long().masked_fill(~mask, IGNORE_INDEX)
+            weight = self.loss_weights.to(out.device) if self.loss_weights is not None else None
+            loss = self.loss(out, target, weight=weight, ignore_index=IGNORE_INDEX) + aux_loss
         elif self.run_mode == RunMode.regression:
-            # Regression task
-            loss = self.loss(prediction[:, 0], target.float()) + aux_loss
+            # Regression task, unlabeled time steps may hold NaN targets that would propagate through the gradient
+            target = labels.float().masked_fill(~mask, 0.0)
+            losses = self.loss(out[:, 0], target, reduction="none").masked_fill(~mask, 0.0)
+            loss = losses.sum() / mask.sum() + aux_loss
         else:
             raise ValueError(f"Run mode {self.run_mode} not yet supported. Please implement it.")
+
+        # Predictions and targets of the labeled time steps for the metrics
+        indices = mask.nonzero().squeeze(-1)
+        prediction = out.detach().index_select(0, indices)
+        target = labels.index_select(0, indices)
+        return loss, prediction, target
+
+    def prediction_groups(self, element):
+        """Returns the group ids of the predictions of the labeled time steps of a batch, or None if it has no groups."""
+        if len(element) < 4:
+            return None
+        mask = element[2]
+        stays = mask.reshape(len(mask), -1).nonzero()[:, 0]
+        return element[3].to(stays.device).index_select(0, stays)
+
+    def update_metrics(self, prediction, target, groups, step_prefix=""):
+        """Update the metrics of a step type with the predictions, targets and group ids of the predictions of a batch."""
         transformed_output = self.output_transform((prediction, target))
 
-        for key, value in self.metrics[step_prefix].items():
-            if isinstance(value, torchmetrics.Metric):
-                if key == "Binary_Fairness":
-                    feature_names = key.feature_helper(self.trainer)
-                    value.update(transformed_output[0], transformed_output[1], data, feature_names)
-                else:
-                    value.update(transformed_output[0], transformed_output[1])
+        for value in self.metrics[step_prefix].values():
+            if isinstance(value, BinaryFairnessWrapper):
+                if groups is not None:
+                    value.update(transformed_output[0], transformed_output[1], groups)
+            elif isinstance(value, torchmetrics.Metric):
+                value.update(transformed_output[0], transformed_output[1])
             else:
                 value.update(transformed_output)
+
+    def step_fn(self, element, step_prefix=""):
+        """Perform a step in the DL prediction model training loop.
+
+        Args:
+            element (object):
+            step_prefix (str): Step type, by default: test, train, val.
+        """
+        loss, prediction, target, _ = self.compute_loss(element)
+        self.update_metrics(prediction, target, self.prediction_groups(element), step_prefix)
+        if step_prefix == "test" and self.bootstrap_outputs is not None:
+            # Stays are numbered by their position in the test batches, the labeled time steps come in the order of the mask.
+            mask = element[2] if len(element) >= 3 else torch.ones_like(element[1]).bool()
+            stays = mask.reshape(len(mask), -1).nonzero()[:, 0] + self.bootstrap_stays
+            self.bootstrap_stays += len(mask)
+            pred, label = self.output_transform((prediction, target))
+            self.collect_bootstrap_outputs(label, pred, stays)
+        if step_prefix == "test" and self.prediction_writer is not None:
+            self.write_predictions(element, prediction, target)
         self.log(f"{step_prefix}/loss", loss, on_step=False, on_epoch=True, sync_dist=True)
         return loss
 
+    def on_test_epoch_start(self) -> None:
+        super().on_test_epoch_start()
+        if self.prediction_writer is not None:
+            # Dataset indices of the stays in each test batch, in the order the batches are tested.
+            self.prediction_batches = iter(self.trainer.test_dataloaders.batch_sampler)
+
+    def on_test_epoch_end(self) -> None:
+        super().on_test_epoch_end()
+        # The iterator cannot be copied, e.g. when the model is quantized after testing.
+        self.prediction_batches = None
+
+    def write_predictions(self, element, prediction, target):
+        """Writes the predictions of the labeled time steps of a test batch."""
+        mask = element[2] if len(element) >= 3 else torch.ones_like(element[1]).bool()
+        stays, time_steps = mask.reshape(len(mask), -1).nonzero().unbind(-1)
+        batch_indices = torch.as_tensor(next(self.prediction_batches))
+        pred, label = self.output_transform((prediction, target))
+        self.prediction_writer.write(batch_indices[stays.cpu()], time_steps, label, pred)
+
 
 @gin.configurable("MLWrapper")
 class MLWrapper(BaseModule, ABC):
@@ -363,7 +536,27 @@ class MLWrapper(BaseModule, ABC):
     requires_backprop = False
     _supported_run_modes = [RunMode.classification, RunMode.regression]
 
-    def __init__(self, *args, run_mode=RunMode.classification, loss=log_loss, patience=10, mps=False, **kwargs):
+    def __init__(
+        self,
+        *args,
+        run_mode=RunMode.classification,
+        loss=log_loss,
+        patience=10,
+        mps=False,
+        negative_sample_rate: float = None,
+        predict_chunk_size: int = 2**16,
+        **kwargs,
+    ):
+        """Interface for prediction with traditional Scikit-learn-like Machine Learning models.
+
+        Args:
+            negative_sample_rate: If set, classifiers are trained on all positive labels and this fraction of the negative
+                labels of each stay, which are weighted to represent the negative labels of the full training data (see
+                PredictionDataset.get_negative_subsample). Meant for tasks with a label per hour, the validation and test
+                sets are not subsampled.
+            predict_chunk_size: Number of rows the test set is predicted in at once, the chunks are predicted in parallel
+                on the threads of the budget (see predict_in_chunks).
+        """
         super().__init__()
         self.save_hyperparameters()
         self.scaler = None
@@ -372,6 +565,8 @@ class MLWrapper(BaseModule, ABC):
         self.loss = loss
         self.patience = patience
         self.mps = mps
+        self.negative_sample_rate = negative_sample_rate
+        self.predict_chunk_size = predict_chunk_size
 
     def set_metrics(self, labels):
         if self.run_mode == RunMode.classification:
@@ -409,20 +604,37 @@ class MLWrapper(BaseModule, ABC):
         if "class_weight" in self.model.get_params().keys():  # Set class weights
             self.model.set_params(class_weight=self.weight)
 
-        val_loss = self.fit_model(train_rep, train_label, val_rep, val_label)
+        train_weight = None
+        if self.negative_sample_rate is not None and self.run_mode == RunMode.classification:
+            indices, train_weight = train_dataset.get_negative_subsample(self.negative_sample_rate)
+            logging.info(f"Training on {len(indices)} of {len(train_label)} labels with subsampled negative labels.")
+            train_rep, train_label = train_rep[indices], train_label[indices]
+            val_loss = self.fit_model(train_rep, train_label, val_rep, val_label, train_weight)
+        else:
+            val_loss = self.fit_model(train_rep, train_label, val_rep, val_label)
 
         train_pred = self.predict(train_rep)
 
         logging.debug(f"Model:{self.model}")
-        self.log("train/loss", self.loss(train_label, train_pred), sync_dist=True)
-        logging.debug(f"Train loss: {self.loss(train_label, train_pred)}")
+        # The training loss on subsampled labels is weighted like the training, the metrics are computed on the subsample.
+        if train_weight is not None:
+            train_loss = self.loss(train_label, train_pred, sample_weight=train_weight)
+        else:
+            train_loss = self.loss(train_label, train_pred)
+        self.log("train/loss", train_loss, sync_dist=True)
+        logging.debug(f"Train loss: {train_loss}")
         self.log("val/loss", val_loss, sync_dist=True)
         logging.debug(f"Val loss: {val_loss}")
         self.log_metrics(train_label, train_pred, "train")
 
-    def fit_model(self, train_data, train_labels, val_data, val_labels):
+    def fit_model(self, train_data, train_labels, val_data, val_labels, train_weights=None):
         """Fit the model to the training data (default SKlearn syntax)"""
-        self.model.fit(train_data, train_labels)
+        if train_weights is not None and has_fit_parameter(self.model, "sample_weight"):
+            self.model.fit(train_data, train_labels, sample_weight=train_weights)
+        else:
+            if train_weights is not None:
+                logging.warning(f"{type(self.model).__name__} does not support sample weights, training without them.")
+            self.model.fit(train_data, train_labels)
         val_loss = 0.0
         return val_loss
 
@@ -438,17 +650,30 @@ class MLWrapper(BaseModule, ABC):
         self.log_metrics(val_label, val_pred, "val")
 
     def test_step(self, dataset, _):
-        test_rep, test_label = dataset
-        test_rep, test_label = test_rep.squeeze().cpu().numpy(), test_label.squeeze().cpu().numpy()
+        """Tests on a whole dataset, which the test loader yields as its only batch."""
+        test_rep, test_label = dataset.get_data_and_labels()
+        if self.mps:
+            test_rep, test_label = test_rep.astype(np.float32), test_label.astype(np.float32)
         self.set_metrics(test_label)
-        test_pred = self.predict(test_rep)
+        test_pred = self.predict_in_chunks(test_rep)
+        has_stays = hasattr(dataset, "get_stay_indices")
+        if self.bootstrap_outputs is not None and has_stays:
+            stays = dataset.get_stay_indices()
+            self.collect_bootstrap_outputs(self.label_transform(test_label), self.output_transform(test_pred), stays)
+        if self.prediction_writer is not None and has_stays:
+            # Multiclass predictions are written as class probabilities.
+            scores = test_pred if test_pred.ndim == 2 and test_pred.shape[1] > 2 else self.output_transform(test_pred)
+            self.prediction_writer.write(
+                dataset.get_stay_indices(), dataset.get_time_steps(), self.label_transform(test_label), scores
+            )
 
+        # The batch is a dataset, from which Lightning cannot infer the batch size.
         if self.mps:
-            self.log("test/loss", np.float32(self.loss(test_label, test_pred)), sync_dist=True)
-            self.log_metrics(np.float32(test_label), np.float32(test_pred), "test")
+            self.log("test/loss", np.float32(self.loss(test_label, test_pred)), sync_dist=True, batch_size=1)
+            self.log_metrics(np.float32(test_label), np.float32(test_pred), "test", batch_size=1)
         else:
-            self.log("test/loss", self.loss(test_label, test_pred), sync_dist=True)
-            self.log_metrics(test_label, test_pred, "test")
+            self.log("test/loss", self.loss(test_label, test_pred), sync_dist=True, batch_size=1)
+            self.log_metrics(test_label, test_pred, "test", batch_size=1)
         logging.debug(f"Test loss: {self.loss(test_label, test_pred)}")
 
     def predict(self, features):
@@ -457,21 +682,38 @@ class MLWrapper(BaseModule, ABC):
         else:  # Classification: return probabilities
             return self.model.predict_proba(features)
 
-    def log_metrics(self, label, pred, metric_type):
-        """Log metrics to the PL logs."""
+    def predict_in_chunks(self, features):
+        """Predicts the features in chunks of predict_chunk_size rows, which are spread over the threads of the budget.
+
+        The models copy and convert their input while predicting, which is bounded by the chunk size for large test sets.
+        Each chunk is predicted by a single thread of the model, BLAS and OpenMP, so the pool does not oversubscribe the
+        cores.
+        """
+        size = self.predict_chunk_size
+        if len(features) <= size:
+            return self.predict(features)
+        chunks = np.array_split(features, range(size, len(features), size))
+        threads = min(thread_budget(), len(chunks))
+        logging.debug(f"Predicting {len(features)} rows in {len(chunks)} chunks on {threads} threads.")
+        with self.model_threads(1), threadpool_limits(limits=1), ThreadPoolExecutor(max_workers=threads) as executor:
+            return np.concatenate(list(executor.map(self.predict, chunks)))
+
+    @contextmanager
+    def model_threads(self, threads: int):
+        """Temporarily sets the number of threads of the model, if its parameters include one."""
+        params = self.model.get_params() if hasattr(self.model, "get_params") else {}
+        original = {name: params[name] for name in model_thread_params(type(self.model), threads) if name in params}
+        self.model.set_params(**{name: threads for name in original})
+        try:
+            yield
+        finally:
+            self.model.set_params(**original)
 
+    def log_metrics(self, label, pred, metric_type, batch_size=None):
+        """Log the scalar metrics to the PL logs, the transforms are applied and the metrics computed once."""
+        values = evaluate_metrics(self.metrics, self.label_transform(label), self.output_transform(pred))
         self.log_dict(
-            {
-                # MPS dependent type casting
-                f"{metric_type}/{name}": metric(self.label_transform(label), self.output_transform(pred))
-                if not self.mps
-                else metric(self.label_transform(label), self.output_transform(pred))
-                # Fore very metric
-                for name, metric in self.metrics.items()
-                # Filter out metrics that return a tuple (e.g. precision_recall_curve)
-                if not isinstance(metric(self.label_transform(label), self.output_transform(pred)), tuple)
-            },
-            sync_dist=True,
+            {f"{metric_type}/{name}": value for name, value in values.items()}, sync_dist=True, batch_size=batch_size
         )
 
     def configure_optimizers(self):
@@ -492,11 +734,14 @@ class MLWrapper(BaseModule, ABC):
             logging.error(f"Cannot save model to path {str(path.resolve())}: {e}.")
 
     def set_model_args(self, model, *args, **kwargs):
-        """Set hyperparameters of the model if they are supported by the model."""
+        """Set hyperparameters of the model if they are supported by the model.
+
+        The number of threads of the model is set to the thread budget, unless it is passed.
+        """
         signature = inspect.signature(model.__init__).parameters
         possible_hps = list(signature.keys())
         # Get passed keyword arguments
-        arguments = locals()["kwargs"]
+        arguments = {**model_thread_params(model, thread_budget()), **kwargs}
         # Get valid hyperparameters
         hyperparams = {key: value for key, value in arguments.items() if key in possible_hps}
         logging.debug(f"Creating model with: {hyperparams}.")
@@ -9,6 +9,7 @@ from icu_benchmarks.wandb_utils import update_wandb_config, apply_wandb_sweep, s
 from icu_benchmarks.tuning.hyperparameters import choose_and_bind_hyperparameters
 from scripts.plotting.utils import plot_aggregated_results
 from icu_benchmarks.cross_validation import execute_repeated_cv
+from icu_benchmarks.models.ml_models import bind_dataset_cache, remove_dataset_cache
 from icu_benchmarks.run_utils import (
     build_parser,
     create_run_dir,
@@ -39,6 +40,8 @@ def main(my_args=tuple(sys.argv[1:])):
     date_format = "%Y-%m-%d %H:%M:%S"
     verbose = args.verbose
     setup_logging(date_format, log_format, verbose)
+    # Bound like the hyperparameters, so that they also apply to every model trained with --models.
+    args.hyperparams = [*(args.hyperparams or []), *training_bindings(args)]
     # Get arguments
     data_dir = Path(args.data_dir)
     name = args.name
@@ -94,6 +97,10 @@ def main(my_args=tuple(sys.argv[1:])):
     if args.preprocessor:
         import_preprocessor(args.preprocessor)
 
+    if args.models:
+        run_models(args, data_dir, name, mode, pretrained_imputation_model)
+        return
+
     # Load pretrained model in evaluate mode or when finetuning
     if load_weights:
         if args.source_dir is None:
@@ -107,27 +114,26 @@ def main(my_args=tuple(sys.argv[1:])):
         source_dir = args.source_dir
         logging.info(f"Will load weights from {source_dir} and bind train gin-config. Note: this might override your config.")
         gin.parse_config_file(source_dir / "train_config.gin")
+        gin.parse_config(training_bindings(args))
+        bind_dataset_cache(run_dir)
     elif args.samples and args.source_dir is not None:  # Train model with limited samples and bind existing config
         logging.info("Binding train gin-config. Note: this might override your config.")
         gin.parse_config_file(args.source_dir / "train_config.gin")
         log_dir /= f"samples_{args.fine_tune}"
         name_datasets(args.name, args.name, args.name)
         run_dir = create_run_dir(log_dir)
+        bind_dataset_cache(run_dir)
     else:
         # Normal train and evaluate
         name_datasets(args.name, args.name, args.name)
         hp_checkpoint = log_dir / args.hp_checkpoint if args.hp_checkpoint else None
-        model_path = (
-                Path("configs") / ("imputation_models" if mode == RunMode.imputation else "prediction_models") / f"{model}.gin"
-        )
         gin_config_files = (
-            [Path(f"configs/experiments/{args.experiment}.gin")]
-            if args.experiment
-            else [model_path, Path(f"configs/tasks/{task}.gin")]
+            [Path(f"configs/experiments/{args.experiment}.gin")] if args.experiment else get_config_files(model, task, mode)
         )
         gin.parse_config_files_and_bindings(gin_config_files, args.hyperparams, finalize_config=False)
         log_full_line(f"Data directory: {data_dir.resolve()}", level=logging.INFO)
         run_dir = create_run_dir(log_dir)
+        bind_dataset_cache(run_dir)
         choose_and_bind_hyperparameters(
             args.tune,
             data_dir,
@@ -174,11 +180,114 @@ def main(my_args=tuple(sys.argv[1:])):
     log_full_line("FINISHED TRAINING", level=logging.INFO, char="=", num_newlines=3)
     execution_time = datetime.now() - start_time
     log_full_line(f"DURATION: {execution_time}", level=logging.INFO, char="")
+    # Every directory in the run directory is aggregated as a repetition.
+    remove_dataset_cache(run_dir)
     aggregate_results(run_dir, execution_time)
     if args.plot:
         plot_aggregated_results(run_dir, "aggregated_test_metrics.json")
 
 
+def training_bindings(args) -> list[str]:
+    """Returns the gin bindings of the command line options that configure the training of each model."""
+    bindings = []
+    if args.threads is not None:
+        bindings.append(f"thread_budget.threads={args.threads}")
+    if args.cpu_processes is not None:
+        bindings.append(f"train_common.cpu_processes={args.cpu_processes}")
+    if args.quantize:
+        bindings.append("train_common.quantize=True")
+    if args.bootstrap:
+        bindings.append("train_common.bootstrap=True")
+    if args.save_predictions is not None:
+        bindings.append(f"train_common.save_predictions={args.save_predictions}")
+    return bindings
+
+
+def get_config_files(model: str, task: str, mode: RunMode) -> list[Path]:
+    """Returns the gin config files of a model and a task."""
+    model_dir = "imputation_models" if mode == RunMode.imputation else "prediction_models"
+    return [Path("configs") / model_dir / f"{model}.gin", Path(f"configs/tasks/{task}.gin")]
+
+
+def run_models(args, data_dir: Path, name: str, mode: RunMode, pretrained_imputation_model: object = None):
+    """Tunes several models with their own gin configs and trains them on the same preprocessed folds.
+
+    Every model is logged in its usual log directory, as if it was trained on its own.
+
+    Args:
+        args: Parsed command line arguments.
+        data_dir: Path to the data directory.
+        name: Name of the dataset.
+        mode: Run mode of the task.
+        pretrained_imputation_model: Pretrained imputation model to use in preprocessing.
+    """
+    if args.eval or args.fine_tune is not None or args.samples is not None or args.experiment:
+        raise ValueError("Training multiple models is only supported for training and tuning from the model configs.")
+    task_name = args.task_name if args.task_name is not None else args.task
+    model_runs = {}
+    for model in args.models:
+        log_full_line(f"PREPARING {model}", level=logging.INFO, char="=")
+        gin.clear_config()
+        gin.parse_config_files_and_bindings(get_config_files(model, args.task, mode), args.hyperparams, finalize_config=False)
+        name_datasets(name, name, name)
+        log_dir = args.log_dir / name / task_name / model
+        run_dir = create_run_dir(log_dir)
+        bind_dataset_cache(run_dir)
+        choose_and_bind_hyperparameters(
+            args.tune,
+            data_dir,
+            run_dir,
+            args.seed,
+            run_mode=mode,
+            checkpoint=log_dir / args.hp_checkpoint if args.hp_checkpoint else None,
+            debug=args.debug,
+            generate_cache=args.generate_cache,
+            load_cache=args.load_cache,
+            verbose=args.verbose,
+        )
+        model_runs[model] = {
+            "config": gin.config_str(),
+            "run_dir": run_dir,
+            "generate_features": uses_generated_features(),
+        }
+
+    log_full_line(f"STARTING TRAINING OF {len(model_runs)} MODELS", level=logging.INFO, char="=", num_newlines=3)
+    start_time = datetime.now()
+    execute_repeated_cv(
+        data_dir,
+        None,
+        args.seed,
+        reproducible=args.reproducible,
+        debug=args.debug,
+        verbose=args.verbose,
+        load_cache=args.load_cache,
+        generate_cache=args.generate_cache,
+        mode=mode,
+        pretrained_imputation_model=pretrained_imputation_model,
+        cpu=args.cpu,
+        complete_train=args.complete_train,
+        model_runs=model_runs,
+    )
+    log_full_line("FINISHED TRAINING", level=logging.INFO, char="=", num_newlines=3)
+    execution_time = datetime.now() - start_time
+    log_full_line(f"DURATION: {execution_time}", level=logging.INFO, char="")
+    for run in model_runs.values():
+        remove_dataset_cache(run["run_dir"])
+        aggregate_results(run["run_dir"], execution_time)
+        if args.plot:
+            plot_aggregated_results(run["run_dir"], "aggregated_test_metrics.json")
+
+
+def uses_generated_features() -> bool:
+    """Whether the bound preprocessor generates features from the dynamic data, as configured for ML models."""
+    try:
+        preprocessor = gin.query_parameter("preprocess.preprocessor").selector
+        return gin.query_parameter(f"{preprocessor}.generate_features")
+    except ValueError:
+        # Not bound, the preprocessors generate features by default.
+        return True
+
+
 """Main module."""
 if __name__ == "__main__":
     main()
@@ -30,11 +30,19 @@ def build_parser() -> ArgumentParser:
     parser.add_argument("-n", "--name", help="Name of the (target) dataset.")
     parser.add_argument("-tn", "--task-name", help="Name of the task, used for naming experiments.")
     parser.add_argument("-m", "--model", default="LGBMClassifier", help="Name of the model gin.")
+    parser.add_argument("--models", nargs="+", help="Names of model gins to train on the same preprocessed folds.")
     parser.add_argument("-e", "--experiment", help="Name of the experiment gin.")
     parser.add_argument("-l", "--log-dir", default=Path("../yaib_logs/"), type=Path, help="Log directory for model weights.")
     parser.add_argument("-s", "--seed", default=1234, type=int, help="Random seed for processing, tuning and training.")
     parser.add_argument("-v", "--verbose", default=False, action=BOA, help="Set to log verbosly. Disable for clean logs.")
     parser.add_argument("--cpu", default=False, action=BOA, help="Set to use CPU.")
+    parser.add_argument("--threads", type=int, help="Number of cores of the run, shared by its parallel jobs.")
+    parser.add_argument("--cpu-processes", type=int, help="Number of processes for data-parallel training on the CPU.")
+    parser.add_argument("--quantize", default=False, action=BOA, help="Also test an int8-quantized copy of DL models.")
+    parser.add_argument("--bootstrap", default=False, action=BOA, help="Write bootstrap CIs of the test AUC and PR.")
+    parser.add_argument(
+        "--save-predictions", nargs="*", choices=["test", "val"], help="Splits to write predictions of, none to disable."
+    )
     parser.add_argument("-db", "--debug", default=False, action=BOA, help="Set to load less data.")
     parser.add_argument("--reproducible", default=True, action=BOA, help="Make torch reproducible.")
     parser.add_argument("-lc", "--load_cache", default=False, action=BOA, help="Set to load generated data cache.")
@@ -223,7 +231,9 @@ def setup_logging(date_format, log_format, verbose):
     logging.basicConfig(format=log_format, datefmt=date_format)
     loggers = ["pytorch_lightning", "lightning_fabric"]
     for logger in loggers:
-        logging.getLogger(logger).handlers[0].setFormatter(logging.Formatter(log_format, datefmt=date_format))
+        # Lightning does not add its handlers if the root logger already has some, e.g. when run by pytest.
+        for handler in logging.getLogger(logger).handlers[:1]:
+            handler.setFormatter(logging.Formatter(log_format, datefmt=date_format))
 
     if not verbose:
         logging.getLogger().setLevel(logging.INFO)
@@ -0,0 +1,37 @@
+import inspect
+import logging
+import os
+
+import gin
+import torch
+from threadpoolctl import threadpool_limits
+
+cpu_core_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+# Constructor parameters through which the supported model libraries set their number of threads.
+MODEL_THREAD_PARAMS = ("n_jobs", "num_threads", "nthread", "thread_count")
+
+
+@gin.configurable("thread_budget")
+def thread_budget(threads: int = None) -> int:
+    """Returns the number of cores a job may use, by default all cores available to the process.
+
+    Jobs that run in parallel, like data-parallel training processes and tuning workers, share the budget equally.
+
+    Args:
+        threads: Number of cores of the job.
+    """
+    return max(1, threads) if threads is not None else cpu_core_count
+
+
+def apply_thread_budget(threads: int):
+    """Limits the intra-op threads of torch and the threads of the BLAS and OpenMP libraries of this process."""
+    torch.set_num_threads(threads)
+    threadpool_limits(limits=threads)
+    logging.debug(f"Limited process {os.getpid()} to {threads} threads.")
+
+
+def model_thread_params(model_class, threads: int) -> dict:
+    """Returns the keyword arguments that set the number of threads of a model, if its constructor supports them."""
+    signature = inspect.signature(model_class.__init__).parameters
+    return {name: threads for name in MODEL_THREAD_PARAMS if name in signature}
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import gin
+
+import icu_benchmarks
+from icu_benchmarks.models.utils import JsonResultLoggingEncoder
+
+# Settings of the tuner, of the threads, of the caches and of the outputs of a run do not influence the loss of a
+# configuration and are left out of the cache key. Tuning workers rebind their share of the thread budget.
+EXCLUDED_CONFIGURABLES = ["tune_hyperparameters", "fold_pruning", "thread_budget", "bootstrap", "lightgbm_dataset_cache"]
+EXCLUDED_PARAMETERS = ["train_common.quantize", "train_common.bootstrap", "train_common.save_predictions"]
+
+
+class EvaluationCache:
+    """Persistent cache of the losses of evaluated hyperparameter configurations.
+
+    Every entry is stored as a separate JSON file, so concurrent tuning workers and runs can share the cache without
+    locking. Entries are keyed by a hash of the gin bindings that can influence the loss (see config_fingerprint), a
+    fingerprint of the data directory, the version and source code of the package (see fingerprint_code), the number of
+    tuning folds and the seed. Changing the code of the package, e.g. of a model, invalidates all entries, whereas changes
+    of the installed libraries, e.g. of torch or LightGBM, are not detected.
+
+    Args:
+        cache_dir: Directory holding the cache entries.
+        data_dir: Path to the data directory.
+        folds: Number of folds the configurations are evaluated on.
+        seed: Random seed.
+        debug: Whether less data is loaded.
+    """
+
+    def __init__(self, cache_dir: Path, data_dir: Path, folds: int, seed: int, debug: bool = False):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.folds = folds
+        self.seed = seed
+        self.debug = debug
+        self.data_fingerprint = fingerprint_data_dir(data_dir)
+        self.code_fingerprint = fingerprint_code()
+
+    def key(self, hyperparams_names: list[str], hyperparams: list) -> str:
+        """Returns the cache key for a configuration, assuming its hyperparameters are bound to gin."""
+        content = {
+            "hyperparameters": dict(zip(hyperparams_names, hyperparams)),
+            "config": config_fingerprint(),
+            "data": self.data_fingerprint,
+            "code": self.code_fingerprint,
+            "folds": self.folds,
+            "seed": self.seed,
+            "debug": self.debug,
+        }
+        content = json.dumps(content, cls=JsonResultLoggingEncoder, sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> float:
+        """Returns the cached loss for a key or None if the configuration was not evaluated yet."""
+        entry_path = self.cache_dir / f"{key}.json"
+        if not entry_path.exists():
+            return None
+        try:
+            with open(entry_path, "r") as f:
+                return json.load(f)["loss"]
+        except (json.decoder.JSONDecodeError, KeyError):
+            logging.warning(f"Ignoring corrupt evaluation cache entry {entry_path}.")
+            return None
+
+    def put(self, key: str, hyperparams_names: list[str], hyperparams: list, loss: float):
+        """Stores the loss of a configuration."""
+        entry = {"hyperparameters": dict(zip(hyperparams_names, hyperparams)), "loss": loss}
+        # Write to a temporary file first, so that readers never see partially written entries.
+        with tempfile.NamedTemporaryFile("w", dir=self.cache_dir, suffix=".tmp", delete=False) as f:
+            json.dump(entry, f, cls=JsonResultLoggingEncoder)
+        os.replace(f.name, self.cache_dir / f"{key}.json")
+
+
+def config_fingerprint() -> str:
+    """Returns the bindings of the gin configuration that can influence the loss, without comments."""
+    excluded = tuple([f"{name}." for name in EXCLUDED_CONFIGURABLES] + [f"{name} " for name in EXCLUDED_PARAMETERS])
+    bindings, skip = [], False
+    for line in gin.config_str().splitlines():
+        if not line.strip() or line.startswith("#"):
+            continue
+        # Values that span several lines continue on indented lines.
+        if not line[0].isspace():
+            skip = line.startswith(excluded)
+        if not skip:
+            bindings.append(line)
+    return "\n".join(bindings)
+
+
+def fingerprint_data_dir(data_dir: Path) -> list:
+    """Fingerprints the data files in a directory by their names, sizes and modification times."""
+    return [
+        (path.name, path.stat().st_size, path.stat().st_mtime_ns)
+        for path in sorted(Path(data_dir).iterdir())
+        if path.is_file()
+    ]
+
+
+def fingerprint_code(package_dir: Path = Path(icu_benchmarks.__file__).parent) -> str:
+    """Fingerprints the version of the package and the contents of its Python source files."""
+    digest = hashlib.sha256(icu_benchmarks.__version__.encode("utf-8"))
+    for path in sorted(package_dir.rglob("*.py")):
+        digest.update(path.relative_to(package_dir).as_posix().encode("utf-8"))
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
@@ -1,17 +1,26 @@
-import json
+import copy
 import gin
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from logging import NOTSET
 import numpy as np
 from pathlib import Path
-from skopt import gp_minimize
+from skopt import gp_minimize, Optimizer
+from skopt.utils import cook_estimator, create_result, normalize_dimensions
+from sklearn.utils import check_random_state
 import tempfile
 
-from icu_benchmarks.models.utils import JsonResultLoggingEncoder, log_table_row, Align
+from icu_benchmarks.models.utils import log_table_row, Align
 from icu_benchmarks.cross_validation import execute_repeated_cv
 from icu_benchmarks.run_utils import log_full_line
 from icu_benchmarks.tuning.gin_utils import get_gin_hyperparameters, bind_gin_params
+from icu_benchmarks.tuning.pruning import FoldPruner
+from icu_benchmarks.tuning.evaluation_cache import EvaluationCache
+from icu_benchmarks.tuning.journal import LEGACY_CHECKPOINT_FILE, TuningJournal, read_journal
+from icu_benchmarks.tuning.warm_start import collect_warm_start_points
 from icu_benchmarks.contants import RunMode
+from icu_benchmarks.thread_budget import apply_thread_budget, thread_budget
 from icu_benchmarks.wandb_utils import wandb_log
 
 TUNE = 25
@@ -30,12 +39,17 @@ def choose_and_bind_hyperparameters(
     n_initial_points: int = 3,
     n_calls: int = 20,
     folds_to_tune_on: int = None,
-    checkpoint_file: str = "hyperparameter_tuning_logs.json",
+    checkpoint_file: str = "hyperparameter_tuning_logs.jsonl",
     generate_cache: bool = False,
     load_cache: bool = False,
     debug: bool = False,
     verbose: bool = False,
     wandb: bool = False,
+    prune_folds: bool = False,
+    n_parallel: int = 1,
+    evaluation_cache: bool = False,
+    evaluation_cache_dir: str = "hyperparameter_evaluation_cache",
+    warm_start: bool = False,
 ):
     """Choose hyperparameters to tune and bind them to gin.
 
@@ -53,9 +67,17 @@ def choose_and_bind_hyperparameters(
         n_initial_points: Number of initial points to explore.
         n_calls: Number of iterations to optimize the hyperparameters.
         folds_to_tune_on: Number of folds to tune on.
-        checkpoint_file: Name of the checkpoint file.
+        checkpoint_file: Name of the tuning journal, which is also used as checkpoint.
         debug: Whether to load less data.
         verbose: Set to true to increase log output.
+        prune_folds: Stop evaluating configurations early if their first folds perform poorly (see fold_pruning).
+        n_parallel: Number of configurations to propose per round and evaluate concurrently in separate processes.
+        evaluation_cache: Reuse the losses of configurations that were already evaluated on the same data, by the same
+            code of the package. Entries are invalidated when the code changes, but not when the installed libraries
+            change, so the cache is opt-in.
+        evaluation_cache_dir: Name of the cache directory, shared by all runs with the same dataset, task and model.
+        warm_start: Replace the random initial points by the best configurations of other datasets and tasks that were
+            tuned for the same model in the same log directory.
 
     Raises:
         ValueError: If checkpoint is not None and the checkpoint does not exist.
@@ -76,11 +98,7 @@ def choose_and_bind_hyperparameters(
     # Attempt checkpoint loading
     configuration, evaluation = None, None
     if checkpoint:
-        checkpoint_path = checkpoint / checkpoint_file
-        if not checkpoint_path.exists():
-            logging.warning(f"Hyperparameter checkpoint {checkpoint_path} does not exist.")
-            logging.info("Attempting to find latest checkpoint file.")
-            checkpoint_path = find_checkpoint(log_dir.parent, checkpoint_file)
+        checkpoint_path = resolve_checkpoint(checkpoint, log_dir, checkpoint_file)
         # Check if we found a checkpoint file
         if checkpoint_path:
             n_calls, configuration, evaluation = load_checkpoint(checkpoint_path, n_calls)
@@ -93,41 +111,54 @@ def choose_and_bind_hyperparameters(
         else:
             logging.warning("No checkpoint file found, starting from scratch.")
 
+    if do_tune and warm_start and configuration is None:
+        configuration = collect_warm_start_points(
+            log_dir, checkpoint_file, hyperparams_names, hyperparams_bounds, n_initial_points
+        )
+        n_initial_points -= len(configuration)
+        configuration = configuration or None
+
+    fold_pruner = create_fold_pruner(evaluation) if do_tune and prune_folds else None
+    cache = (
+        EvaluationCache(log_dir.parent / evaluation_cache_dir, data_dir, folds_to_tune_on, seed, debug)
+        if do_tune and evaluation_cache
+        else None
+    )
+
+    cv_kwargs = {
+        "data_dir": data_dir,
+        "seed": seed,
+        "mode": run_mode,
+        "cv_repetitions_to_train": 1,
+        "cv_folds_to_train": folds_to_tune_on,
+        "generate_cache": generate_cache,
+        "load_cache": load_cache,
+        "test_on": "val",
+        "debug": debug,
+        "verbose": verbose,
+        "wandb": wandb,
+    }
+
     # Function that trains the model with the given hyperparameters.
     def bind_params_and_train(hyperparams):
-        with tempfile.TemporaryDirectory(dir=log_dir) as temp_dir:
+        if not do_tune:
             bind_gin_params(hyperparams_names, hyperparams)
-            if not do_tune:
-                return 0
-            return execute_repeated_cv(
-                data_dir,
-                Path(temp_dir),
-                seed,
-                mode=run_mode,
-                cv_repetitions_to_train=1,
-                cv_folds_to_train=folds_to_tune_on,
-                generate_cache=generate_cache,
-                load_cache=load_cache,
-                test_on="val",
-                debug=debug,
-                verbose=verbose,
-                wandb=wandb,
-            )
+            return 0
+        loss = train_with_hyperparameters(hyperparams_names, hyperparams, log_dir, fold_pruner, cache, **cv_kwargs)
+        return fold_pruner.finish_evaluation(loss) if fold_pruner is not None else loss
 
     header = ["ITERATION"] + hyperparams_names + ["LOSS AT ITERATION"]
 
+    journal = TuningJournal(log_dir / checkpoint_file, hyperparams_names) if do_tune else None
+
     def tune_step_callback(res):
-        with open(log_dir / checkpoint_file, "w") as f:
-            data = {
-                "x_iters": res.x_iters,
-                "func_vals": res.func_vals,
-            }
-            f.write(json.dumps(data, cls=JsonResultLoggingEncoder))
-            table_cells = [len(res.x_iters)] + res.x_iters[-1] + [res.func_vals[-1]]
-            highlight = res.x_iters[-1] == res.x  # highlight if best so far
-            log_table_row(header, TUNE)
-            log_table_row(table_cells, TUNE, align=Align.RIGHT, header=header, highlight=highlight)
-            wandb_log({"hp-iteration": len(res.x_iters)})
+        # Only the new evaluations are appended, previously evaluated points are already in the journal.
+        journal.sync(res.x_iters, res.func_vals)
+        table_cells = [len(res.x_iters)] + res.x_iters[-1] + [res.func_vals[-1]]
+        highlight = res.x_iters[-1] == res.x  # highlight if best so far
+        log_table_row(header, TUNE)
+        log_table_row(table_cells, TUNE, align=Align.RIGHT, header=header, highlight=highlight)
+        wandb_log({"hp-iteration": len(res.x_iters)})
 
     if do_tune:
         log_full_line("STARTING TUNING", level=TUNE, char="=")
@@ -148,27 +179,206 @@ def choose_and_bind_hyperparameters(
             n_initial_points = 1
             n_calls = 1
 
-    # Call gaussian process. To choose a random set of hyperparameters this functions is also called.
-    res = gp_minimize(
-        bind_params_and_train,
-        hyperparams_bounds,
-        x0=configuration,
-        y0=evaluation,
-        n_calls=n_calls,
-        n_initial_points=n_initial_points,
-        random_state=seed,
-        noise=1e-10,  # The models are deterministic, but noise is needed for the gp to work.
-        callback=tune_step_callback if do_tune else None,
-    )
+    if do_tune and n_parallel > 1:
+        # Evaluate batches of proposed configurations concurrently.
+        res = parallel_gp_minimize(
+            hyperparams_names,
+            hyperparams_bounds,
+            log_dir,
+            cv_kwargs,
+            x0=configuration,
+            y0=evaluation,
+            n_calls=n_calls,
+            n_initial_points=n_initial_points,
+            n_parallel=n_parallel,
+            random_state=seed,
+            fold_pruner=fold_pruner,
+            evaluation_cache=cache,
+            callback=tune_step_callback,
+        )
+    else:
+        # Call gaussian process. To choose a random set of hyperparameters this functions is also called.
+        res = gp_minimize(
+            bind_params_and_train,
+            hyperparams_bounds,
+            x0=configuration,
+            y0=evaluation,
+            n_calls=n_calls,
+            n_initial_points=n_initial_points,
+            random_state=seed,
+            noise=1e-10,  # The models are deterministic, but noise is needed for the gp to work.
+            callback=tune_step_callback if do_tune else None,
+        )
     logging.disable(level=NOTSET)
 
     if do_tune:
+        journal.compact()
         log_full_line("FINISHED TUNING", level=TUNE, char="=", num_newlines=4)
 
     logging.info("Training with these hyperparameters:")
     bind_gin_params(hyperparams_names, res.x)
 
 
+def train_with_hyperparameters(hyperparams_names, hyperparams, log_dir, fold_pruner=None, evaluation_cache=None, **cv_kwargs):
+    """Binds hyperparameters to gin and trains on the tuning folds in a temporary log directory.
+
+    Args:
+        hyperparams_names: List of hyperparameter names.
+        hyperparams: List of hyperparameter values.
+        log_dir: Directory to create the temporary log directory in.
+        fold_pruner: Optional FoldPruner to stop training the remaining folds early.
+        evaluation_cache: Optional EvaluationCache to look up and store the loss of the configuration.
+        **cv_kwargs: Arguments passed to execute_repeated_cv.
+
+    Returns:
+        The average loss over the trained folds.
+    """
+    bind_gin_params(hyperparams_names, hyperparams)
+    if fold_pruner is not None:
+        fold_pruner.start_evaluation()
+    if evaluation_cache is not None:
+        cache_key = evaluation_cache.key(hyperparams_names, hyperparams)
+        loss = evaluation_cache.get(cache_key)
+        if loss is not None:
+            logging.log(TUNE, f"Configuration was already evaluated, using cached loss {loss}.")
+            return loss
+    with tempfile.TemporaryDirectory(dir=log_dir) as temp_dir:
+        loss = execute_repeated_cv(log_dir=Path(temp_dir), fold_pruner=fold_pruner, **cv_kwargs)
+    # Losses of pruned configurations depend on the other evaluations and are not cached.
+    if evaluation_cache is not None and not (fold_pruner is not None and fold_pruner.pruned):
+        evaluation_cache.put(cache_key, hyperparams_names, hyperparams, loss)
+    return loss
+
+
+def parallel_gp_minimize(
+    hyperparams_names: list[str],
+    hyperparams_bounds: list,
+    log_dir: Path,
+    cv_kwargs: dict,
+    x0: list = None,
+    y0: list = None,
+    n_calls: int = 20,
+    n_initial_points: int = 3,
+    n_parallel: int = 2,
+    random_state: int = None,
+    fold_pruner: FoldPruner = None,
+    evaluation_cache: EvaluationCache = None,
+    callback=None,
+):
+    """Bayesian optimization that evaluates batches of configurations concurrently in a process pool.
+
+    Mirrors the settings of gp_minimize, but uses the ask/tell interface of the skopt Optimizer to propose n_parallel
+    configurations per round with the constant liar strategy. Results are passed to the callback as soon as a single
+    evaluation finishes, so checkpoints are updated while the remaining configurations of the round are still running.
+
+    Args:
+        hyperparams_names: List of hyperparameter names.
+        hyperparams_bounds: List of hyperparameter bounds.
+        log_dir: Directory to create the temporary log directories in.
+        cv_kwargs: Arguments passed to execute_repeated_cv.
+        x0: Previously evaluated configurations, or configurations to evaluate first if y0 is None.
+        y0: Losses of the previously evaluated configurations.
+        n_calls: Number of configurations to evaluate.
+        n_initial_points: Number of random configurations to evaluate before fitting the surrogate model.
+        n_parallel: Number of configurations to evaluate concurrently.
+        random_state: Random seed.
+        fold_pruner: Optional FoldPruner, a copy of it is sent along with each configuration.
+        evaluation_cache: Optional EvaluationCache shared by the workers.
+        callback: Function that is called with the current optimization result after each evaluation.
+
+    Returns:
+        The optimization result.
+    """
+    rng = check_random_state(random_state)
+    optimizer, x_iters, func_vals, pending = create_optimizer(hyperparams_bounds, x0, y0, n_initial_points, rng)
+
+    logging.log(TUNE, f"Evaluating {n_parallel} configurations per round in parallel.")
+    # The workers share the thread budget of the run.
+    worker_threads = max(1, thread_budget() // n_parallel)
+    with ProcessPoolExecutor(
+        max_workers=n_parallel,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_tuning_worker,
+        initargs=(gin.config_str(), worker_threads, logging.getLogger().level),
+    ) as executor:
+        remaining = n_calls
+        while remaining > 0:
+            batch_size = min(n_parallel, remaining)
+            if pending:
+                points, pending = pending[:batch_size], pending[batch_size:]
+            else:
+                points = optimizer.ask(n_points=batch_size, strategy="cl_min")
+            futures = {
+                executor.submit(
+                    evaluate_in_worker,
+                    hyperparams_names,
+                    point,
+                    log_dir,
+                    copy.deepcopy(fold_pruner),
+                    evaluation_cache,
+                    cv_kwargs,
+                ): point
+                for point in points
+            }
+            losses = []
+            for future in as_completed(futures):
+                loss, fold_losses, pruned = future.result()
+                if fold_pruner is not None:
+                    loss = fold_pruner.record_evaluation(fold_losses, pruned, loss)
+                x_iters.append(futures[future])
+                func_vals.append(loss)
+                losses.append((futures[future], loss))
+                if callback is not None:
+                    callback(create_result(x_iters, func_vals))
+            optimizer.tell([point for point, _ in losses], [loss for _, loss in losses])
+            remaining -= len(points)
+    return create_result(x_iters, func_vals, space=optimizer.space, rng=rng)
+
+
+def create_optimizer(hyperparams_bounds: list, x0: list, y0: list, n_initial_points: int, rng: np.random.RandomState):
+    """Creates the skopt Optimizer of parallel_gp_minimize, which draws random points like gp_minimize.
+
+    Evaluated configurations (x0 with y0) are told to the optimizer and configurations without a loss are evaluated first.
+    Both count towards the initial points of the optimizer in addition to n_initial_points, so that a resumed or warm
+    started run still draws n_initial_points random configurations before fitting the surrogate model.
+
+    Returns:
+        The optimizer, the evaluated configurations and their losses, and the configurations to evaluate first.
+    """
+    space = normalize_dimensions(hyperparams_bounds)
+    base_estimator = cook_estimator("GP", space=space, random_state=rng.randint(0, np.iinfo(np.int32).max), noise=1e-10)
+    x_iters, func_vals = (list(x0), list(y0)) if x0 and y0 else ([], [])
+    pending = list(x0) if x0 and not y0 else []
+    optimizer = Optimizer(
+        space,
+        base_estimator,
+        n_initial_points=n_initial_points + len(x_iters) + len(pending),
+        acq_optimizer="lbfgs",
+        random_state=rng,
+    )
+    if x_iters:
+        # Telling the evaluated configurations uses up the initial points they were counted for.
+        optimizer.tell(x_iters, func_vals)
+    return optimizer, x_iters, func_vals, pending
+
+
+def init_tuning_worker(config_str: str, num_threads: int, log_level: int):
+    """Restores the gin configuration and logging setup of the main process in a tuning worker."""
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s : %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    logging.getLogger().setLevel(log_level)
+    gin.parse_config(config_str, skip_unknown=True)
+    gin.bind_parameter("thread_budget.threads", num_threads)
+    apply_thread_budget(num_threads)
+
+
+def evaluate_in_worker(hyperparams_names, hyperparams, log_dir, fold_pruner, evaluation_cache, cv_kwargs):
+    """Trains a configuration in a tuning worker and returns its loss and the information needed for pruning."""
+    loss = train_with_hyperparameters(hyperparams_names, hyperparams, log_dir, fold_pruner, evaluation_cache, **cv_kwargs)
+    if fold_pruner is None:
+        return loss, [], False
+    return loss, fold_pruner.fold_losses, fold_pruner.pruned
+
+
 def collect_bound_hyperparameters(hyperparams, scopes):
     for scope in scopes:
         with gin.config_scope(scope):
@@ -178,20 +388,40 @@ def collect_bound_hyperparameters(hyperparams, scopes):
     return hyperparams_bounds, hyperparams_names
 
 
+def create_fold_pruner(evaluation=None):
+    """Create a fold pruner that knows the losses of previously evaluated configurations."""
+    fold_pruner = FoldPruner()
+    if evaluation:
+        fold_pruner.completed_losses.extend(evaluation)
+    logging.log(TUNE, f"Pruning configurations over folds with the {fold_pruner.rule} rule.")
+    return fold_pruner
+
+
 def load_checkpoint(checkpoint_path, n_calls):
     logging.info(f"Loading checkpoint at {checkpoint_path}")
-    with open(checkpoint_path, "r") as f:
-        data = json.loads(f.read())
-        x0 = data["x_iters"]
-        y0 = data["func_vals"]
+    x0, y0 = read_journal(checkpoint_path)
     n_calls -= len(x0)
     logging.log(TUNE, f"Checkpoint contains {len(x0)} points.")
     return n_calls, x0, y0
 
 
+def resolve_checkpoint(checkpoint, log_dir, checkpoint_file):
+    """Find the checkpoint of the given run, falling back to the latest checkpoint in the log directory."""
+    checkpoint_path = checkpoint / checkpoint_file
+    if not checkpoint_path.exists() and (checkpoint / LEGACY_CHECKPOINT_FILE).exists():
+        checkpoint_path = checkpoint / LEGACY_CHECKPOINT_FILE
+    if not checkpoint_path.exists():
+        logging.warning(f"Hyperparameter checkpoint {checkpoint_path} does not exist.")
+        logging.info("Attempting to find latest checkpoint file.")
+        checkpoint_path = find_checkpoint(log_dir.parent, checkpoint_file)
+    return checkpoint_path
+
+
 def find_checkpoint(log_dir, checkpoint_file):
     """Find the latest checkpoint in the log directory."""
-    hyperparameters = sorted(log_dir.glob(f"*/{checkpoint_file}"), reverse=True)
+    # Runs from before the journal was introduced only have a checkpoint in the legacy format.
+    hyperparameters = list(log_dir.glob(f"*/{checkpoint_file}")) + list(log_dir.glob(f"*/{LEGACY_CHECKPOINT_FILE}"))
+    hyperparameters = sorted(hyperparameters, key=lambda path: path.parent.name, reverse=True)
     if not hyperparameters:
         return None
     return hyperparameters[0]
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+from icu_benchmarks.models.utils import JsonResultLoggingEncoder
+
+# Checkpoint file that older versions rewrote completely after every tuning iteration.
+LEGACY_CHECKPOINT_FILE = "hyperparameter_tuning_logs.json"
+
+
+class TuningJournal:
+    """Append-only JSON-lines journal of the evaluated hyperparameter configurations.
+
+    Every evaluation is appended as a single line and flushed to disk, so each tuning iteration costs constant I/O and a
+    killed job can at most leave a partially written last line behind, which is skipped when the journal is read. The first
+    line holds the names of the tuned hyperparameters, so that other runs can interpret the journal.
+
+    Args:
+        path: Path to the journal file.
+        hyperparams_names: Names of the tuned hyperparameters.
+    """
+
+    def __init__(self, path: Path, hyperparams_names: list[str] = None):
+        self.path = Path(path)
+        self.hyperparams_names = hyperparams_names
+        self.x_iters, self.func_vals = [], []
+        if self.path.exists():
+            self.x_iters, self.func_vals = read_journal(self.path)
+            self.hyperparams_names = hyperparams_names or read_journal_names(self.path)
+        # Writes the header and drops a partially written last line, so that new records start on a line of their own.
+        self.compact()
+
+    def __len__(self):
+        return len(self.x_iters)
+
+    def append(self, x_iters: list, func_vals: list):
+        """Appends evaluated configurations and their losses and syncs the journal to disk."""
+        if not x_iters:
+            return
+        with open(self.path, "a") as f:
+            for x, loss in zip(x_iters, func_vals):
+                f.write(json.dumps({"x": x, "loss": loss}, cls=JsonResultLoggingEncoder) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.x_iters.extend(x_iters)
+        self.func_vals.extend(func_vals)
+
+    def sync(self, x_iters: list, func_vals: list):
+        """Appends the evaluations of an optimization history that are not in the journal yet."""
+        num_recorded = len(self)
+        self.append(list(x_iters[num_recorded:]), list(func_vals[num_recorded:]))
+
+    def compact(self):
+        """Atomically rewrites the journal with only its valid records, dropping partially written lines."""
+        with tempfile.NamedTemporaryFile("w", dir=self.path.parent, suffix=".tmp", delete=False) as f:
+            if self.hyperparams_names is not None:
+                f.write(json.dumps({"hyperparameters": self.hyperparams_names}) + "\n")
+            for x, loss in zip(self.x_iters, self.func_vals):
+                f.write(json.dumps({"x": x, "loss": loss}, cls=JsonResultLoggingEncoder) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, self.path)
+
+
+def read_journal(path: Path) -> tuple[list, list]:
+    """Reads the evaluated configurations and losses from a journal, skipping lines that were not written completely.
+
+    Args:
+        path: Path to the journal, or to a checkpoint file in the legacy JSON format.
+
+    Returns:
+        The evaluated configurations and their losses.
+    """
+    path = Path(path)
+    if path.suffix == ".json":
+        with open(path, "r") as f:
+            data = json.loads(f.read())
+        return data["x_iters"], data["func_vals"]
+    x_iters, func_vals = [], []
+    with open(path, "r") as f:
+        lines = f.read().split("\n")
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if "hyperparameters" in record:
+                continue
+            x_iters.append(record["x"])
+            func_vals.append(record["loss"])
+        except (json.decoder.JSONDecodeError, KeyError, TypeError):
+            # Only the last line can be incomplete after a crash; anything else means the file was modified.
+            where = "trailing" if line_number == len(lines) else f"line {line_number} of"
+            logging.warning(f"Skipping incomplete record at {where} tuning journal {path}.")
+    return x_iters, func_vals
+
+
+def read_journal_names(path: Path) -> list[str]:
+    """Reads the names of the tuned hyperparameters from the header of a journal, or None if it has no header."""
+    path = Path(path)
+    if path.suffix == ".json":
+        return None
+    with open(path, "r") as f:
+        try:
+            header = json.loads(f.readline())
+        except json.decoder.JSONDecodeError:
+            return None
+    return header.get("hyperparameters") if isinstance(header, dict) else None
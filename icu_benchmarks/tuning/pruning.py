@@ -0,0 +1,108 @@
+import logging
+import gin
+import numpy as np
+
+
+@gin.configurable("fold_pruning")
+class FoldPruner:
+    """Stops the evaluation of a hyperparameter configuration once its first folds are clearly worse than earlier ones.
+
+    After every trained fold, the running mean loss of the current configuration is compared to the running mean losses
+    that previously evaluated configurations had after the same number of folds. Pruned configurations are reported back to
+    the optimizer with a penalized (censored) loss, which is never lower than the worst fully evaluated configuration, so
+    that a pruned configuration can never be selected as the best one.
+
+    Args:
+        rule: Pruning rule, either "median" (median stopping rule) or "halving" (successive halving over folds).
+        min_evaluations: Number of configurations that need to be evaluated before pruning starts.
+        min_folds: Minimum number of folds a configuration is trained on before it can be pruned.
+        reduction_factor: Only the best 1 / reduction_factor configurations are continued at each rung ("halving" only).
+    """
+
+    def __init__(self, rule: str = "median", min_evaluations: int = 3, min_folds: int = 1, reduction_factor: int = 2):
+        if rule not in ["median", "halving"]:
+            raise ValueError(f"Pruning rule {rule} not supported, use 'median' or 'halving'.")
+        if reduction_factor < 2:
+            raise ValueError(f"The reduction factor needs to be at least 2, got {reduction_factor}.")
+        self.rule = rule
+        self.min_evaluations = min_evaluations
+        self.min_folds = max(min_folds, 1)
+        self.reduction_factor = reduction_factor
+        # Running mean losses of earlier configurations, indexed by the number of trained folds.
+        self.history = {}
+        self.completed_losses = []
+        self.fold_losses = []
+        self.pruned = False
+
+    def start_evaluation(self):
+        """Resets the state for a new configuration."""
+        self.fold_losses = []
+        self.pruned = False
+
+    def should_prune(self, fold_loss: float, total_folds: int = None) -> bool:
+        """Records the loss of the latest fold and decides whether to stop evaluating the configuration.
+
+        Args:
+            fold_loss: Loss of the fold that was just trained.
+            total_folds: Number of folds the configuration is evaluated on. A configuration is never pruned after its last
+                fold, as it is fully evaluated.
+
+        Returns:
+            True if the remaining folds should be skipped.
+        """
+        self.fold_losses.append(fold_loss)
+        num_folds = len(self.fold_losses)
+        running_loss = np.mean(self.fold_losses)
+        previous = list(self.history.get(num_folds, []))
+        self.history.setdefault(num_folds, []).append(running_loss)
+        if num_folds < self.min_folds or len(previous) < self.min_evaluations:
+            return False
+        if total_folds is not None and num_folds >= total_folds:
+            return False
+        if self.rule == "median":
+            self.pruned = running_loss > np.median(previous)
+        elif self._is_rung(num_folds):
+            self.pruned = running_loss > np.quantile(previous, 1 / self.reduction_factor)
+        if self.pruned:
+            logging.info(f"Pruning configuration after {num_folds} folds with running loss {running_loss:.4f}.")
+        return self.pruned
+
+    def finish_evaluation(self, loss: float) -> float:
+        """Finishes the evaluation of a configuration.
+
+        Args:
+            loss: Average loss over the trained folds.
+
+        Returns:
+            The loss to report to the optimizer, penalized if the configuration was pruned.
+        """
+        if not self.pruned:
+            self.completed_losses.append(loss)
+            return loss
+        if self.completed_losses:
+            loss = max(loss, max(self.completed_losses))
+        logging.info(f"Reporting penalized loss {loss:.4f} for pruned configuration.")
+        return loss
+
+    def record_evaluation(self, fold_losses: list[float], pruned: bool, loss: float) -> float:
+        """Records a configuration that was evaluated with a copy of this pruner, e.g. in another process.
+
+        Args:
+            fold_losses: Losses of the trained folds.
+            pruned: Whether the configuration was pruned.
+            loss: Average loss over the trained folds.
+
+        Returns:
+            The loss to report to the optimizer, penalized if the configuration was pruned.
+        """
+        for num_folds in range(1, len(fold_losses) + 1):
+            self.history.setdefault(num_folds, []).append(np.mean(fold_losses[:num_folds]))
+        self.fold_losses = list(fold_losses)
+        self.pruned = pruned
+        return self.finish_evaluation(loss)
+
+    def _is_rung(self, num_folds: int) -> bool:
+        rung = self.min_folds
+        while rung < num_folds:
+            rung *= self.reduction_factor
+        return rung == num_folds
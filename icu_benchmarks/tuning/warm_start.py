@@ -0,0 +1,61 @@
+import logging
+from pathlib import Path
+
+from skopt.space import Space
+
+from icu_benchmarks.tuning.journal import read_journal, read_journal_names
+
+
+def collect_warm_start_points(
+    log_dir: Path, checkpoint_file: str, hyperparams_names: list[str], hyperparams_bounds: list, max_points: int
+) -> list[list]:
+    """Collects promising configurations from the tuning journals of the same model on other datasets and tasks.
+
+    Losses of different datasets and tasks are not on the same scale, so the configurations are ranked within each source
+    (dataset and task) and taken in turns from all sources, starting with sources of the same task. Only configurations of
+    journals that tuned the same hyperparameters and that lie within the current bounds are used.
+
+    Args:
+        log_dir: Log directory of the current run, i.e. <log root>/<dataset>/<task>/<model>/<run>.
+        checkpoint_file: Name of the tuning journals.
+        hyperparams_names: Names of the tuned hyperparameters.
+        hyperparams_bounds: Bounds of the tuned hyperparameters.
+        max_points: Maximum number of configurations to collect.
+
+    Returns:
+        List of configurations to evaluate first.
+    """
+    model_dir = log_dir.parent
+    task_dir = model_dir.parent
+    log_root = task_dir.parent.parent
+    space = Space(hyperparams_bounds)
+
+    sources = {}
+    for journal_path in log_root.glob(f"*/*/{model_dir.name}/*/{checkpoint_file}"):
+        source_task_dir = journal_path.parents[2]
+        if source_task_dir == task_dir:
+            # Runs of the current dataset and task are resumed with a checkpoint instead.
+            continue
+        names = read_journal_names(journal_path)
+        if names is None or not set(hyperparams_names).issubset(names):
+            continue
+        for x, loss in zip(*read_journal(journal_path)):
+            values = dict(zip(names, x))
+            point = [values[name] for name in hyperparams_names]
+            if point in space:
+                sources.setdefault(source_task_dir, []).append((loss, point))
+
+    # Sources of the same task first, then sources of other tasks.
+    ordered_sources = sorted(sources, key=lambda source: (source.name != task_dir.name, str(source)))
+    ranked = [[point for _, point in sorted(sources[source], key=lambda item: item[0])] for source in ordered_sources]
+    points = []
+    for rank in range(max(map(len, ranked), default=0)):
+        for source_points in ranked:
+            if rank < len(source_points) and source_points[rank] not in points and len(points) < max_points:
+                points.append(source_points[rank])
+    if points:
+        names = ", ".join(f"{source.parent.name}/{source.name}" for source in ordered_sources)
+        logging.info(f"Warm starting with {len(points)} configurations from {names}.")
+    else:
+        logging.info("No tuning journals of other datasets or tasks found for warm starting.")
+    return points
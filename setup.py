@@ -62,7 +62,13 @@ setup(
     description="Yet Another ICU Benchmark is a holistic framework for the automation of the development of clinical "
     "prediction models on ICU data. Users can create custom datasets, cohorts, prediction tasks, endpoints, "
     "and models. ",
-    entry_points={"console_scripts": ["icu-benchmarks = icu_benchmarks.run:main"]},
+    entry_points={
+        "console_scripts": [
+            "icu-benchmarks = icu_benchmarks.run:main",
+            "icu-benchmarks-export = icu_benchmarks.models.export:main",
+            "icu-benchmarks-recompute-metrics = icu_benchmarks.models.predictions:main",
+        ]
+    },
     extras_require={"mps": ["mkl < 2022"]},
     license="MIT license",
     long_description=readme,
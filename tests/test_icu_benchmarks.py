@@ -0,0 +1,685 @@
+import copy
+import inspect
+import json
+import shutil
+import time
+
+import gin
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from pytorch_lightning import Trainer
+from pytorch_lightning.utilities.compile import from_compiled
+from torch.utils.data import DataLoader, TensorDataset
+from sklearn.calibration import calibration_curve
+from torchmetrics.classification import BinaryFairness
+from skopt import gp_minimize
+from sklearn.utils import check_random_state
+from threadpoolctl import threadpool_info, threadpool_limits
+from sklearn.metrics import (
+    average_precision_score,
+    balanced_accuracy_score,
+    mean_absolute_error,
+    precision_recall_curve,
+    roc_auc_score,
+    roc_curve,
+)
+
+from icu_benchmarks.models.custom_metrics import (
+    MAE,
+    BalancedAccuracy,
+    BinaryFairnessWrapper,
+    BinnedAveragePrecision,
+    BinnedROC_AUC,
+    CalibrationCurve,
+)
+from icu_benchmarks.models.callbacks import ThreadBudget, Throughput
+from icu_benchmarks.models.bootstrap import bootstrap_intervals, weighted_ranking_metrics
+from icu_benchmarks.models.constants import MLMetrics
+from icu_benchmarks.contants import RunMode
+from icu_benchmarks.data import loader_tuning
+from icu_benchmarks.data.loader import PredictionDataset
+from icu_benchmarks.data.split_process_data import preprocess_data
+from icu_benchmarks.models.dl_models import GRUNet, LSTMNet, RNNet, TemporalConvNet, Transformer
+from icu_benchmarks.models.ensemble import create_ensemble, fused_forward, loop_forward, vmap_forward
+from icu_benchmarks.models.export import export_model
+from icu_benchmarks.models.ml_metrics import evaluate_metrics
+from icu_benchmarks.models import compilation, quantization, utils as model_utils
+from icu_benchmarks.models.predictions import PredictionWriter, read_predictions, recompute_metrics, write_predictions
+from icu_benchmarks.models.train import build_test_loader
+from icu_benchmarks import run
+from icu_benchmarks.thread_budget import apply_thread_budget, cpu_core_count, model_thread_params, thread_budget
+from icu_benchmarks.tuning.evaluation_cache import EvaluationCache, fingerprint_code
+from icu_benchmarks.tuning.hyperparameters import choose_and_bind_hyperparameters, create_optimizer
+from icu_benchmarks.tuning.journal import TuningJournal, read_journal, read_journal_names
+from icu_benchmarks.tuning.pruning import FoldPruner
+from icu_benchmarks.tuning.warm_start import collect_warm_start_points
+
+
+def update_in_batches(metric, y_pred, y, batch_size=1000):
+    for start in range(0, len(y), batch_size):
+        metric.update((torch.from_numpy(y_pred[start : start + batch_size]), torch.from_numpy(y[start : start + batch_size])))
+    return metric.compute()
+
+
+def tiny_trainer():
+    return Trainer(accelerator="cpu", max_epochs=1, logger=False, enable_checkpointing=False, enable_progress_bar=False)
+
+
+@pytest.fixture
+def trained_gru():
+    """A tiny GRU trained for one epoch on random sequences, and the loader of its data."""
+    torch.manual_seed(0)
+    features, labels = torch.randn(8, 6, 3), torch.randint(0, 2, (8, 6)).float()
+    loader = DataLoader(TensorDataset(features, labels, torch.ones(8, 6, dtype=torch.bool)), batch_size=4)
+    model = GRUNet(torch.Size([4, 6, 3]), 4, 1, 2, loss=torch.nn.functional.cross_entropy, epochs=1)
+    tiny_trainer().fit(model, loader)
+    return model, loader
+
+
+@pytest.fixture
+def binary_predictions():
+    rng = np.random.default_rng(0)
+    y = rng.integers(0, 2, 20_000)
+    y_pred = 1 / (1 + np.exp(-(rng.normal(size=len(y)) + y)))
+    return y_pred.astype(np.float32), y
+
+
+@pytest.mark.parametrize("metric, exact", [(BinnedROC_AUC, roc_auc_score), (BinnedAveragePrecision, average_precision_score)])
+def test_binned_ranking_metrics(binary_predictions, metric, exact):
+    y_pred, y = binary_predictions
+    assert update_in_batches(metric(), y_pred, y) == pytest.approx(exact(y, y_pred), abs=1e-3)
+
+
+def test_calibration_curve(binary_predictions):
+    y_pred, y = binary_predictions
+    prob_true, prob_pred = update_in_batches(CalibrationCurve(), y_pred, y)
+    exact_true, exact_pred = calibration_curve(y, y_pred, n_bins=10)
+    np.testing.assert_allclose(prob_true, exact_true, atol=1e-6)
+    np.testing.assert_allclose(prob_pred, exact_pred, atol=1e-6)
+
+
+def test_balanced_accuracy():
+    rng = np.random.default_rng(0)
+    y = rng.integers(0, 3, 5_000)
+    y_pred = rng.random((len(y), 3)).astype(np.float32)
+    y_pred[np.arange(len(y)), y] += 0.3
+    assert update_in_batches(BalancedAccuracy(), y_pred, y) == pytest.approx(
+        balanced_accuracy_score(y, y_pred.argmax(axis=1)), abs=1e-9
+    )
+
+
+def test_mae():
+    rng = np.random.default_rng(0)
+    y = rng.normal(size=5_000).astype(np.float32)
+    y_pred = (y + rng.normal(size=len(y))).astype(np.float32)
+    assert update_in_batches(MAE(), y_pred, y) == pytest.approx(mean_absolute_error(y, y_pred), rel=1e-6)
+
+
+def test_evaluate_metrics_matches_sklearn(binary_predictions):
+    y_pred, y = binary_predictions
+    # Ties are resolved like in scikit-learn.
+    y_pred = np.round(y_pred, 2)
+    values = evaluate_metrics(MLMetrics.BINARY_CLASSIFICATION, y, y_pred, curves=True)
+    assert values["AUC"] == pytest.approx(roc_auc_score(y, y_pred), abs=1e-12)
+    assert values["PR"] == pytest.approx(average_precision_score(y, y_pred), abs=1e-12)
+    for name, curve in [("PR_Curve", precision_recall_curve), ("RO_Curve", roc_curve)]:
+        for value, exact in zip(values[name], curve(y, y_pred)):
+            np.testing.assert_allclose(value, exact)
+    assert set(evaluate_metrics(MLMetrics.BINARY_CLASSIFICATION, y, y_pred)) == {"AUC", "PR"}
+
+
+def test_binary_fairness_on_group_columns(binary_predictions):
+    y_pred, y = map(torch.from_numpy, binary_predictions)
+    groups = torch.stack([torch.arange(len(y)) % 2, torch.arange(len(y)) % 3], dim=1)
+    wrapper, exact = BinaryFairnessWrapper(3, group_index=1), BinaryFairness(3)
+    wrapper.update(y_pred, y, groups)
+    exact.update(y_pred, y, groups[:, 1])
+    assert wrapper.compute() == exact.compute()
+
+
+def test_weighted_ranking_metrics_match_sklearn(binary_predictions):
+    y_pred, y = binary_predictions
+    y_pred = np.round(y_pred, 2)
+    order = np.argsort(y_pred, kind="mergesort")[::-1]
+    threshold_idxs = np.r_[np.where(np.diff(y_pred[order]))[0], len(y) - 1]
+    auc, ap = weighted_ranking_metrics(np.ones((1, len(y)), dtype=int), y[order] == 1, threshold_idxs)
+    assert auc[0] == pytest.approx(roc_auc_score(y, y_pred), abs=1e-12)
+    assert ap[0] == pytest.approx(average_precision_score(y, y_pred), abs=1e-12)
+
+
+def test_bootstrap_intervals(binary_predictions):
+    y_pred, y = binary_predictions
+    groups = np.arange(len(y)) // 10
+    intervals = bootstrap_intervals(y, y_pred, groups, num_samples=200, max_chunk_elements=len(y) * 16)
+    assert intervals["AUC"][0] < roc_auc_score(y, y_pred) < intervals["AUC"][1]
+    assert intervals["PR"][0] < average_precision_score(y, y_pred) < intervals["PR"][1]
+    # Chunks are resampled independently of the threads that compute them.
+    assert intervals == bootstrap_intervals(y, y_pred, groups, num_samples=200, max_chunk_elements=len(y) * 16, num_threads=4)
+
+
+def test_recompute_metrics_from_predictions(binary_predictions, tmp_path):
+    y_pred, y = binary_predictions
+    fold_dir = tmp_path / "repetition_0" / "fold_0"
+    fold_dir.mkdir(parents=True)
+    stays = np.arange(len(y)) // 10
+    writer = PredictionWriter(
+        fold_dir / "test_predictions.parquet", 1000 + np.arange(stays[-1] + 1), RunMode.classification, 3000
+    )
+    for start in range(0, len(y), 1024):
+        batch = slice(start, start + 1024)
+        writer.write(stays[batch], np.arange(len(y))[batch] % 10, y[batch], y_pred[batch])
+    writer.close()
+    predictions = read_predictions(fold_dir)
+    np.testing.assert_array_equal(predictions["stay_id"], 1000 + stays)
+    np.testing.assert_array_equal(predictions["score"], y_pred)
+    results = recompute_metrics(tmp_path)
+    assert results["folds"]["repetition_0/fold_0"]["AUC"] == pytest.approx(roc_auc_score(y, y_pred), abs=1e-12)
+    assert (fold_dir / "test_recomputed_metrics.json").is_file()
+
+
+def test_negative_subsample_weights(binary_predictions):
+    _, y = binary_predictions
+    stays = np.arange(len(y)) // 50
+    dataset = PredictionDataset.__new__(PredictionDataset)
+    dataset.vars = {"LABEL": "label"}
+    dataset.outcome_df = pd.DataFrame({"label": y}, index=pd.Index(stays, name="stay_id"))
+    indices, weights = dataset.get_negative_subsample(0.1)
+    assert np.all(y[indices][weights > 1] == 0)
+    np.testing.assert_array_equal(np.flatnonzero(y == 1), indices[y[indices] == 1])
+    # The weighted negative labels of each stay sum up to its negative labels.
+    negatives = y[indices] == 0
+    np.testing.assert_allclose(
+        np.bincount(stays[indices][negatives], weights[negatives], minlength=stays[-1] + 1),
+        np.bincount(stays[y == 0], minlength=stays[-1] + 1),
+    )
+
+
+def test_model_thread_params():
+    from lightgbm import LGBMClassifier
+    from sklearn.linear_model import ElasticNet, LogisticRegression
+
+    assert model_thread_params(LGBMClassifier, 4) == {"n_jobs": 4}
+    assert model_thread_params(LogisticRegression, 4) == {"n_jobs": 4}
+    assert model_thread_params(ElasticNet, 4) == {}
+
+
+def test_thread_budget_caps_threads():
+    from icu_benchmarks.models.ml_models import LogisticRegression
+
+    threads, blas_threads = torch.get_num_threads(), {info["prefix"]: info["num_threads"] for info in threadpool_info()}
+    gin.parse_config("thread_budget.threads = 1")
+    try:
+        torch.set_num_threads(3)
+        apply_thread_budget(thread_budget())
+        assert torch.get_num_threads() == 1
+        assert all(info["num_threads"] == 1 for info in threadpool_info())
+        assert LogisticRegression().model.n_jobs == 1
+        assert LogisticRegression(n_jobs=2).model.n_jobs == 2
+    finally:
+        gin.clear_config()
+        torch.set_num_threads(threads)
+        threadpool_limits(limits=blas_threads)
+    assert thread_budget(0) == 1 and thread_budget() == cpu_core_count
+
+
+def test_autotune_dataloader_reuses_settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(loader_tuning, "_tuned_settings", {})
+    dataset = TensorDataset(torch.randn(64, 6, 3), torch.ones(64, 6))
+    # Loading is cheap compared to a slow training step, so it stays on the main thread.
+    settings = loader_tuning.autotune_dataloader(dataset, 8, step_fn=lambda batch: time.sleep(0.01), log_dir=tmp_path)
+    assert settings == {"num_workers": 0, "persistent_workers": False, "prefetch_factor": None, "pin_memory": False}
+    assert json.loads((tmp_path / "dataloader_settings.json").read_text()) == settings
+
+    def measure(*args, **kwargs):
+        raise AssertionError("The settings are measured again.")
+
+    monkeypatch.setattr(loader_tuning, "choose_dataloader_settings", measure)
+    (tmp_path / "dataloader_settings.json").unlink()
+    assert loader_tuning.autotune_dataloader(dataset, 8, log_dir=tmp_path) == settings
+    assert json.loads((tmp_path / "dataloader_settings.json").read_text()) == settings
+    # Settings are tuned per batch size.
+    with pytest.raises(AssertionError, match="measured again"):
+        loader_tuning.autotune_dataloader(dataset, 16)
+
+
+def test_predict_in_chunks_matches_predict():
+    from icu_benchmarks.models.ml_models import LogisticRegression
+
+    rng = np.random.default_rng(0)
+    features, labels = rng.normal(size=(100, 5)), rng.integers(0, 2, size=100)
+    wrapper = LogisticRegression(predict_chunk_size=7, n_jobs=3)
+    wrapper.model.fit(features, labels)
+    np.testing.assert_allclose(wrapper.predict_in_chunks(features), wrapper.predict(features))
+    # The model predicts the chunks single-threaded, its own number of threads is restored afterwards.
+    assert wrapper.model.n_jobs == 3
+
+
+def test_lightgbm_dataset_cache_in_run_dir(tmp_path):
+    from icu_benchmarks.models.ml_models import DATASET_CACHE_DIR, LGBMClassifier, bind_dataset_cache, remove_dataset_cache
+
+    rng = np.random.default_rng(0)
+    features, labels = rng.normal(size=(200, 5)), rng.integers(0, 2, size=200)
+    gin.clear_config()
+    try:
+        assert LGBMClassifier(n_estimators=5).dataset_cache_dir is None
+        bind_dataset_cache(tmp_path)
+        wrappers = [LGBMClassifier(n_estimators=5) for _ in range(2)]
+        losses = [wrapper.fit_model(features[:150], labels[:150], features[150:], labels[150:]) for wrapper in wrappers]
+    finally:
+        gin.clear_config()
+    # The second fit loads the Datasets that the first one cached in the run directory.
+    assert losses[0] == losses[1] and len(list((tmp_path / DATASET_CACHE_DIR).glob("*.bin"))) == 2
+    remove_dataset_cache(tmp_path)
+    assert not (tmp_path / DATASET_CACHE_DIR).exists()
+
+
+def run_demo(log_dir, model, *args, data_dir="demo_data/aki/mimic_demo", task_name="AKI", bindings=()):
+    """Trains a model on the first fold of a demo dataset with run.py, and returns its run directory."""
+    gin.clear_config()
+    try:
+        run.main(
+            ["-d", data_dir, "-n", "mimic_demo", "-t", "BinaryClassification", "-tn", task_name, "-m", model, "-s", "1111"]
+            + ["-l", str(log_dir), "--cpu", *args, "-hp", "execute_repeated_cv.cv_repetitions_to_train=1"]
+            + ["execute_repeated_cv.cv_folds_to_train=1", *bindings]
+        )
+    finally:
+        gin.clear_config()
+    (run_dir,) = (log_dir / "mimic_demo" / task_name / model).iterdir()
+    return run_dir
+
+
+def test_models_reproduce_separate_dl_runs(tmp_path):
+    kwargs = dict(
+        data_dir="demo_data/mortality24/mimic_demo",
+        task_name="Mortality24",
+        bindings=["train_common.epochs=1", "execute_repeated_cv.cv_folds_to_train=2"],
+    )
+    separate = run_demo(tmp_path / "separate", "GRU", **kwargs)
+    # The GRU is trained after the LSTM on each fold.
+    together = run_demo(tmp_path / "together", "GRU", "--models", "LSTM", "GRU", **kwargs)
+    for fold in ["fold_0", "fold_1"]:
+        expected, actual = [
+            json.loads((run_dir / "repetition_0" / fold / "test_metrics.json").read_text()) for run_dir in [separate, together]
+        ]
+        assert actual == expected
+
+
+def test_bf16_matches_fp32_on_demo_data(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_utils, "cpu_supports_bf16", lambda: True)
+    kwargs = dict(data_dir="demo_data/mortality24/mimic_demo", task_name="Mortality24")
+    metrics = {}
+    for precision in ["32", "'bf16'"]:
+        run_dir = run_demo(tmp_path / precision.strip("'"), "GRU", **kwargs, bindings=[f"train_common.precision={precision}"])
+        metrics[precision] = json.loads((run_dir / "repetition_0" / "fold_0" / "test_metrics.json").read_text())
+    assert metrics["'bf16'"]["loss"] == pytest.approx(metrics["32"]["loss"], abs=0.01)
+    assert metrics["'bf16'"]["AUC"] == pytest.approx(metrics["32"]["AUC"], abs=0.05)
+
+
+@pytest.mark.parametrize(
+    "precision, use_cuda, bf16_supported, expected",
+    [
+        (32, False, True, "32-true"),
+        (16, False, True, "bf16-mixed"),
+        ("bf16", False, True, "bf16-mixed"),
+        (16, False, False, "32-true"),
+        ("bf16-mixed", False, False, "32-true"),
+        (16, True, False, "16-mixed"),
+        ("bf16", True, True, "bf16-mixed"),
+        ("bf16", True, False, "32-true"),
+    ],
+)
+def test_resolve_precision(monkeypatch, precision, use_cuda, bf16_supported, expected):
+    monkeypatch.setattr(model_utils, "cpu_supports_bf16", lambda: bf16_supported and not use_cuda)
+    monkeypatch.setattr(torch.cuda, "is_bf16_supported", lambda: bf16_supported and use_cuda)
+    assert model_utils.resolve_precision(precision, use_cuda) == expected
+
+
+def test_run_aggregates_only_repetitions(tmp_path):
+    run_dir = run_demo(tmp_path, "LGBMClassifier")
+    aggregated = json.loads((run_dir / "aggregated_test_metrics.json").read_text())
+    assert list(aggregated) == ["repetition_0"] and aggregated["repetition_0"]["fold_0"]["AUC"] > 0
+    assert not any(run_dir.glob("lightgbm_datasets"))
+
+
+def test_copy_model_after_writing_predictions(trained_gru, tmp_path):
+    model, loader = trained_gru
+    model.enable_prediction_writer(tmp_path / "test_predictions.parquet", np.arange(8))
+    tiny_trainer().test(model, loader, verbose=False)
+    assert len(read_predictions(tmp_path)) == 48
+    copy.deepcopy(model)
+
+
+def test_predictions_written_for_every_stay(trained_gru, tmp_path):
+    model, loader = trained_gru
+    # Seven stays are tested in a batch of four and a partial batch of three.
+    dataset = TensorDataset(*(tensor[:7] for tensor in loader.dataset.tensors))
+    test_loader = build_test_loader(model, dataset, 1, 1, {})
+    write_predictions(model, test_loader, tmp_path / "val_predictions.parquet", 100 + np.arange(7), {"accelerator": "cpu"})
+    predictions = read_predictions(tmp_path, "val")
+    assert sorted(predictions["stay_id"].unique()) == list(100 + np.arange(7)) and len(predictions) == 42
+
+
+def test_throughput_and_thread_budget_callbacks(trained_gru):
+    model, loader = trained_gru
+    throughput, threads = Throughput(), torch.get_num_threads()
+    torch.set_num_threads(3)
+    try:
+        trainer = Trainer(
+            accelerator="cpu",
+            max_epochs=2,
+            logger=False,
+            enable_checkpointing=False,
+            enable_progress_bar=False,
+            callbacks=[throughput, ThreadBudget(1)],
+        )
+        trainer.fit(model, loader)
+        assert torch.get_num_threads() == 1
+    finally:
+        torch.set_num_threads(threads)
+    # The steps of the last epoch are counted, two batches of four sequences.
+    assert throughput.steps == 2 and throughput.end > throughput.start
+    assert trainer.callback_metrics["train/steps_per_sec"] == pytest.approx(2 / (throughput.end - throughput.start))
+
+
+def test_quantize_after_writing_predictions(trained_gru, tmp_path):
+    model, loader = trained_gru
+    model.enable_prediction_writer(tmp_path / "test_predictions.parquet", np.arange(8))
+    tiny_trainer().test(model, loader, verbose=False)
+    results = quantization.test_quantized(model, loader, [], tmp_path)
+    assert np.isfinite(results["test/quantized/loss"])
+    assert (tmp_path / "model_quantized.ckpt").is_file()
+    # State of a running test is not copied to the quantized model, and kept on the float model.
+    model.prediction_batches = iter(loader.batch_sampler)
+    quantized = quantization.quantize_model(model)
+    assert quantized.prediction_batches is None and model.prediction_batches is not None
+
+
+def test_quantize_compiled_model_keeps_trainer(trained_gru):
+    model, _ = trained_gru
+    assert compilation.uncompiled(model) is model
+    # torch.compile is not supported on every Python version, so the compiled steps are stood in for by plain wrappers.
+    compiled = from_compiled(torch._dynamo.OptimizedModule(model, lambda step: lambda *args, **kwargs: step(*args, **kwargs)))
+    assert compiled is model and not inspect.ismethod(model.forward)
+    trainer = tiny_trainer()
+    model.trainer = trainer
+    quantized = quantization.quantize_model(compiled)
+    assert inspect.ismethod(model.forward) and model.trainer is trainer
+    with pytest.raises(RuntimeError, match="not attached"):
+        quantized.trainer
+
+
+def test_compile_model_keeps_dynamo_errors_global(trained_gru):
+    model, loader = trained_gru
+    assert compilation.suppress_errors(lambda: torch._dynamo.config.suppress_errors)()
+    assert not torch._dynamo.config.suppress_errors
+    # Falls back to eager execution where torch.compile is not supported, e.g. on Python 3.11 with torch 2.0.
+    compiled = compilation.compile_model(model, torch.Size([4, 6, 3]))
+    assert not torch._dynamo.config.suppress_errors
+    tiny_trainer().fit(compiled, loader)
+    tiny_trainer().test(compiled, loader, verbose=False)
+    assert not torch._dynamo.config.suppress_errors
+
+
+@pytest.mark.parametrize(
+    "run_mode, num_classes, loss, weight",
+    [
+        (RunMode.classification, 2, torch.nn.functional.cross_entropy, [0.3, 0.7]),
+        (RunMode.classification, 3, torch.nn.functional.cross_entropy, None),
+        (RunMode.regression, 1, torch.nn.functional.mse_loss, None),
+    ],
+)
+def test_loss_from_output_matches_masked_select(run_mode, num_classes, loss, weight):
+    torch.manual_seed(0)
+    model = GRUNet(torch.Size([4, 6, 3]), 4, 1, num_classes, loss=loss, run_mode=run_mode)
+    model.set_weight(weight, None)
+    out = torch.randn(4, 6, num_classes, requires_grad=True)
+    mask = torch.rand(4, 6) > 0.3
+    labels = torch.randint(0, num_classes, (4, 6)).float() if num_classes > 1 else torch.randn(4, 6)
+    # Unlabeled time steps of regression tasks may hold missing targets.
+    labels = labels.masked_fill(~mask, float("nan")) if run_mode == RunMode.regression else labels
+    value, prediction, target = model.loss_from_output(out, labels, mask)
+    (gradient,) = torch.autograd.grad(value, out)
+
+    # Loss of the outputs and labels of the labeled time steps only.
+    expected_prediction = torch.masked_select(out, mask.unsqueeze(-1)).reshape(-1, num_classes)
+    expected_target = torch.masked_select(labels, mask)
+    if run_mode == RunMode.classification:
+        kwargs = {"weight": torch.tensor(weight)} if weight is not None else {}
+        expected = loss(expected_prediction, expected_target.long(), **kwargs)
+    else:
+        expected = loss(expected_prediction[:, 0], expected_target)
+    (expected_gradient,) = torch.autograd.grad(expected, out)
+    torch.testing.assert_close(value, expected)
+    torch.testing.assert_close(gradient, expected_gradient)
+    torch.testing.assert_close(prediction, expected_prediction.detach())
+    torch.testing.assert_close(target, expected_target)
+
+
+def test_export_model_without_trainer(trained_gru, tmp_path):
+    trained, loader = trained_gru
+    # Like a model loaded from a checkpoint, the model is not attached to a trainer.
+    model = GRUNet(torch.Size([4, 6, 3]), 4, 1, 2, loss=torch.nn.functional.cross_entropy)
+    model.load_state_dict(trained.state_dict())
+    exported = torch.jit.load(str(export_model(model, model.hparams.input_size, tmp_path / "export")))
+    with pytest.raises(RuntimeError, match="not attached"):
+        model.trainer
+    # Members of an ensemble are attached and detached like the model itself.
+    ensemble = create_ensemble(
+        GRUNet,
+        2,
+        input_size=torch.Size([4, 6, 3]),
+        hidden_dim=4,
+        layer_dim=1,
+        num_classes=2,
+        loss=torch.nn.functional.cross_entropy,
+    )
+    export_model(ensemble, torch.Size([4, 6, 3]), tmp_path / "ensemble")
+    with pytest.raises(RuntimeError, match="not attached"):
+        ensemble.members[0].trainer
+    features = next(iter(loader))[0]
+    with torch.no_grad():
+        torch.testing.assert_close(exported(features), torch.softmax(model(features), dim=-1))
+
+
+def test_recipes_written_for_cached_data(tmp_path):
+    data_dir = shutil.copytree("demo_data/mortality24/mimic_demo", tmp_path / "data")
+    run_dirs = [tmp_path / "fitted", tmp_path / "cached"]
+    gin.clear_config()
+    try:
+        gin.parse_config_file("configs/tasks/BinaryClassification.gin", skip_unknown=True)
+        for run_dir in run_dirs:
+            run_dir.mkdir()
+            preprocess_data(data_dir, load_cache=True, generate_cache=True, recipe_dirs=[run_dir])
+    finally:
+        gin.clear_config()
+    fitted, cached = [json.loads((run_dir / "recipes.json").read_text()) for run_dir in run_dirs]
+    assert fitted and cached == fitted
+
+
+def evaluate_with_pruner(pruner, fold_losses):
+    """Evaluates a configuration fold by fold like execute_repeated_cv, and returns the trained folds and reported loss."""
+    pruner.start_evaluation()
+    trained = []
+    for fold_loss in fold_losses:
+        trained.append(fold_loss)
+        if pruner.should_prune(fold_loss, len(fold_losses)):
+            break
+    return len(trained), pruner.finish_evaluation(np.mean(trained))
+
+
+@pytest.mark.parametrize(
+    "min_folds, reduction_factor, rungs", [(1, 2, [1, 2, 4, 8]), (2, 2, [2, 4, 8]), (1, 3, [1, 3, 9]), (2, 3, [2, 6])]
+)
+def test_fold_pruner_rungs(min_folds, reduction_factor, rungs):
+    pruner = FoldPruner(rule="halving", min_folds=min_folds, reduction_factor=reduction_factor)
+    assert [num_folds for num_folds in range(1, 10) if pruner._is_rung(num_folds)] == rungs
+
+
+def test_fold_pruner_rejects_reduction_factor_below_two():
+    with pytest.raises(ValueError):
+        FoldPruner(rule="halving", reduction_factor=1)
+
+
+def test_fold_pruner_decisions():
+    pruner = FoldPruner(rule="median", min_evaluations=2)
+    for fold_losses in [[1.0, 1.0, 1.0], [2.0, 2.0, 2.0]]:
+        assert evaluate_with_pruner(pruner, fold_losses) == (3, np.mean(fold_losses))
+    # Better than the median of the earlier configurations after each fold: fully evaluated.
+    assert evaluate_with_pruner(pruner, [0.5, 0.5, 0.5]) == (3, 0.5)
+    # Worse after the first fold: pruned and penalized with the worst completed loss.
+    assert evaluate_with_pruner(pruner, [3.0, 0.1, 0.1]) == (1, 3.0)
+    assert pruner.pruned
+    # Better than the median after the first fold, but not after the second.
+    assert evaluate_with_pruner(pruner, [1.2, 1.2, 1.2]) == (2, 2.0)
+    # Only worse on the last fold: a fully evaluated configuration is never pruned.
+    assert evaluate_with_pruner(pruner, [0.1, 0.1, 5.0]) == (3, pytest.approx(5.2 / 3))
+    assert not pruner.pruned
+
+
+@pytest.mark.parametrize("resume", [True, False])
+def test_parallel_optimizer_draws_initial_points_like_gp_minimize(resume):
+    def objective(x):
+        return (x[0] - 0.3) ** 2
+
+    bounds, x0 = [(0.0, 1.0)], [[0.1], [0.5], [0.9]]
+    # Resumed runs pass the evaluated configurations with their losses, warm started runs evaluate them first.
+    y0 = [objective(x) for x in x0] if resume else None
+    serial = gp_minimize(objective, bounds, x0=x0, y0=y0, n_calls=6, n_initial_points=2, random_state=1, noise=1e-10)
+    optimizer, _, _, pending = create_optimizer(bounds, x0, y0, 2, check_random_state(1))
+    for _ in range(6):
+        point = pending.pop(0) if pending else optimizer.ask(n_points=1, strategy="cl_min")[0]
+        optimizer.tell(point, objective(point))
+    # The surrogate model is fitted after the same number of random configurations.
+    assert len(optimizer.models) == len(serial.models)
+
+
+def test_evaluation_cache_key_ignores_threads_and_outputs(tmp_path):
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "outc.parquet").write_bytes(b"outcome")
+    cache = EvaluationCache(tmp_path / "cache", tmp_path / "data", folds=2, seed=42)
+
+    def key(*bindings):
+        gin.clear_config()
+        gin.parse_config(["train_common.epochs = 3", *bindings])
+        return cache.key(["lr"], [0.01])
+
+    try:
+        base = key()
+        assert base == key("thread_budget.threads = 2", "train_common.quantize = True", "train_common.bootstrap = True")
+        assert base == key("train_common.save_predictions = [\n    'test',\n    'val',\n]")
+        assert base != key("train_common.batch_size = 8")
+        assert base != cache.key(["lr"], [0.1])
+    finally:
+        gin.clear_config()
+
+
+def test_evaluation_cache_key_changes_with_code(tmp_path):
+    (tmp_path / "models").mkdir()
+    (tmp_path / "models" / "model.py").write_text("loss = 1")
+    fingerprint = fingerprint_code(tmp_path)
+    assert fingerprint == fingerprint_code(tmp_path)
+    (tmp_path / "models" / "model.py").write_text("loss = 2")
+    assert fingerprint != fingerprint_code(tmp_path)
+    # Without a key on the installed libraries, the cache is opt-in.
+    assert inspect.signature(choose_and_bind_hyperparameters).parameters["evaluation_cache"].default is False
+
+
+def test_journal_skips_truncated_trailing_line(tmp_path):
+    path = tmp_path / "tuning_journal.jsonl"
+    journal = TuningJournal(path, ["lr", "depth"])
+    journal.append([[0.1, 3], [0.01, 5]], [0.5, 0.4])
+    # A job killed while appending leaves a partial last line behind.
+    with open(path, "a") as f:
+        f.write('{"x": [0.001, ')
+    assert read_journal(path) == ([[0.1, 3], [0.01, 5]], [0.5, 0.4])
+    assert read_journal_names(path) == ["lr", "depth"]
+
+
+def test_journal_reads_legacy_checkpoint(tmp_path):
+    path = tmp_path / "hyperparameter_tuning_logs.json"
+    path.write_text(json.dumps({"x_iters": [[0.1, 3]], "func_vals": [0.5]}))
+    assert read_journal(path) == ([[0.1, 3]], [0.5])
+    assert read_journal_names(path) is None
+
+
+def test_journal_compaction_keeps_all_evaluations(tmp_path):
+    path = tmp_path / "tuning_journal.jsonl"
+    TuningJournal(path, ["lr"]).append([[0.1], [0.01]], [0.5, 0.4])
+    with open(path, "a") as f:
+        f.write('{"x": [0.0')
+    # Resuming compacts the journal, new evaluations start on a line of their own.
+    journal = TuningJournal(path)
+    assert journal.hyperparams_names == ["lr"] and len(journal) == 2
+    journal.sync([[0.1], [0.01], [0.001]], [0.5, 0.4, 0.3])
+    journal.compact()
+    assert read_journal(path) == ([[0.1], [0.01], [0.001]], [0.5, 0.4, 0.3])
+    assert len(path.read_text().splitlines()) == 4
+
+
+def test_warm_start_points_taken_in_turns_from_other_runs(tmp_path):
+    def write_journal(run_dir, names, x_iters, func_vals):
+        (tmp_path / run_dir).mkdir(parents=True)
+        TuningJournal(tmp_path / run_dir / "tuning_journal.jsonl", names).append(x_iters, func_vals)
+
+    write_journal("mimic/Mortality24/GRU/old", ["lr", "hidden"], [[0.3, 16]], [0.01])
+    write_journal("eicu/Mortality24/GRU/run", ["lr", "hidden"], [[0.1, 32], [0.01, 64], [0.001, 32]], [0.5, 0.3, 0.4])
+    # The learning rate of the best configuration lies outside the bounds.
+    write_journal("hirid/AKI/GRU/run", ["hidden", "lr"], [[16, 0.05], [16, 0.02], [16, 1.0]], [0.2, 0.1, 0.05])
+    write_journal("aumc/Mortality24/GRU/run", ["lr"], [[0.2]], [0.01])
+    write_journal("eicu/Mortality24/LSTM/run", ["lr", "hidden"], [[0.2, 16]], [0.01])
+    log_dir = tmp_path / "mimic" / "Mortality24" / "GRU" / "run"
+    log_dir.mkdir()
+    bounds = [(1e-4, 0.5, "log-uniform"), (16, 64)]
+    points = collect_warm_start_points(log_dir, "tuning_journal.jsonl", ["lr", "hidden"], bounds, 4)
+    # Same task first, then the other tasks, each source ranked by its own losses.
+    assert points == [[0.01, 64], [0.02, 16], [0.001, 32], [0.05, 16]]
+    assert collect_warm_start_points(log_dir, "tuning_journal.jsonl", ["lr", "hidden"], bounds, 1) == [[0.01, 64]]
+
+
+def test_ensemble_skips_bootstrap_with_warning(trained_gru, caplog, tmp_path):
+    _, loader = trained_gru
+    ensemble = create_ensemble(
+        GRUNet,
+        2,
+        input_size=torch.Size([4, 6, 3]),
+        hidden_dim=4,
+        layer_dim=1,
+        num_classes=2,
+        loss=torch.nn.functional.cross_entropy,
+    )
+    ensemble.enable_bootstrap()
+    ensemble.enable_prediction_writer(tmp_path / "test_predictions.parquet", np.arange(8))
+    tiny_trainer().test(ensemble, loader, verbose=False)
+    assert ensemble.bootstrap_outputs is None and not (tmp_path / "test_predictions.parquet").exists()
+    assert "not supported for ensembles" in caplog.text
+    assert "only computed for binary classification" not in caplog.text
+
+
+RNN_PARAMS = dict(hidden_dim=4, layer_dim=2)
+
+
+@pytest.mark.parametrize(
+    "model_class, params, forward",
+    [
+        (RNNet, RNN_PARAMS, fused_forward),
+        (LSTMNet, RNN_PARAMS, fused_forward),
+        (GRUNet, RNN_PARAMS, fused_forward),
+        (Transformer, dict(hidden=4, heads=2, ff_hidden_mult=2, depth=2), vmap_forward),
+        (TemporalConvNet, dict(num_channels=[4, 4]), vmap_forward),
+    ],
+)
+def test_stacked_forward_matches_members(model_class, params, forward):
+    torch.manual_seed(0)
+    members = list(
+        create_ensemble(
+            model_class, 3, input_size=torch.Size([4, 6, 3]), num_classes=2, loss=torch.nn.functional.cross_entropy, **params
+        ).members
+    )
+    x = torch.randn(5, 6, 3)
+    stacked, expected = forward(members, x), loop_forward(members, x)
+    assert torch.allclose(stacked, expected, atol=1e-6)
+    weight = next(members[1].parameters())
+    gradients = [torch.autograd.grad(out.square().sum(), weight)[0] for out in [stacked, expected]]
+    assert torch.allclose(*gradients, atol=1e-6)